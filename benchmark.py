@@ -0,0 +1,510 @@
+import os
+import sys
+import gc
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+try:
+    from util.synthetic_data import generate_synthetic_dataset
+    from util.feature_A import extract_asymmetry_features
+    from util.feature_B import extract_border_features_from_folder
+    from util.feature_C import extract_feature_C
+    from util.contrast_feature import extract_feature_contrast
+    from util.blue_veil import extract_feature_BV, build_bv_lut, BV_HSV_THRESHOLDS
+    from util.hair_removal_feature import remove_and_save_hairs
+    from util.profiling import get_profile_summary, reset_profile
+    from util.logging_util import get_logger, configure_logging
+    from util.feature_matrix import build_feature_matrix, drop_all_nan_columns, impute_mean_inplace, matrix_memory_mb
+    from util.pyramid import PYRAMID_PRESETS
+    from util.pipeline import (load_pipeline_config, prepare_model_data, resolve_cv_folds, run_cross_validation,
+                               cv_matrix, MODELS)
+    import main_baseline
+    import main_extended
+except ImportError as e:
+    print(f"Error: Could not import pipeline modules for benchmarking: {e}")
+    sys.exit(1)
+
+logger = get_logger("benchmark")
+
+EXTRACTORS = {
+    "A": (extract_asymmetry_features, {}),
+    "B": (extract_border_features_from_folder, {}),
+    "C": (extract_feature_C, {"normalize_colors": True}),
+    "Contrast": (extract_feature_contrast, {}),
+    "BV": (extract_feature_BV, {}),
+}
+
+# Pipeline stages (as named in util.profiling) reported from the end-to-end run
+PIPELINE_STAGES = ["merge", "imputation", "cv.train", "cv.predict"]
+
+# Columns of the merged feature CSV that are labels/ids rather than features
+NON_FEATURE_COLUMNS = ['filename', 'real_label', 'binary_target', 'label', 'diagnostic', 'patient_id', 'lesion_id', 'img_id']
+
+# Pipeline configs whose models are compared by --model-comparison (the current RandomForest first)
+MODEL_COMPARISON_CONFIGS = ("extended", "extended_hgb")
+
+# Feature table for --model-comparison when --features is not given. It was extracted before the
+# contrast family moved to the Otsu mask (contrast_mean_gray etc. are the old KMeans values), so
+# pass a freshly extracted table with --features to compare models on the current features
+DEFAULT_FEATURES_CSV = os.path.join("result", "Main_baseline_extended_results", "Features_dataframe_extended.csv")
+
+# Metrics where a higher value is better; every other metric is "lower is better"
+HIGHER_IS_BETTER = {"images_per_sec"}
+
+
+def _measure(func, *args, measure_memory=True, **kwargs):
+    """
+    Run func and return (result, elapsed seconds, peak traced memory in MB).
+
+    tracemalloc slows allocation-heavy code considerably, so timing comes from an untraced
+    run and the memory peak from a second, traced run.
+    """
+    gc.collect()
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+
+    peak_mb = np.nan
+    if measure_memory:
+        gc.collect()
+        tracemalloc.start()
+        try:
+            func(*args, **kwargs)
+            peak_mb = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+        finally:
+            tracemalloc.stop()
+    return result, elapsed, peak_mb
+
+
+def benchmark_extractors(folder, n_images, size, measure_memory=True):
+    """
+    Time every feature extractor over the synthetic folder.
+
+    The blue-veil lookup table is built once up front (same call as extract_feature_BV), so
+    the BV timing is per-image work and not the one-off table build.
+    """
+    build_bv_lut(tuple(BV_HSV_THRESHOLDS))
+    records = []
+    for name, (func, kwargs) in EXTRACTORS.items():
+        df, elapsed, peak_mb = _measure(func, folder_path=folder, output_csv=None, visualize=False,
+                                        measure_memory=measure_memory, **kwargs)
+        records.append({
+            'benchmark': f"extract_{name}",
+            'size': size,
+            'n_images': n_images,
+            'rows_out': len(df),
+            'seconds': elapsed,
+            'images_per_sec': n_images / elapsed if elapsed > 0 else np.nan,
+            'peak_mem_mb': peak_mb,
+        })
+    return records
+
+
+def benchmark_hair_removal(folder, output_dir, n_images, size, measure_memory=True):
+    """Time remove_and_save_hairs over the synthetic folder (same parameters as main_extended)."""
+    hair_params = {k: tuple(v) if isinstance(v, list) else v
+                   for k, v in main_extended.PIPELINE_CONFIG['hair_removal']['params'].items()}
+    files = sorted(os.listdir(folder))
+
+    def run_all():
+        for filename in files:
+            remove_and_save_hairs(image_path=os.path.join(folder, filename), output_dir=output_dir, **hair_params)
+
+    _, elapsed, peak_mb = _measure(run_all, measure_memory=measure_memory)
+    return [{
+        'benchmark': "hair_removal",
+        'size': size,
+        'n_images': n_images,
+        'rows_out': len(files),
+        'seconds': elapsed,
+        'images_per_sec': n_images / elapsed if elapsed > 0 else np.nan,
+        'peak_mem_mb': peak_mb,
+    }]
+
+
+def benchmark_pipeline_stages(folder, labels_csv, work_dir, n_images, size, measure_memory=True):
+    """
+    Run the full extended pipeline once and report the merge, imputation and CV loop stages
+    from the per-stage profile (these stages only exist inside main_extended.main).
+    """
+    output_csv = os.path.join(work_dir, "features.csv")
+    result_path = os.path.join(work_dir, "model_evaluation.csv")
+    # Untraced run first so the per-stage profile below is not inflated by tracemalloc
+    _, elapsed, _ = _measure(main_extended.main, folder, None, labels_csv, output_csv, result_path,
+                             recreate_features=True, measure_memory=False)
+    summary = get_profile_summary().set_index('stage')
+    peak_mb = np.nan
+    if measure_memory:
+        _, _, peak_mb = _measure(main_extended.main, folder, None, labels_csv, output_csv, result_path,
+                                 recreate_features=True, measure_memory=True)
+    records = [{
+        'benchmark': "pipeline_end_to_end",
+        'size': size,
+        'n_images': n_images,
+        'rows_out': n_images,
+        'seconds': elapsed,
+        'images_per_sec': n_images / elapsed if elapsed > 0 else np.nan,
+        'peak_mem_mb': peak_mb,
+    }]
+    for stage in PIPELINE_STAGES:
+        if stage not in summary.index:
+            logger.warning("Stage '%s' was not recorded during the pipeline run.", stage)
+            continue
+        total = summary.loc[stage, 'total_s']
+        records.append({
+            'benchmark': f"stage_{stage}",
+            'size': size,
+            'n_images': n_images,
+            'rows_out': int(summary.loc[stage, 'count']),
+            'seconds': total,
+            'images_per_sec': n_images / total if total > 0 else np.nan,
+            'peak_mem_mb': np.nan,
+        })
+    return records
+
+
+def _legacy_feature_matrix(df, feature_columns):
+    """The pre-float32 preparation path: get_dummies, per-column to_numeric, SimpleImputer copy."""
+    from sklearn.impute import SimpleImputer
+    if 'c_dominant_channel' in df.columns:
+        df = pd.get_dummies(df, columns=['c_dominant_channel'], prefix='c_dom_channel', dummy_na=False)
+        feature_columns = [c for c in feature_columns if c != 'c_dominant_channel'] + \
+                          [c for c in df.columns if c.startswith('c_dom_channel_')]
+    x_all = df[feature_columns].copy()
+    for feat in feature_columns:
+        x_all[feat] = pd.to_numeric(x_all[feat], errors='coerce')
+    x_all = x_all.drop(columns=x_all.columns[x_all.isnull().all()])
+    x_all.replace([np.inf, -np.inf], np.nan, inplace=True)
+    return pd.DataFrame(SimpleImputer(strategy='mean').fit_transform(x_all), columns=x_all.columns, index=x_all.index)
+
+
+def _float32_feature_matrix(df, feature_columns):
+    x_all, names = build_feature_matrix(df, feature_columns)
+    x_all, names, _ = drop_all_nan_columns(x_all, names)
+    impute_mean_inplace(x_all)
+    return x_all
+
+
+def benchmark_feature_matrix(features_csv, size, multipliers=(10, 100), seed=0, measure_memory=True):
+    """
+    Compare the legacy DataFrame/float64 preparation path with the float32 feature matrix
+    on the merged feature CSV replicated `multiplier` times (rows jittered so the forest
+    does not see exact duplicates), including one Random Forest fit on each result.
+    """
+    from sklearn.ensemble import RandomForestClassifier
+    base_df = pd.read_csv(features_csv)
+    feature_columns = [c for c in base_df.columns if c not in NON_FEATURE_COLUMNS]
+    numeric_cols = base_df[feature_columns].select_dtypes(include='number').columns
+    rng = np.random.default_rng(seed)
+    records = []
+    for multiplier in multipliers:
+        df = pd.concat([base_df] * multiplier, ignore_index=True)
+        df[numeric_cols] = df[numeric_cols] * rng.normal(1.0, 0.01, (len(df), len(numeric_cols)))
+        y = (df['binary_target'].to_numpy() if 'binary_target' in df.columns
+             else np.arange(len(df)) % 2)
+        for name, build in [("legacy", _legacy_feature_matrix), ("float32", _float32_feature_matrix)]:
+            x_all, elapsed, peak_mb = _measure(build, df, feature_columns, measure_memory=measure_memory)
+            model = RandomForestClassifier(n_estimators=100, random_state=42, class_weight='balanced')
+            _, fit_elapsed, _ = _measure(model.fit, x_all, y, measure_memory=False)
+            for benchmark, seconds, mem in [(f"feature_matrix_{name}_x{multiplier}", elapsed, peak_mb),
+                                            (f"rf_fit_{name}_x{multiplier}", fit_elapsed, np.nan)]:
+                records.append({
+                    'benchmark': benchmark,
+                    'size': size,
+                    'n_images': len(df),
+                    'rows_out': len(x_all),
+                    'seconds': seconds,
+                    'images_per_sec': len(df) / seconds if seconds > 0 else np.nan,
+                    'peak_mem_mb': mem,
+                    'matrix_mb': matrix_memory_mb(x_all),
+                })
+    return records
+
+
+def benchmark_pyramid_tradeoff(image_dir, labels_csv, work_dir, presets=None):
+    """
+    Run the baseline pipeline once in normal mode and once per pyramid preset, and report
+    feature-extraction time against cross-validated accuracy.
+
+    Parameters:
+    image_dir (str): Folder with the lesion images.
+    labels_csv (str): Metadata CSV with the labels.
+    work_dir (str): Where each run writes its features and results.
+    presets (list or None): Pyramid preset names; defaults to all of PYRAMID_PRESETS.
+
+    Returns:
+    pd.DataFrame: One row per mode with feature seconds and mean/std test accuracy.
+    """
+    modes = [None] + list(presets if presets is not None else PYRAMID_PRESETS)
+    records = []
+    for preset in modes:
+        mode_name = preset or "normal"
+        mode_dir = os.path.join(work_dir, f"pyramid_{mode_name}")
+        os.makedirs(mode_dir, exist_ok=True)
+        summary = main_baseline.main(image_dir, None, labels_csv, os.path.join(mode_dir, "features.csv"),
+                                     os.path.join(mode_dir, "model_evaluation.csv"), recreate_features=True,
+                                     pyramid_scales=preset) or {}
+        stages = get_profile_summary().set_index('stage')
+        records.append({
+            'mode': mode_name,
+            'scales': json.dumps(PYRAMID_PRESETS[preset]) if preset else "",
+            'feature_seconds': stages.loc['features', 'total_s'] if 'features' in stages.index else np.nan,
+            'mean_test_accuracy': summary.get('mean_test_accuracy_fold', np.nan),
+            'std_test_accuracy': summary.get('std_test_accuracy_fold', np.nan),
+        })
+    return pd.DataFrame(records)
+
+
+def benchmark_models(features_csv, labels_csv=None, configs=MODEL_COMPARISON_CONFIGS, cv_grouping=None):
+    """
+    Train the model of each pipeline config in the same CV loop (same folds, same feature
+    matrix) on an existing feature table and report training time against accuracy.
+    Models with pre-binning also run once without it, to show what binning once for all
+    folds saves.
+
+    Parameters:
+    features_csv (str): Merged feature table with labels (e.g. a main_extended.py output).
+    labels_csv (str or None): Metadata CSV, only needed for cv_grouping='patient'.
+    configs (tuple): Names (or paths) of pipeline configs; their 'model' sections are compared.
+    cv_grouping (str or None): None or 'patient'.
+
+    Returns:
+    pd.DataFrame: One row per model with prebin/train/predict seconds and CV accuracy.
+    """
+    features_df = pd.read_csv(features_csv)
+    if 'contrast_mean_gray' in features_df.columns:
+        logger.warning("%s has the pre-Otsu contrast columns; models are compared on stale contrast features. "
+                       "Re-extract the table for results that match the current pipeline.", features_csv)
+    model_data = prepare_model_data(features_df)
+    if model_data is None:
+        raise ValueError(f"No usable labelled rows in {features_csv}")
+    x_all, y_all, filenames, _, _ = model_data
+    cv_config = load_pipeline_config(configs[0])['cv']
+    cv_folds = resolve_cv_folds(y_all, filenames, labels_csv, n_splits=cv_config['n_splits'], seed=cv_config['seed'],
+                                inner_val_size=cv_config['inner_val_size'], grouping=cv_grouping)
+    if cv_folds is None:
+        raise ValueError("No valid CV split for this feature table.")
+
+    model_configs = []
+    for config in configs:
+        model_config = load_pipeline_config(config)['model']
+        model_configs.append(model_config)
+        if model_config.get('prebin'):
+            model_configs.append(dict(model_config, prebin=False, name=f"{model_config['name']}_unbinned"))
+
+    records = []
+    for model_config in model_configs:
+        reset_profile()
+        start = time.perf_counter()
+        x_cv, _ = cv_matrix(x_all, model_config)
+        fold_results, _ = run_cross_validation(x_cv, y_all, filenames, cv_folds,
+                                               model_class=MODELS[model_config['type']],
+                                               model_params=model_config.get('params', {}),
+                                               model_name=model_config['name'])
+        elapsed = time.perf_counter() - start
+        stages = get_profile_summary().set_index('stage')['total_s']
+        accuracies = np.array([fold['test_accuracy_fold'] for fold in fold_results])
+        f1_scores = np.array([fold.get('macro_avg_f1-score_test_fold', np.nan) for fold in fold_results])
+        records.append({
+            'model': model_config['name'],
+            'type': model_config['type'],
+            'prebin': bool(model_config.get('prebin')),
+            'n_samples': len(x_all),
+            'n_features': x_all.shape[1],
+            'folds': len(fold_results),
+            'prebin_s': stages.get('cv.prebin', 0.0),
+            'train_s': stages.get('cv.train', np.nan),
+            'predict_s': stages.get('cv.predict', np.nan),
+            'total_s': elapsed,
+            'matrix_mb': matrix_memory_mb(x_cv),
+            'mean_test_accuracy': accuracies.mean() if len(accuracies) else np.nan,
+            'std_test_accuracy': accuracies.std(ddof=1) if len(accuracies) > 1 else np.nan,
+            'mean_macro_f1': np.nanmean(f1_scores) if len(f1_scores) else np.nan,
+        })
+    return pd.DataFrame(records)
+
+
+def run_benchmark_suite(sizes=(128, 256, 512), n_images=20, seed=0, work_dir=None, measure_memory=True,
+                        include_pipeline=True, matrix_multipliers=(10, 100)):
+    """
+    Generate synthetic lesion images at each resolution and benchmark every stage on them.
+
+    Returns:
+    pd.DataFrame: One row per (benchmark, size) with seconds, images/sec and peak memory.
+    """
+    cleanup = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp(prefix="fyp_benchmark_")
+    records = []
+    try:
+        for size in sizes:
+            logger.info("Benchmarking at %dx%d with %d synthetic images", size, size, n_images)
+            size_dir = os.path.join(work_dir, f"size_{size}")
+            image_dir = os.path.join(size_dir, "images")
+            labels_csv = os.path.join(size_dir, "labels.csv")
+            if os.path.exists(size_dir):
+                shutil.rmtree(size_dir)
+            generate_synthetic_dataset(image_dir, n_images, size, seed=seed, labels_csv=labels_csv)
+
+            records.extend(benchmark_extractors(image_dir, n_images, size, measure_memory))
+            records.extend(benchmark_hair_removal(image_dir, os.path.join(size_dir, "hair_removed"),
+                                                  n_images, size, measure_memory))
+            if include_pipeline:
+                records.extend(benchmark_pipeline_stages(image_dir, labels_csv, os.path.join(size_dir, "pipeline"),
+                                                         n_images, size, measure_memory))
+                if matrix_multipliers:
+                    records.extend(benchmark_feature_matrix(os.path.join(size_dir, "pipeline", "features.csv"), size,
+                                                            matrix_multipliers, seed, measure_memory))
+    finally:
+        if cleanup:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return pd.DataFrame(records)
+
+
+def _environment_info():
+    import cv2
+    import sklearn
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'opencv': cv2.__version__,
+        'scikit-learn': sklearn.__version__,
+    }
+
+
+def save_baseline(results_df, path, settings):
+    """Save benchmark results plus environment/settings metadata as JSON."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    payload = {
+        'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'environment': _environment_info(),
+        'settings': settings,
+        'results': json.loads(results_df.to_json(orient='records')),
+    }
+    with open(path, 'w') as f:
+        json.dump(payload, f, indent=2)
+    logger.info("Benchmark results saved to %s", path)
+
+
+def compare_to_baseline(results_df, baseline_path, tolerance=0.2):
+    """
+    Compare current results with a saved baseline.
+
+    A metric regresses when it is worse than the baseline by more than `tolerance`
+    (relative), e.g. images/sec dropping by over 20% or peak memory growing by over 20%.
+    Timings are only comparable between runs on the same machine.
+
+    Returns:
+    pd.DataFrame: One row per (benchmark, size, metric) with baseline, current, relative change
+                  and a 'regression' flag.
+    """
+    with open(baseline_path) as f:
+        baseline_df = pd.DataFrame(json.load(f)['results'])
+
+    merged = pd.merge(baseline_df, results_df, on=['benchmark', 'size'], suffixes=('_baseline', '_current'))
+    rows = []
+    for _, row in merged.iterrows():
+        for metric in ['images_per_sec', 'peak_mem_mb']:
+            base, current = row[f'{metric}_baseline'], row[f'{metric}_current']
+            if pd.isna(base) or pd.isna(current) or base == 0:
+                continue
+            change = (current - base) / base
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            rows.append({
+                'benchmark': row['benchmark'],
+                'size': row['size'],
+                'metric': metric,
+                'baseline': base,
+                'current': current,
+                'relative_change': change,
+                'regression': worse > tolerance,
+            })
+    return pd.DataFrame(rows, columns=['benchmark', 'size', 'metric', 'baseline', 'current',
+                                       'relative_change', 'regression'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark feature extraction, hair removal, merging and CV training on synthetic images.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[128, 256, 512], help="Square image resolutions to generate.")
+    parser.add_argument("--n-images", type=int, default=20, help="Synthetic images per resolution.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=os.path.join("result", "benchmarks", "benchmark_latest.json"),
+                        help="Where to write this run's results (JSON).")
+    parser.add_argument("--compare", default=None, help="Baseline JSON to compare against.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative slowdown / memory growth.")
+    parser.add_argument("--work-dir", default=None, help="Keep generated images here instead of a temp dir.")
+    parser.add_argument("--no-memory", action="store_true", help="Skip tracemalloc peak-memory tracking.")
+    parser.add_argument("--skip-pipeline", action="store_true", help="Skip the end-to-end merge/CV stage benchmark.")
+    parser.add_argument("--matrix-multipliers", type=int, nargs="*", default=[10, 100],
+                        help="Row multipliers for the feature matrix benchmark (needs the pipeline run).")
+    parser.add_argument("--pyramid-tradeoff", action="store_true",
+                        help="Only compare normal vs. pyramid feature extraction (time vs. accuracy).")
+    parser.add_argument("--images", default=None, help="Real image folder for --pyramid-tradeoff (default: synthetic).")
+    parser.add_argument("--labels", default=None, help="Labels CSV for --images.")
+    parser.add_argument("--model-comparison", action="store_true",
+                        help="Only compare the RandomForest with the histogram gradient boosting model on a feature table (time vs. accuracy).")
+    parser.add_argument("--features", default=DEFAULT_FEATURES_CSV, help="Feature table for --model-comparison.")
+    args = parser.parse_args()
+
+    configure_logging()
+    if args.model_comparison:
+        comparison_df = benchmark_models(args.features, labels_csv=args.labels)
+        print("\n--- MODEL COMPARISON ---")
+        print(comparison_df.to_string(index=False))
+        comparison_path = os.path.splitext(args.output)[0] + "_model_comparison.csv"
+        os.makedirs(os.path.dirname(comparison_path) or '.', exist_ok=True)
+        comparison_df.to_csv(comparison_path, index=False)
+        logger.info("Model comparison saved to %s", comparison_path)
+        return
+
+    if args.pyramid_tradeoff:
+        work_dir = args.work_dir or tempfile.mkdtemp(prefix="fyp_pyramid_")
+        image_dir, labels_csv = args.images, args.labels
+        if image_dir is None:
+            image_dir = os.path.join(work_dir, "images")
+            labels_csv = os.path.join(work_dir, "labels.csv")
+            generate_synthetic_dataset(image_dir, args.n_images, args.sizes[-1], seed=args.seed, labels_csv=labels_csv)
+        tradeoff_df = benchmark_pyramid_tradeoff(image_dir, labels_csv, work_dir)
+        print("\n--- PYRAMID TRADEOFF ---")
+        print(tradeoff_df.to_string(index=False))
+        tradeoff_path = os.path.splitext(args.output)[0] + "_pyramid_tradeoff.csv"
+        os.makedirs(os.path.dirname(tradeoff_path) or '.', exist_ok=True)
+        tradeoff_df.to_csv(tradeoff_path, index=False)
+        logger.info("Pyramid tradeoff saved to %s", tradeoff_path)
+        return
+
+    results_df = run_benchmark_suite(sizes=args.sizes, n_images=args.n_images, seed=args.seed,
+                                     work_dir=args.work_dir, measure_memory=not args.no_memory,
+                                     include_pipeline=not args.skip_pipeline,
+                                     matrix_multipliers=args.matrix_multipliers)
+    print("\n--- BENCHMARK RESULTS ---")
+    print(results_df.to_string(index=False))
+    save_baseline(results_df, args.output, settings=vars(args))
+
+    if args.compare:
+        comparison_df = compare_to_baseline(results_df, args.compare, tolerance=args.tolerance)
+        print("\n--- COMPARISON WITH BASELINE ---")
+        print(comparison_df.to_string(index=False))
+        comparison_path = os.path.splitext(args.output)[0] + "_comparison.csv"
+        comparison_df.to_csv(comparison_path, index=False)
+        logger.info("Comparison saved to %s", comparison_path)
+        if comparison_df['regression'].any():
+            logger.error("PERFORMANCE REGRESSION: %d metric(s) worse than baseline by more than %.0f%%.",
+                         int(comparison_df['regression'].sum()), args.tolerance * 100)
+            sys.exit(1)
+        logger.info("No performance regressions detected.")
+
+
+if __name__ == "__main__":
+    main()
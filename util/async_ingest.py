@@ -0,0 +1,258 @@
+import os
+import time
+import queue
+import asyncio
+import threading
+import urllib.request
+from urllib.parse import urlparse, unquote
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from util.logging_util import get_logger, ErrorSummary, log_run_summary
+
+logger = get_logger("async_ingest")
+
+# Defaults for the object store; the HTTP stand-in used in tests behaves the same way
+DEFAULT_CONCURRENCY = 16
+DEFAULT_DECODE_WORKERS = 4
+DEFAULT_TIMEOUT_S = 30
+
+# Sentinel that marks the end of the stream in the hand-off queue
+_END = object()
+
+
+class IngestMetrics:
+    """
+    Counters for one ingest run, safe to read from another thread while it is running.
+
+    in_flight counts fetches that hold a semaphore slot; peak_in_flight shows whether the
+    concurrency limit was actually reached.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.finished = None
+        self.requested = 0
+        self.fetched = 0
+        self.decoded = 0
+        self.failed = 0
+        self.bytes_fetched = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.fetch_seconds = 0.0
+        self.decode_seconds = 0.0
+
+    def add(self, **deltas):
+        with self._lock:
+            for name, delta in deltas.items():
+                setattr(self, name, getattr(self, name) + delta)
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def elapsed(self):
+        return (self.finished or time.perf_counter()) - self.started
+
+    def snapshot(self):
+        """Current counters plus throughput (images/s and MB/s) as a plain dict."""
+        with self._lock:
+            elapsed = self.elapsed()
+            return {
+                'requested': self.requested,
+                'fetched': self.fetched,
+                'decoded': self.decoded,
+                'failed': self.failed,
+                'in_flight': self.in_flight,
+                'peak_in_flight': self.peak_in_flight,
+                'mb_fetched': round(self.bytes_fetched / (1024 * 1024), 3),
+                'elapsed_s': round(elapsed, 3),
+                'images_per_sec': round(self.decoded / elapsed, 2) if elapsed > 0 else np.nan,
+                'mb_per_sec': round(self.bytes_fetched / (1024 * 1024) / elapsed, 3) if elapsed > 0 else np.nan,
+                'mean_fetch_s': round(self.fetch_seconds / self.fetched, 4) if self.fetched else np.nan,
+                'mean_decode_s': round(self.decode_seconds / self.decoded, 4) if self.decoded else np.nan,
+            }
+
+
+def source_filename(url):
+    """Filename used for an image URL (last path component), matching the folder mode's names."""
+    return os.path.basename(unquote(urlparse(url).path))
+
+
+def urls_from_listing(base_url, filenames):
+    """Build image URLs for a base URL (object store prefix or HTTP stand-in) and filenames."""
+    base_url = base_url.rstrip('/') + '/'
+    return [base_url + filename for filename in filenames]
+
+
+def _read_url(url, timeout):
+    """
+    Blocking fetch of one object; plain paths and file:// URLs are read from disk. A
+    Windows path such as C:\\data\\x.png parses with the drive letter as its scheme, so
+    existing paths and one-letter schemes are treated as paths.
+    """
+    parsed = urlparse(url)
+    if os.path.exists(url) or len(parsed.scheme) <= 1:
+        with open(url, 'rb') as f:
+            return f.read()
+    if parsed.scheme == 'file':
+        with open(unquote(parsed.path), 'rb') as f:
+            return f.read()
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        return response.read()
+
+
+def _decode(data):
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError("could not decode image bytes")
+    return img
+
+
+async def ingest_images(urls, on_image, concurrency=DEFAULT_CONCURRENCY, decode_workers=DEFAULT_DECODE_WORKERS,
+                        timeout=DEFAULT_TIMEOUT_S, metrics=None, errors=None, on_tasks=None):
+    """
+    Fetch images concurrently and decode them in a thread pool.
+
+    At most `concurrency` fetches run at once (asyncio.Semaphore). The blocking reads run
+    in the default executor and the cv2.imdecode calls in a separate pool of
+    `decode_workers` threads, so slow downloads never hold up decoding.
+
+    Parameters:
+    urls (list): http(s)://, file:// URLs or local paths.
+    on_image (callable): Called as on_image(filename, BGR image) for every decoded image.
+    concurrency (int): Maximum number of simultaneous fetches.
+    decode_workers (int): Threads used for decoding.
+    timeout (float): Per-request timeout in seconds.
+    metrics (IngestMetrics or None): Counters to update; a new one is created if None.
+    errors (ErrorSummary or None): Collector for failed fetches/decodes.
+    on_tasks (callable or None): Called as on_tasks(loop, tasks) once the fetch tasks are
+                                 created, so another thread can cancel them.
+
+    Returns:
+    IngestMetrics: The metrics of this run.
+    """
+    metrics = metrics or IngestMetrics()
+    errors = errors or ErrorSummary(logger, "Ingest")
+    semaphore = asyncio.Semaphore(concurrency)
+    loop = asyncio.get_running_loop()
+    metrics.add(requested=len(urls))
+
+    with ThreadPoolExecutor(max_workers=decode_workers, thread_name_prefix="decode") as decode_pool:
+
+        async def fetch_and_decode(url):
+            filename = source_filename(url)
+            try:
+                async with semaphore:
+                    metrics.add(in_flight=1)
+                    start = time.perf_counter()
+                    try:
+                        data = await loop.run_in_executor(None, _read_url, url, timeout)
+                    finally:
+                        metrics.add(in_flight=-1)
+                metrics.add(fetched=1, bytes_fetched=len(data), fetch_seconds=time.perf_counter() - start)
+
+                start = time.perf_counter()
+                img = await loop.run_in_executor(decode_pool, _decode, data)
+                metrics.add(decoded=1, decode_seconds=time.perf_counter() - start)
+            except Exception as e:
+                metrics.add(failed=1)
+                errors.record(filename, e)
+                return
+            await on_image(filename, img)
+
+        tasks = [asyncio.ensure_future(fetch_and_decode(url)) for url in urls]
+        if on_tasks is not None:
+            on_tasks(loop, tasks)
+        # Cancelled tasks come back as CancelledError results instead of aborting the rest
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    metrics.finished = time.perf_counter()
+    errors.log_summary()
+    log_run_summary(logger, "Ingest", **metrics.snapshot())
+    return metrics
+
+
+def iter_remote_images(urls, concurrency=DEFAULT_CONCURRENCY, decode_workers=DEFAULT_DECODE_WORKERS,
+                       timeout=DEFAULT_TIMEOUT_S, max_buffered=64, metrics=None, errors=None):
+    """
+    Synchronous generator over (filename, BGR image) pairs fetched by `ingest_images`.
+
+    The event loop runs in a background thread and hands decoded arrays over through a
+    bounded queue, so the (synchronous) feature extraction consumes images while later ones
+    are still downloading, and at most `max_buffered` decoded images wait in memory.
+    Images are yielded in completion order, not in the order of `urls`. When the consumer
+    stops early, fetches that have not finished are cancelled.
+    """
+    metrics = metrics or IngestMetrics()
+    handoff = queue.Queue(maxsize=max_buffered)
+    stop = threading.Event()
+    failure = []
+    running = {}
+
+    def on_tasks(loop, tasks):
+        running['loop'], running['tasks'] = loop, tasks
+
+    def cancel_pending():
+        for task in running['tasks']:
+            task.cancel()
+
+    async def on_image(filename, img):
+        # Blocking put in a worker thread, so a slow consumer applies backpressure
+        # without stalling the event loop
+        if not stop.is_set():
+            await asyncio.get_running_loop().run_in_executor(None, handoff.put, (filename, img))
+
+    def run():
+        try:
+            asyncio.run(ingest_images(urls, on_image, concurrency=concurrency, decode_workers=decode_workers,
+                                      timeout=timeout, metrics=metrics, errors=errors, on_tasks=on_tasks))
+        except Exception as e:
+            failure.append(e)
+        finally:
+            handoff.put(_END)
+
+    worker = threading.Thread(target=run, name="async-ingest", daemon=True)
+    worker.start()
+    try:
+        while True:
+            item = handoff.get()
+            if item is _END:
+                break
+            yield item
+    finally:
+        # Consumer stopped early: cancel the outstanding fetches and drain so the producer
+        # thread can finish
+        stop.set()
+        if 'loop' in running:
+            try:
+                running['loop'].call_soon_threadsafe(cancel_pending)
+            except RuntimeError:
+                pass  # loop already closed, nothing left to cancel
+        while worker.is_alive():
+            try:
+                handoff.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        worker.join()
+    if failure:
+        raise failure[0]
+
+
+def extract_features_from_urls(urls, scales='full', normalize_colors=True, concurrency=DEFAULT_CONCURRENCY,
+                               decode_workers=DEFAULT_DECODE_WORKERS, timeout=DEFAULT_TIMEOUT_S):
+    """
+    Fetch images from URLs and extract the A/B/C features from the decoded arrays directly,
+    without staging the images on disk.
+
+    Returns:
+    tuple: ({'A': df, 'B': df, 'C': df}, metrics dict)
+    """
+    from util.pyramid import extract_features_pyramid_from_images
+
+    metrics = IngestMetrics()
+    errors = ErrorSummary(logger, "Ingest")
+    images = iter_remote_images(urls, concurrency=concurrency, decode_workers=decode_workers, timeout=timeout,
+                                metrics=metrics, errors=errors)
+    feature_dfs = extract_features_pyramid_from_images(images, scales=scales, normalize_colors=normalize_colors)
+    return feature_dfs, metrics.snapshot()
@@ -3,11 +3,86 @@ import numpy as np
 import matplotlib.pyplot as plt
 import os
 import pandas as pd
+from functools import lru_cache
 from skimage import color 
 from sklearn.cluster import KMeans
 from tqdm import tqdm 
 
-def extract_feature_BV(folder_path, output_csv=None, normalize_colors=True, visualize=False):
+from util.profiling import stage_timer, timed_stage
+from util.logging_util import get_logger, configure_logging, ErrorSummary, log_run_summary
+from util.checkpoint import PartialResultsWriter
+from util.feature_sink import extractor_sink
+from util.cache_util import CACHE_DIR
+
+logger = get_logger("blue_veil")
+
+# HSV thresholds for blue-veil (tune as needed), on the [0,1] scale of skimage.color.rgb2hsv
+# (h_min, h_max, s_min, s_max, v_min, v_max):
+# H 0.52-0.75 ~ 187-270 deg (cyan-blue to blue-magenta), S 0.10-0.75 allows whitish/grayish
+# blues but not extremely vibrant pure blues, V 0.30-0.95 avoids very dark pixels and pure white.
+BV_HSV_THRESHOLDS = (0.52, 0.75, 0.10, 0.75, 0.30, 0.95)
+
+# Built lookup tables are saved here (one file per threshold tuple) so they are only computed once
+BV_LUT_CACHE_DIR = CACHE_DIR
+
+
+@lru_cache(maxsize=4)
+def build_bv_lut(thresholds=BV_HSV_THRESHOLDS, cache_dir=BV_LUT_CACHE_DIR):
+    """
+    Bit-packed lookup table over all 256^3 RGB colours: bit (r << 16 | g << 8 | b) is set
+    when that colour falls inside the blue-veil HSV thresholds (2 MB).
+
+    The HSV conversion is the same skimage.color.rgb2hsv call used before, so the table
+    reproduces the float threshold test exactly. Building takes a few seconds, so the table
+    is cached in memory and in `cache_dir` (pass None to skip the disk cache); changing
+    the thresholds gives a new file name and therefore a rebuilt table.
+    """
+    cache_path = None
+    if cache_dir:
+        cache_path = os.path.join(cache_dir, "bv_lut_" + "_".join(f"{t:g}" for t in thresholds) + ".npy")
+        if os.path.exists(cache_path):
+            try:
+                lut = np.load(cache_path)
+                if lut.shape == (256 * 256 * 256 // 8,) and lut.dtype == np.uint8:
+                    return lut
+            except (OSError, ValueError) as e:
+                logger.warning("Could not read blue-veil LUT cache %s: %s. Rebuilding.", cache_path, e)
+
+    logger.info("Building blue-veil RGB lookup table for thresholds %s", thresholds)
+    h_min, h_max, s_min, s_max, v_min, v_max = thresholds
+    gb = np.stack(np.meshgrid(np.arange(256), np.arange(256), indexing='ij'), axis=-1).reshape(-1, 2)
+    chunk = np.empty((gb.shape[0], 3), dtype=np.float64)
+    chunk[:, 1:] = gb / 255.0
+    lut = np.empty(256 * 256 * 256 // 8, dtype=np.uint8)
+    step = gb.shape[0] // 8
+    for r in range(256):
+        chunk[:, 0] = r / 255.0
+        hsv = color.rgb2hsv(chunk)
+        mask = ((hsv[:, 0] >= h_min) & (hsv[:, 0] <= h_max) &
+                (hsv[:, 1] >= s_min) & (hsv[:, 1] <= s_max) &
+                (hsv[:, 2] >= v_min) & (hsv[:, 2] <= v_max))
+        lut[r * step:(r + 1) * step] = np.packbits(mask, bitorder='little')
+
+    if cache_path:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            np.save(cache_path, lut)
+        except OSError as e:
+            logger.warning("Could not save blue-veil LUT cache to %s: %s", cache_path, e)
+    return lut
+
+
+def classify_bv_pixels(pixels_rgb, lut):
+    """
+    Blue-veil mask for uint8 RGB pixels of shape (..., 3) using the packed LUT:
+    one byte gather and a bit test per pixel, no float HSV conversion.
+    """
+    idx = (pixels_rgb[..., 0].astype(np.uint32) << 16) | (pixels_rgb[..., 1].astype(np.uint32) << 8) | pixels_rgb[..., 2]
+    return ((lut[idx >> 3] >> (idx & 7).astype(np.uint8)) & 1).astype(bool)
+
+@timed_stage("BV.folder")
+def extract_feature_BV(folder_path, output_csv=None, normalize_colors=True, visualize=False,
+                       hsv_thresholds=BV_HSV_THRESHOLDS, file_list=None):
     """
     Function to extract blue veil features from skin lesion images in a folder.
     Blue veil is characterized by blue-to-whitish or blue-to-gray areas.
@@ -18,40 +93,55 @@ def extract_feature_BV(folder_path, output_csv=None, normalize_colors=True, visu
                       will be added to it (assumes it's a CSV for blue veil features).
     normalize_colors (bool): Whether to normalize output RGB color mean/std values to range [0,1].
     visualize (bool): Whether to visualize the segmentation and blue veil detection results.
+    hsv_thresholds (tuple): (h_min, h_max, s_min, s_max, v_min, v_max) on the rgb2hsv [0,1] scale;
+                            the RGB lookup table is rebuilt (once) for new thresholds.
+    file_list (list or None): Only process these file names (e.g. one chunk), default all.
     
     Returns:
     pd.DataFrame: DataFrame containing blue veil features.
     """
-    results = []
+    results = extractor_sink()
+    errors = ErrorSummary(logger, "BV")
+    no_lesion_count = 0
     valid_extensions = ['.jpg', '.jpeg', '.png', '.bmp']
     
     existing_df = None
     if output_csv and os.path.exists(output_csv):
         try:
             existing_df = pd.read_csv(output_csv)
-            print(f"Loaded existing Blue Veil features from {output_csv}")
+            logger.info("Loaded existing Blue Veil features from %s", output_csv)
         except Exception as e:
-            print(f"Error loading existing CSV {output_csv}: {str(e)}")
+            logger.warning("Error loading existing CSV %s: %s", output_csv, e)
             existing_df = None
+    # Rows are saved every CHECKPOINT_EVERY images, so a crashed run resumes from there
+    writer = PartialResultsWriter(output_csv, existing_df)
 
     image_files = [f for f in os.listdir(folder_path) if os.path.splitext(f)[1].lower() in valid_extensions]
+    if file_list is not None:
+        wanted = set(file_list)
+        image_files = [f for f in image_files if f in wanted]
+    with stage_timer("BV.lut"):
+        bv_lut = build_bv_lut(tuple(hsv_thresholds))
 
     for filename in tqdm(image_files, desc="Extracting Blue Veil Features"): 
+        writer.maybe_flush(results)
         if existing_df is not None and filename in existing_df['filename'].values:
             continue
             
         image_path = os.path.join(folder_path, filename)
         
         current_features = {'filename': filename} 
+        rows_before = len(results)
 
         try:
-            img_bgr = cv2.imread(image_path)
-            if img_bgr is None:
-                print(f"Error reading {filename}, skipping...")
-                continue 
+            with stage_timer("BV.decode"):
+                img_bgr = cv2.imread(image_path)
+                if img_bgr is None:
+                    errors.record(filename, "unreadable image")
+                    continue 
                 
-            img_rgb = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB)
-            img_resized = cv2.resize(img_rgb, (256, 256), interpolation=cv2.INTER_AREA)
+                img_rgb = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB)
+                img_resized = cv2.resize(img_rgb, (256, 256), interpolation=cv2.INTER_AREA)
             
             h, w = img_resized.shape[:2]
 
@@ -64,7 +154,8 @@ def extract_feature_BV(folder_path, output_csv=None, normalize_colors=True, visu
             circular_mask = dist_from_center <= initial_mask_radius
             
             pixels_for_kmeans = img_resized.reshape(-1, 3)
-            kmeans = KMeans(n_clusters=2, random_state=42, n_init='auto').fit(pixels_for_kmeans)
+            with stage_timer("BV.kmeans"):
+                kmeans = KMeans(n_clusters=2, random_state=42, n_init='auto').fit(pixels_for_kmeans)
             labels = kmeans.labels_.reshape(h, w)
             
             center_label = labels[center_y, center_x]
@@ -74,7 +165,8 @@ def extract_feature_BV(folder_path, output_csv=None, normalize_colors=True, visu
             lesion_pixels_rgb = img_resized[final_lesion_mask]
             
             if len(lesion_pixels_rgb) == 0:
-                print(f"No lesion detected in {filename} after segmentation, skipping BV feature extraction.")
+                logger.debug("No lesion detected in %s after segmentation, using default BV features", filename)
+                no_lesion_count += 1
                 
                 current_features['bv_present'] = 0
                 current_features['bv_pixel_count'] = 0
@@ -104,25 +196,8 @@ def extract_feature_BV(folder_path, output_csv=None, normalize_colors=True, visu
                 continue 
 
             # Step 2: Blue Veil Detection
-            lesion_pixels_rgb_normalized = lesion_pixels_rgb / 255.0
-            lesion_pixels_hsv = color.rgb2hsv(lesion_pixels_rgb_normalized)
-
-            # HSV thresholds for blue-veil (tune as needed)
-            # H: [0,1] from skimage.color.rgb2hsv (0-360 degrees)
-            # Blue-ish range: ~180-270 degrees (0.5 - 0.75 in [0,1] scale)
-            H_MIN_BV = 0.52  # Approx 187 deg (cyan-blue)
-            H_MAX_BV = 0.75  # Approx 270 deg (blue-magenta)
-            S_MIN_BV = 0.10  # Min saturation (allow desaturated/whitish/grayish blues)
-            S_MAX_BV = 0.75  # Max saturation (avoid extremely vibrant pure blues if not veil-like)
-            V_MIN_BV = 0.30  # Min value/brightness (avoid very dark pixels)
-            V_MAX_BV = 0.95  # Max value/brightness (avoid pure white)
-
-            bv_pixels_mask_1d = (lesion_pixels_hsv[:, 0] >= H_MIN_BV) & \
-                                (lesion_pixels_hsv[:, 0] <= H_MAX_BV) & \
-                                (lesion_pixels_hsv[:, 1] >= S_MIN_BV) & \
-                                (lesion_pixels_hsv[:, 1] <= S_MAX_BV) & \
-                                (lesion_pixels_hsv[:, 2] >= V_MIN_BV) & \
-                                (lesion_pixels_hsv[:, 2] <= V_MAX_BV)
+            with stage_timer("BV.classify"):
+                bv_pixels_mask_1d = classify_bv_pixels(lesion_pixels_rgb, bv_lut)
             
             detected_bv_rgb_pixels = lesion_pixels_rgb[bv_pixels_mask_1d]
             
@@ -149,7 +224,8 @@ def extract_feature_BV(folder_path, output_csv=None, normalize_colors=True, visu
                     current_features['bv_std_G'] = std_rgb_bv[1]
                     current_features['bv_std_B'] = std_rgb_bv[2]
 
-                detected_bv_hsv_pixels_subset = lesion_pixels_hsv[bv_pixels_mask_1d]
+                # HSV is only needed for the (few) detected blue-veil pixels
+                detected_bv_hsv_pixels_subset = color.rgb2hsv(detected_bv_rgb_pixels / 255.0)
                 mean_hsv_bv = np.mean(detected_bv_hsv_pixels_subset, axis=0)
                 current_features['bv_mean_H'] = mean_hsv_bv[0]
                 current_features['bv_mean_S'] = mean_hsv_bv[1]
@@ -180,13 +256,7 @@ def extract_feature_BV(folder_path, output_csv=None, normalize_colors=True, visu
                 lesion_display_img[final_lesion_mask] = img_resized[final_lesion_mask]
                 plt.subplot(1, 4, 3); plt.imshow(lesion_display_img); plt.title("Extracted Lesion"); plt.axis('off')
 
-                hsv_img_resized_full = color.rgb2hsv(img_resized / 255.0)
-                bv_candidate_mask_on_full_img = (hsv_img_resized_full[:, :, 0] >= H_MIN_BV) & \
-                                                (hsv_img_resized_full[:, :, 0] <= H_MAX_BV) & \
-                                                (hsv_img_resized_full[:, :, 1] >= S_MIN_BV) & \
-                                                (hsv_img_resized_full[:, :, 1] <= S_MAX_BV) & \
-                                                (hsv_img_resized_full[:, :, 2] >= V_MIN_BV) & \
-                                                (hsv_img_resized_full[:, :, 2] <= V_MAX_BV)
+                bv_candidate_mask_on_full_img = classify_bv_pixels(img_resized, bv_lut)
                 actual_bv_mask_2d = np.logical_and(final_lesion_mask, bv_candidate_mask_on_full_img)
                 
                 plt.subplot(1, 4, 4)
@@ -203,9 +273,9 @@ def extract_feature_BV(folder_path, output_csv=None, normalize_colors=True, visu
                 plt.close()
 
         except Exception as e:
-            print(f"Error processing {filename} for Blue Veil features: {str(e)}. File skipped.")
+            errors.record(filename, e)
         
-            if current_features not in results:
+            if len(results) == rows_before:
                 current_features['bv_present'] = 0
                 current_features['bv_pixel_count'] = 0
                 current_features['bv_area_ratio'] = 0.0
@@ -220,20 +290,16 @@ def extract_feature_BV(folder_path, output_csv=None, normalize_colors=True, visu
                 current_features['bv_mean_V'] = 0.0
                 results.append(current_features)
 
-    new_df = pd.DataFrame(results)
-    
-    final_df_to_return = pd.DataFrame() 
-    if not new_df.empty:
-        if existing_df is not None:
-            final_df_to_return = pd.concat([existing_df, new_df], ignore_index=True)
-        else:
-            final_df_to_return = new_df
-    elif existing_df is not None: 
-        final_df_to_return = existing_df
-    
+    final_df_to_return = writer.finish(results)
+    if output_csv and not final_df_to_return.empty:
+        logger.info("Blue Veil features saved to %s", output_csv)
+
+    errors.log_summary()
+    log_run_summary(logger, "BV", images=len(image_files), extracted=len(results), no_lesion=no_lesion_count, errors=errors.count)
     return final_df_to_return
 
 if __name__ == "__main__":
+    configure_logging()
 
     image_folder = r"C:\path\to\your\skin_lesion_images" 
     
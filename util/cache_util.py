@@ -0,0 +1,5 @@
+import os
+
+# Root of every on-disk cache (blue-veil LUTs, metadata index, CV folds, pipeline stages).
+# Set FYP_CACHE_DIR to move them all, e.g. to a scratch disk on a cluster.
+CACHE_DIR = os.environ.get("FYP_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "fyp"))
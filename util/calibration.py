@@ -0,0 +1,362 @@
+import os
+import sys
+import json
+import time
+import argparse
+
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.isotonic import IsotonicRegression
+from sklearn.linear_model import LogisticRegression
+
+from util.logging_util import get_logger, configure_logging, log_run_summary
+from util.pipeline import CLASS_NAMES, summarize_cv, save_cv_reports
+
+logger = get_logger("calibration")
+
+CALIBRATION_METHODS = ('isotonic', 'platt', 'none')
+# balanced_accuracy (the default) weighs the recall of both classes equally; 'cost' minimises
+# the expected cost below and can push the threshold so low that nothing is called non-cancer
+OBJECTIVES = ('balanced_accuracy', 'cost')
+
+# Costs for objective='cost': a missed cancer counts five times as much as a false alarm
+COST_FALSE_NEGATIVE = 5.0
+COST_FALSE_POSITIVE = 1.0
+
+# Scores are clipped to this before the logit of Platt scaling
+_EPS = 1e-6
+
+
+class ProbabilityCalibrator:
+    """
+    Maps the model's cancer probability to a calibrated one, fitted on out-of-fold
+    predictions only (the classifier is not retrained).
+
+    'isotonic' fits a monotone step function, 'platt' a logistic curve on the logit of
+    the score, 'none' keeps the scores.
+    """
+
+    def __init__(self, method='isotonic'):
+        if method not in CALIBRATION_METHODS:
+            raise ValueError(f"method must be one of {CALIBRATION_METHODS}, got {method!r}")
+        self.method = method
+        self.model_ = None
+
+    def fit(self, p, y):
+        p, y = np.asarray(p, dtype=np.float64), np.asarray(y, dtype=int)
+        if self.method == 'isotonic':
+            self.model_ = IsotonicRegression(y_min=0.0, y_max=1.0, out_of_bounds='clip').fit(p, y)
+        elif self.method == 'platt':
+            if len(np.unique(y)) < 2:
+                logger.warning("Platt scaling needs both classes; keeping the raw scores.")
+                self.model_ = None
+            else:
+                self.model_ = LogisticRegression(C=1e6).fit(_logit(p)[:, None], y)
+        return self
+
+    def transform(self, p):
+        p = np.asarray(p, dtype=np.float64)
+        if self.model_ is None:
+            return p
+        if self.method == 'isotonic':
+            return self.model_.predict(p)
+        return self.model_.predict_proba(_logit(p)[:, None])[:, 1]
+
+
+def _logit(p):
+    p = np.clip(p, _EPS, 1 - _EPS)
+    return np.log(p / (1 - p))
+
+
+def load_fold_predictions(path):
+    """
+    Out-of-fold predictions written by the CV reports (*_CV_all_predictions.csv or
+    predictions_summary*.csv): fold, filename, true label and proba_cancer per row.
+    """
+    df = pd.read_csv(path)
+    required = ['fold', 'true_label_encoded', f'proba_{CLASS_NAMES[1]}']
+    missing = [col for col in required if col not in df.columns]
+    if missing:
+        raise ValueError(f"{path} has no column(s) {missing}; expected a CV predictions CSV.")
+    df = df.dropna(subset=required).reset_index(drop=True)
+    if df.empty:
+        raise ValueError(f"{path} has no rows with probabilities.")
+    return df
+
+
+def cross_fit_calibration(p, y, folds, method='isotonic'):
+    """
+    Calibrated out-of-fold probabilities: each fold is calibrated by a calibrator fitted on
+    the other folds, so no row is calibrated with its own label.
+    """
+    calibrated = np.empty(len(p), dtype=np.float64)
+    for fold in np.unique(folds):
+        test = folds == fold
+        train = ~test if (~test).any() else test
+        calibrated[test] = ProbabilityCalibrator(method).fit(p[train], y[train]).transform(p[test])
+    return calibrated
+
+
+def _safe_divide(a, b):
+    a, b = np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64)
+    return np.divide(a, b, out=np.zeros(np.broadcast(a, b).shape), where=b > 0)
+
+
+def metrics_from_counts(tp, fp, tn, fn):
+    """
+    Classification metrics from confusion counts (scalars or arrays, one entry per threshold),
+    with the zero_division=0 convention of sklearn's classification_report.
+
+    Returns:
+    dict: accuracy, balanced_accuracy and precision/recall/f1 per class and macro/weighted.
+    """
+    tp, fp, tn, fn = (np.asarray(x, dtype=np.float64) for x in (tp, fp, tn, fn))
+    n_pos, n_neg = tp + fn, tn + fp
+    n = n_pos + n_neg
+    per_class = {
+        CLASS_NAMES[1]: (_safe_divide(tp, tp + fp), _safe_divide(tp, n_pos), n_pos),
+        CLASS_NAMES[0]: (_safe_divide(tn, tn + fn), _safe_divide(tn, n_neg), n_neg),
+    }
+    metrics = {'accuracy': _safe_divide(tp + tn, n)}
+    for name, (precision, recall, support) in per_class.items():
+        metrics[f'{name}_precision'] = precision
+        metrics[f'{name}_recall'] = recall
+        metrics[f'{name}_f1-score'] = _safe_divide(2 * precision * recall, precision + recall)
+        metrics[f'{name}_support'] = support
+    for metric in ['precision', 'recall', 'f1-score']:
+        values = [metrics[f'{name}_{metric}'] for name in CLASS_NAMES]
+        metrics[f'macro_avg_{metric}'] = (values[0] + values[1]) / 2
+        metrics[f'weighted_avg_{metric}'] = _safe_divide(values[0] * n_neg + values[1] * n_pos, n)
+    metrics['balanced_accuracy'] = metrics['macro_avg_recall']
+    return metrics
+
+
+def threshold_sweep(y, p, thresholds=None, cost_fn=COST_FALSE_NEGATIVE, cost_fp=COST_FALSE_POSITIVE):
+    """
+    Metrics at every threshold, from one sort of the scores.
+
+    A row is predicted cancer when p > threshold, so 0.5 reproduces the model's own
+    predictions. Counts per threshold come from binary searches in the sorted scores of
+    each class, so a sweep over thousands of thresholds takes milliseconds.
+
+    Parameters:
+    y (np.ndarray): True labels (1 = cancer).
+    p (np.ndarray): Cancer probabilities.
+    thresholds (np.ndarray or None): Defaults to 0..1 in steps of 0.001 plus every distinct score.
+    cost_fn (float): Cost of a missed cancer.
+    cost_fp (float): Cost of a false alarm.
+
+    Returns:
+    pd.DataFrame: One row per threshold with counts, metrics and expected cost per image.
+    """
+    y, p = np.asarray(y, dtype=int), np.asarray(p, dtype=np.float64)
+    if thresholds is None:
+        thresholds = np.unique(np.concatenate([np.round(np.linspace(0, 1, 1001), 3), p]))
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    pos_scores, neg_scores = np.sort(p[y == 1]), np.sort(p[y == 0])
+    tp = len(pos_scores) - np.searchsorted(pos_scores, thresholds, side='right')
+    fp = len(neg_scores) - np.searchsorted(neg_scores, thresholds, side='right')
+    fn, tn = len(pos_scores) - tp, len(neg_scores) - fp
+    sweep = pd.DataFrame({'threshold': thresholds, 'tp': tp, 'fp': fp, 'tn': tn, 'fn': fn})
+    for name, values in metrics_from_counts(tp, fp, tn, fn).items():
+        sweep[name] = values
+    sweep['expected_cost'] = (cost_fn * fn + cost_fp * fp) / max(len(y), 1)
+    return sweep
+
+
+def select_threshold(sweep, objective='balanced_accuracy'):
+    """
+    Threshold with the highest balanced accuracy (or lowest expected cost); ties go to the
+    one closest to 0.5. Thresholds that predict the same class for every row are only
+    chosen if no other threshold exists, and then with a warning.
+    """
+    if objective not in OBJECTIVES:
+        raise ValueError(f"objective must be one of {OBJECTIVES}, got {objective!r}")
+    values = sweep['expected_cost'].to_numpy() if objective == 'cost' else -sweep['balanced_accuracy'].to_numpy()
+    predicted_positive = (sweep['tp'] + sweep['fp']).to_numpy()
+    n_rows = (sweep['tp'] + sweep['fp'] + sweep['tn'] + sweep['fn']).to_numpy()
+    both_classes = (predicted_positive > 0) & (predicted_positive < n_rows)
+    if not both_classes.any():
+        logger.warning("Every threshold predicts a single class for all rows.")
+    else:
+        if values[both_classes].min() > values.min() and not np.isclose(values[both_classes].min(), values.min()):
+            logger.warning("The best %s threshold predicts a single class for every row; using the best "
+                           "threshold that predicts both classes instead.", objective)
+        values = np.where(both_classes, values, np.inf)
+    best = np.flatnonzero(np.isclose(values, values.min()))
+    thresholds = sweep['threshold'].to_numpy()[best]
+    return float(thresholds[np.argmin(np.abs(thresholds - 0.5))])
+
+
+def calibration_table(y, p, n_bins=10):
+    """
+    Reliability table (equal-width bins) plus Brier score, log loss and expected calibration error.
+
+    Returns:
+    tuple: (pd.DataFrame per bin, dict of scores)
+    """
+    y, p = np.asarray(y, dtype=np.float64), np.asarray(p, dtype=np.float64)
+    bins = np.minimum((p * n_bins).astype(int), n_bins - 1)
+    count = np.bincount(bins, minlength=n_bins)
+    mean_pred = _safe_divide(np.bincount(bins, weights=p, minlength=n_bins), count)
+    observed = _safe_divide(np.bincount(bins, weights=y, minlength=n_bins), count)
+    table = pd.DataFrame({'bin_low': np.arange(n_bins) / n_bins, 'bin_high': np.arange(1, n_bins + 1) / n_bins,
+                          'count': count, 'mean_predicted': mean_pred, 'observed_rate': observed})
+    clipped = np.clip(p, _EPS, 1 - _EPS)
+    scores = {
+        'brier': float(np.mean((p - y) ** 2)),
+        'log_loss': float(-np.mean(y * np.log(clipped) + (1 - y) * np.log(1 - clipped))),
+        'ece': float(np.sum(count / len(p) * np.abs(observed - mean_pred))),
+    }
+    return table, scores
+
+
+def fold_metrics(y, p, folds, thresholds, model_name):
+    """
+    Per-fold metric rows with the same columns as run_cross_validation's fold details, at
+    one threshold per fold ({fold: threshold}).
+    """
+    rows = []
+    for fold in np.unique(folds):
+        mask = folds == fold
+        threshold = thresholds[fold]
+        pred = p[mask] > threshold
+        truth = y[mask] == 1
+        counts = (np.sum(pred & truth), np.sum(pred & ~truth), np.sum(~pred & ~truth), np.sum(~pred & truth))
+        metrics = {name: float(value) for name, value in metrics_from_counts(*counts).items()}
+        row = {'fold': int(fold), 'model_name': model_name, 'threshold': threshold,
+               'test_accuracy_fold': metrics['accuracy'], 'num_test_samples_fold': int(mask.sum()),
+               'num_features_used': np.nan}
+        for name in CLASS_NAMES:
+            for metric in ['precision', 'recall', 'f1-score', 'support']:
+                row[f'{name}_{metric}_test_fold'] = metrics[f'{name}_{metric}']
+        for avg in ['macro_avg', 'weighted_avg']:
+            for metric in ['precision', 'recall', 'f1-score']:
+                row[f'{avg}_{metric}_test_fold'] = metrics[f'{avg}_{metric}']
+        rows.append(row)
+    return rows
+
+
+def calibrate_predictions(predictions_csv, output_dir, method='isotonic', objective='balanced_accuracy',
+                          cost_fn=COST_FALSE_NEGATIVE, cost_fp=COST_FALSE_POSITIVE, threshold=None,
+                          calibrator_path=None):
+    """
+    Calibrate cached out-of-fold probabilities and pick a decision threshold, without
+    retraining, then rewrite the CV reports at that threshold.
+
+    Calibration and threshold are cross-fitted over the CV folds: every fold is scored with
+    a calibrator and a threshold chosen on the other folds, so the reported metrics are
+    not tuned on the rows they are measured on. The final calibrator and threshold (fitted
+    on all folds) are what new images should use.
+
+    Outputs in output_dir, named after the predictions file:
+    - <base>_threshold_sweep.csv: metrics and expected cost at every threshold (calibrated scores).
+    - <base>_reliability.csv: reliability tables before and after calibration.
+    - <base>_calibrated.csv (+ _CV_fold_details.csv and _CV_all_predictions.csv): the CV
+      reports at the cross-fitted thresholds, in the pipeline's format.
+    - <base>_calibration.json: method, threshold, costs and calibration scores.
+
+    Parameters:
+    predictions_csv (str): *_CV_all_predictions.csv (or predictions_summary*.csv).
+    output_dir (str): Output folder.
+    method (str): 'isotonic', 'platt' or 'none'.
+    objective (str): 'balanced_accuracy' or 'cost' (expected cost with cost_fn/cost_fp).
+    cost_fn (float): Cost of a missed cancer.
+    cost_fp (float): Cost of a false alarm.
+    threshold (float or None): Fixed threshold instead of selecting one.
+    calibrator_path (str or None): Where to save the final calibrator and threshold (joblib).
+
+    Returns:
+    dict: 'threshold', 'method', 'summary' (aggregated metrics), 'sweep' and 'scores'.
+    """
+    df = load_fold_predictions(predictions_csv)
+    y = df['true_label_encoded'].to_numpy(dtype=int)
+    p = df[f'proba_{CLASS_NAMES[1]}'].to_numpy(dtype=np.float64)
+    folds = df['fold'].to_numpy()
+    model_name = f"{df['model_name'].iloc[0]}_calibrated" if 'model_name' in df.columns else f"calibrated_{method}"
+
+    start = time.perf_counter()
+    calibrated = cross_fit_calibration(p, y, folds, method)
+    fold_thresholds = {}
+    for fold in np.unique(folds):
+        if threshold is not None:
+            fold_thresholds[fold] = threshold
+            continue
+        other = folds != fold
+        if not other.any():
+            other = np.ones(len(y), dtype=bool)
+        fold_thresholds[fold] = select_threshold(threshold_sweep(y[other], calibrated[other], cost_fn=cost_fn,
+                                                                 cost_fp=cost_fp), objective)
+    sweep = threshold_sweep(y, calibrated, cost_fn=cost_fn, cost_fp=cost_fp)
+    final_threshold = threshold if threshold is not None else select_threshold(sweep, objective)
+    fold_rows = fold_metrics(y, calibrated, folds, fold_thresholds, model_name)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    logger.info("Calibration, %d-threshold sweep and fold metrics computed in %.1f ms", len(sweep), elapsed_ms)
+
+    raw_table, raw_scores = calibration_table(y, p)
+    cal_table, cal_scores = calibration_table(y, calibrated)
+    final_calibrator = ProbabilityCalibrator(method).fit(p, y)
+
+    base = os.path.splitext(os.path.basename(predictions_csv))[0]
+    base = base[:-len("_CV_all_predictions")] if base.endswith("_CV_all_predictions") else base
+    os.makedirs(output_dir, exist_ok=True)
+    sweep.to_csv(os.path.join(output_dir, f"{base}_threshold_sweep.csv"), index=False)
+    pd.concat([raw_table.assign(scores='raw'), cal_table.assign(scores=method)], ignore_index=True).to_csv(
+        os.path.join(output_dir, f"{base}_reliability.csv"), index=False)
+
+    predictions_df = df.copy()
+    predictions_df[f'proba_{CLASS_NAMES[1]}_calibrated'] = calibrated
+    predictions_df['threshold'] = predictions_df['fold'].map(fold_thresholds)
+    predictions_df['predicted_label_encoded'] = (calibrated > predictions_df['threshold'].to_numpy()).astype(int)
+    predictions_df['predicted_label_text'] = predictions_df['predicted_label_encoded'].map({0: CLASS_NAMES[0], 1: CLASS_NAMES[1]})
+    cv_summary_df, avg_metrics_summary = summarize_cv(fold_rows, model_name=model_name)
+    avg_metrics_summary['threshold'] = final_threshold
+    save_cv_reports(os.path.join(output_dir, f"{base}_calibrated.csv"), cv_summary_df, predictions_df,
+                    avg_metrics_summary)
+
+    summary = {
+        'predictions_csv': predictions_csv, 'method': method, 'objective': objective,
+        'cost_fn': cost_fn, 'cost_fp': cost_fp, 'threshold': final_threshold,
+        'fold_thresholds': {str(fold): t for fold, t in fold_thresholds.items()},
+        'scores_raw': raw_scores, 'scores_calibrated': cal_scores, 'compute_ms': round(elapsed_ms, 2),
+    }
+    with open(os.path.join(output_dir, f"{base}_calibration.json"), 'w') as f:
+        json.dump(summary, f, indent=2, default=float)
+    if calibrator_path:
+        os.makedirs(os.path.dirname(calibrator_path) or '.', exist_ok=True)
+        joblib.dump({'calibrator': final_calibrator, 'threshold': final_threshold, 'metadata': summary}, calibrator_path)
+        logger.info("Calibrator and threshold saved to %s", calibrator_path)
+
+    log_run_summary(logger, "Calibration", method=method, threshold=round(final_threshold, 4),
+                    brier_raw=round(raw_scores['brier'], 4), brier_calibrated=round(cal_scores['brier'], 4),
+                    non_cancer_recall=round(float(avg_metrics_summary.get(f'mean_{CLASS_NAMES[0]}_recall', np.nan)), 4),
+                    cancer_recall=round(float(avg_metrics_summary.get(f'mean_{CLASS_NAMES[1]}_recall', np.nan)), 4))
+    return {'threshold': final_threshold, 'method': method, 'summary': avg_metrics_summary, 'sweep': sweep,
+            'scores': {'raw': raw_scores, 'calibrated': cal_scores}}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Calibrate cached out-of-fold probabilities and choose a decision "
+                                                 "threshold without retraining (run from the repository root: "
+                                                 "python -m util.calibration result/..._CV_all_predictions.csv ...).")
+    parser.add_argument("predictions", help="*_CV_all_predictions.csv or predictions_summary*.csv")
+    parser.add_argument("--output-dir", required=True)
+    parser.add_argument("--method", choices=CALIBRATION_METHODS, default='isotonic')
+    parser.add_argument("--objective", choices=OBJECTIVES, default='balanced_accuracy')
+    parser.add_argument("--cost-fn", type=float, default=COST_FALSE_NEGATIVE, help="Cost of a missed cancer.")
+    parser.add_argument("--cost-fp", type=float, default=COST_FALSE_POSITIVE, help="Cost of a false alarm.")
+    parser.add_argument("--threshold", type=float, default=None, help="Use this threshold instead of selecting one.")
+    parser.add_argument("--save-calibrator", default=None, metavar="PATH",
+                        help="Save the final calibrator and threshold (joblib).")
+    args = parser.parse_args(argv)
+
+    configure_logging()
+    calibrate_predictions(args.predictions, args.output_dir, method=args.method, objective=args.objective,
+                          cost_fn=args.cost_fn, cost_fp=args.cost_fp, threshold=args.threshold,
+                          calibrator_path=args.save_calibrator)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
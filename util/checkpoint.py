@@ -0,0 +1,264 @@
+import os
+import json
+import pickle
+import shutil
+import hashlib
+import threading
+
+import pandas as pd
+
+from util.logging_util import get_logger
+from util.feature_sink import FeatureSink, results_frame
+
+logger = get_logger("checkpoint")
+
+# Folder extractors write their partial results to output_csv every this many images
+CHECKPOINT_EVERY = 50
+
+# An image that failed this many times (in any stage, across runs) is quarantined
+MAX_FAILURES = 2
+
+# Bump when the checkpoint layout changes, so old checkpoints are discarded
+CHECKPOINT_VERSION = 1
+
+
+def write_atomic(path, write):
+    """
+    Call `write(tmp_path)` and rename the temp file to `path`, so a crash never leaves a
+    truncated file and readers (the shard merge, a resumed run) see the old or the new one.
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def write_csv_atomic(df, path):
+    """Write `df` (without index) to a CSV atomically."""
+    write_atomic(path, lambda tmp_path: df.to_csv(tmp_path, index=False))
+
+
+def write_json_atomic(obj, path, indent=None):
+    """Write `obj` to a JSON file atomically."""
+    def write(tmp_path):
+        with open(tmp_path, 'w') as f:
+            json.dump(obj, f, indent=indent)
+    write_atomic(path, write)
+
+
+class PartialResultsWriter:
+    """
+    Periodically saves a folder extractor's rows to its output_csv.
+
+    Each flush appends only the rows added since the previous one, in a single write, so
+    saving costs the same per image however large the file gets. The first flush of a
+    run writes a new file (header included) or appends to the output_csv the existing
+    rows came from; should a batch bring columns the file lacks, the file is rewritten
+    once with all columns.
+
+    The extractors already skip images that are in an existing output_csv, so after a
+    crash a rerun with the same output_csv continues where the last checkpoint ended.
+    """
+
+    def __init__(self, output_csv, existing_df=None, every=CHECKPOINT_EVERY):
+        self.output_csv = output_csv
+        self.existing_df = existing_df
+        self.every = every
+        self._flushed = 0
+        # Columns of output_csv as it is on disk; None until this run writes it
+        self._columns = list(existing_df.columns) if existing_df is not None else None
+
+    def maybe_flush(self, results):
+        if self.output_csv and len(results) - self._flushed >= self.every:
+            self.flush(results)
+
+    def flush(self, results):
+        """Append the rows of `results` added since the last flush to output_csv (if any)."""
+        if self.output_csv and len(results) > self._flushed:
+            new_df = results_frame(results, start=self._flushed)
+            if not new_df.empty:
+                self._append(new_df)
+                logger.debug("Checkpointed %d new rows to %s", len(new_df), self.output_csv)
+        self._flushed = len(results)
+
+    def _append(self, new_df):
+        if self._columns is None:
+            write_csv_atomic(new_df, self.output_csv)
+            self._columns = list(new_df.columns)
+        elif set(new_df.columns) <= set(self._columns):
+            text = new_df.reindex(columns=self._columns).to_csv(index=False, header=False)
+            with open(self.output_csv, 'a', newline='') as f:
+                f.write(text)
+        else:
+            combined_df = pd.concat([pd.read_csv(self.output_csv), new_df], ignore_index=True)
+            write_csv_atomic(combined_df, self.output_csv)
+            self._columns = list(combined_df.columns)
+
+    def finish(self, results):
+        """
+        Save the remaining rows and return the existing rows plus all of `results`;
+        a FeatureSink is closed afterwards (its spilled batches are deleted).
+        """
+        self.flush(results)
+        new_df = results_frame(results)
+        if isinstance(results, FeatureSink):
+            results.close()
+        if self.existing_df is not None and not new_df.empty:
+            return pd.concat([self.existing_df, new_df], ignore_index=True)
+        if not new_df.empty:
+            return new_df
+        return self.existing_df if self.existing_df is not None else pd.DataFrame()
+
+
+def file_signature(folder, filename):
+    """[size, mtime_ns] of an image; rows are only reused while the image is unchanged."""
+    stat = os.stat(os.path.join(folder, filename))
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class ExtractionCheckpoint:
+    """
+    Per-chunk results of a stage-DAG run (util/dag.py), kept on disk so that a restarted
+    job only processes what is missing, plus a record of images that failed.
+
+    Layout of `directory`:
+    - manifest.json: version and hash of the run config; a different config discards the rows.
+    - rows/<stage>/<chunk hash>.pkl: rows of one finished (stage, chunk) with the files it
+      covered and their signatures.
+    - failures.json: {filename: {'count', 'stages', 'last_error'}}; survives clear_rows(),
+      so failures add up across runs and repeat offenders get quarantined. A config change
+      starts it over too, since the new settings may process those images fine.
+
+    After the final output is written, finish() removes the directory (see there).
+    """
+
+    def __init__(self, directory, config=None):
+        self.directory = directory
+        self.rows_dir = os.path.join(directory, "rows")
+        self.failures_path = os.path.join(directory, "failures.json")
+        os.makedirs(self.rows_dir, exist_ok=True)
+
+        config_hash = hashlib.sha256(json.dumps([CHECKPOINT_VERSION, config], sort_keys=True,
+                                                default=str).encode('utf-8')).hexdigest()[:16]
+        manifest_path = os.path.join(directory, "manifest.json")
+        manifest = {}
+        if os.path.exists(manifest_path):
+            try:
+                with open(manifest_path) as f:
+                    manifest = json.load(f)
+            except (OSError, ValueError):
+                manifest = {}
+        if manifest.get('config_hash') != config_hash:
+            if manifest:
+                logger.info("Checkpoint in %s was made with another config; starting over.", directory)
+            self.clear_rows()
+            if os.path.exists(self.failures_path):
+                os.remove(self.failures_path)
+            write_json_atomic({'version': CHECKPOINT_VERSION, 'config_hash': config_hash}, manifest_path, indent=1)
+        self._failures = self._read_failures()
+        self._lock = threading.Lock()
+
+    def _read_failures(self):
+        if not os.path.exists(self.failures_path):
+            return {}
+        try:
+            with open(self.failures_path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning("Could not read %s: %s", self.failures_path, e)
+            return {}
+
+    def has_rows(self):
+        return any(files for _, _, files in os.walk(self.rows_dir))
+
+    def clear_rows(self):
+        """Forget the finished chunks (e.g. after the final CSV is written); failures are kept."""
+        shutil.rmtree(self.rows_dir, ignore_errors=True)
+        os.makedirs(self.rows_dir, exist_ok=True)
+
+    def save_rows(self, stage, files, df, signatures):
+        """Record that `stage` finished `files` (df holds their rows; some files may have none)."""
+        if not files:
+            return
+        stage_dir = os.path.join(self.rows_dir, stage)
+        os.makedirs(stage_dir, exist_ok=True)
+        name = hashlib.sha1("\0".join(files).encode('utf-8')).hexdigest()[:16]
+        path = os.path.join(stage_dir, f"{name}.pkl")
+        rows = {'signatures': {fn: signatures.get(fn) for fn in files}, 'df': df}
+
+        def write(tmp_path):
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(rows, f, protocol=pickle.HIGHEST_PROTOCOL)
+        write_atomic(path, write)
+
+    def load_rows(self, stage, signatures):
+        """
+        Rows of `stage` from earlier runs, restricted to images that are unchanged.
+
+        Returns:
+        tuple: (pd.DataFrame of rows, set of file names the stage already finished)
+        """
+        stage_dir = os.path.join(self.rows_dir, stage)
+        if not os.path.isdir(stage_dir):
+            return pd.DataFrame(columns=['filename']), set()
+        frames, finished = [], set()
+        for entry in sorted(os.listdir(stage_dir)):
+            if not entry.endswith(".pkl"):
+                continue
+            try:
+                with open(os.path.join(stage_dir, entry), 'rb') as f:
+                    saved = pickle.load(f)
+            except Exception as e:
+                logger.warning("Ignoring unreadable checkpoint %s: %s", entry, e)
+                continue
+            valid = {fn for fn, sig in saved['signatures'].items() if sig is not None and signatures.get(fn) == sig}
+            finished |= valid
+            df = saved['df']
+            if df is not None and not df.empty and 'filename' in df.columns:
+                frames.append(df[df['filename'].isin(valid)])
+        frames = [df for df in frames if not df.empty]
+        rows = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=['filename'])
+        return rows, finished
+
+    def record_failure(self, filename, stage, error):
+        with self._lock:
+            entry = self._failures.setdefault(filename, {'count': 0, 'stages': [], 'last_error': None})
+            entry['count'] += 1
+            if stage not in entry['stages']:
+                entry['stages'].append(stage)
+            entry['last_error'] = str(error)[:500]
+            write_json_atomic(self._failures, self.failures_path, indent=1)
+
+    def quarantined(self, max_failures=MAX_FAILURES):
+        """Images that failed at least `max_failures` times; they are skipped by later runs."""
+        return {fn for fn, entry in self._failures.items() if entry['count'] >= max_failures}
+
+    def finish(self):
+        """
+        Clean up once the final output is written. The whole directory is removed, unless
+        images failed: then only manifest.json and failures.json are kept, so the failures
+        keep adding up in the next run.
+        """
+        if not self._failures:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            return
+        keep = {os.path.basename(self.failures_path), "manifest.json"}
+        for entry in os.listdir(self.directory):
+            if entry not in keep:
+                path = os.path.join(self.directory, entry)
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    os.remove(path)
+
+    def release(self, filenames=None):
+        """Take images out of quarantine (all if filenames is None), e.g. after replacing a corrupt file."""
+        with self._lock:
+            for filename in list(self._failures) if filenames is None else filenames:
+                self._failures.pop(filename, None)
+            write_json_atomic(self._failures, self.failures_path, indent=1)
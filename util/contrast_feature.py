@@ -5,39 +5,123 @@ import numpy as np
 import pandas as pd
 import os
 import matplotlib.pyplot as plt
-from sklearn.cluster import KMeans  
 from tqdm import tqdm 
 
+from util.profiling import stage_timer, timed_stage
+from util.logging_util import get_logger, configure_logging, ErrorSummary, log_run_summary
+from util.checkpoint import PartialResultsWriter
+from util.feature_sink import extractor_sink
+from util.integral_texture import IntegralImage, box_mean_std, ring_mean_std
 
-def extract_feature_contrast(folder_path, output_csv=None, visualize=False):
+logger = get_logger("contrast_feature")
+
+# Window sizes (pixels, on the 256x256 image) for the local mean/variance maps
+LOCAL_WINDOWS = (5, 11, 21)
+# Widths (pixels) of the surround rings around the lesion bounding box
+RING_WIDTHS = (8, 16, 32)
+
+
+def segment_lesion_gray(gray):
+    """
+    Lesion mask from a grayscale image: Otsu threshold, keep the class of the centre pixel,
+    restricted to a central circle (radius = min(h, w) // 3) like the other colour features.
+    """
+    h, w = gray.shape
+    center_y, center_x = h // 2, w // 2
+    _, otsu = cv2.threshold(gray, 0, 1, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    circ_mask = np.zeros((h, w), dtype=np.uint8)
+    cv2.circle(circ_mask, (center_x, center_y), min(h, w) // 3, 1, -1)
+    return np.logical_and(circ_mask.astype(bool), otsu == otsu[center_y, center_x])
+
+
+def compute_contrast_features(gray, lesion_mask, windows=LOCAL_WINDOWS, ring_widths=RING_WIDTHS):
+    """
+    Contrast and local texture features from integral images.
+
+    Parameters:
+    gray (np.ndarray): uint8 grayscale image.
+    lesion_mask (np.ndarray): Boolean lesion mask (non-empty).
+    windows (tuple): Window sizes for the multi-scale local mean/variance maps.
+    ring_widths (tuple): Widths of the surround rings around the lesion bounding box.
+
+    Returns:
+    dict: Feature values (without 'filename').
+    """
+    integral = IntegralImage(gray, pad=max(windows) // 2)
+    lesion_gray = gray[lesion_mask].astype(np.float64)
+    background = ~lesion_mask
+    # Named after the Otsu mask: the KMeans-based contrast_mean_gray/contrast_std_gray/lesion_pixel_count
+    # of older feature tables measured a different region and are not comparable
+    features = {
+        'contrast_otsu_mean_gray': lesion_gray.mean(),
+        'contrast_otsu_std_gray': lesion_gray.std(),
+        'contrast_otsu_pixel_count': lesion_gray.size,
+        'contrast_lesion_bg_diff': gray[background].mean() - lesion_gray.mean() if background.any() else np.nan,
+    }
+
+    # Multi-scale local texture: average local std inside the lesion and relative to the background
+    for window in windows:
+        _, var = integral.local_mean_var(window)
+        local_std = np.sqrt(var)
+        lesion_local = local_std[lesion_mask].mean()
+        bg_local = local_std[background].mean() if background.any() else np.nan
+        features[f'contrast_local_std_w{window}'] = lesion_local
+        features[f'contrast_local_std_ratio_w{window}'] = lesion_local / bg_local if bg_local else np.nan
+
+    # Lesion bounding box vs. surrounding rings
+    ys, xs = np.nonzero(lesion_mask)
+    bbox = (ys.min(), xs.min(), ys.max() + 1, xs.max() + 1)
+    box_mean, box_std = box_mean_std(integral, *bbox)
+    for width in ring_widths:
+        ring_mean, ring_std = ring_mean_std(integral, bbox, width)
+        features[f'contrast_ring{width}_diff'] = ring_mean - box_mean
+        features[f'contrast_ring{width}_michelson'] = (abs(ring_mean - box_mean) / (ring_mean + box_mean)
+                                                        if (ring_mean + box_mean) > 0 else np.nan)
+        features[f'contrast_ring{width}_std_ratio'] = ring_std / box_std if box_std > 0 else np.nan
+    return features
+
+
+@timed_stage("Contrast.folder")
+def extract_feature_contrast(folder_path, output_csv=None, visualize=False, file_list=None):
     """
     Extract contrast-related features from skin lesion images in a folder.
 
-    Contrast here is computed as the standard deviation of grayscale pixel intensities
-    within a lesion mask estimated by a simple circular + KMeans segmentation (similar to BV).
+    The lesion is segmented with a central circle + Otsu threshold on grayscale. Contrast is
+    the mean/std of lesion grayscale intensities plus integral-image texture features:
+    multi-scale local standard deviation inside the lesion vs. the background, and
+    lesion-vs-surround contrast over rings around the lesion bounding box.
 
     Parameters:
     - folder_path (str): Path to folder with images.
     - output_csv (str or None): If provided and file exists, load and append new data.
     - visualize (bool): Show/save visualizations of segmentation and contrast mask.
+    - file_list (list or None): Only process these file names (e.g. one chunk), default all.
 
     Returns:
     - pd.DataFrame with contrast features.
     """
-    results = []
+    results = extractor_sink()
+    errors = ErrorSummary(logger, "Contrast")
+    no_lesion_count = 0
     valid_exts = ['.jpg', '.jpeg', '.png', '.bmp']
 
     existing_df = None
     if output_csv and os.path.exists(output_csv):
         try:
             existing_df = pd.read_csv(output_csv)
-            print(f"Loaded existing contrast features from {output_csv}")
+            logger.info("Loaded existing contrast features from %s", output_csv)
         except Exception as e:
-            print(f"Error loading {output_csv}: {e}")
+            logger.warning("Error loading %s: %s", output_csv, e)
+    # Rows are saved every CHECKPOINT_EVERY images, so a crashed run resumes from there
+    writer = PartialResultsWriter(output_csv, existing_df)
 
     files = [f for f in os.listdir(folder_path) if os.path.splitext(f)[1].lower() in valid_exts]
+    if file_list is not None:
+        wanted = set(file_list)
+        files = [f for f in files if f in wanted]
 
     for filename in tqdm(files, desc="Extracting Contrast Features"): 
+        writer.maybe_flush(results)
         if existing_df is not None and filename in existing_df['filename'].values:
            
             continue
@@ -46,54 +130,32 @@ def extract_feature_contrast(folder_path, output_csv=None, visualize=False):
         
 
         try:
-            img_bgr = cv2.imread(filepath)
-            if img_bgr is None:
-                print(f"Could not read {filename}, skipping.")
-                continue
-
-            img_rgb = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB)
-            img_resized = cv2.resize(img_rgb, (256, 256), interpolation=cv2.INTER_AREA)
-
-            h, w = img_resized.shape[:2]
-
-            # Simple circular mask around center as initial guess for lesion area
-            center_y, center_x = h // 2, w // 2
-            y_coords, x_coords = np.ogrid[:h, :w]
-            dist = np.sqrt((x_coords - center_x) ** 2 + (y_coords - center_y) ** 2)
-            radius = min(h, w) // 3
-            circ_mask = dist <= radius
+            with stage_timer("Contrast.decode"):
+                img_bgr = cv2.imread(filepath)
+                if img_bgr is None:
+                    errors.record(filename, "unreadable image")
+                    continue
 
-            # KMeans to segment lesion vs. background
-            pixels = img_resized.reshape(-1, 3)
-            kmeans = KMeans(n_clusters=2, random_state=42, n_init='auto').fit(pixels)
-            labels = kmeans.labels_.reshape(h, w)
+                img_resized = cv2.resize(img_bgr, (256, 256), interpolation=cv2.INTER_AREA)
+                gray = cv2.cvtColor(img_resized, cv2.COLOR_BGR2GRAY)
 
-            center_label = labels[center_y, center_x]
-            lesion_mask = np.logical_and(circ_mask, labels == center_label)
+            with stage_timer("Contrast.segment"):
+                lesion_mask = segment_lesion_gray(gray)
 
-            lesion_pixels = img_resized[lesion_mask]
-
-            if lesion_pixels.size == 0:
-                print(f"No lesion pixels found in {filename}, skipping.")
+            if not lesion_mask.any():
+                logger.debug("No lesion pixels found in %s, skipping", filename)
+                no_lesion_count += 1
                 continue
 
-            # Convert lesion pixels to grayscale for contrast calculation
-            lesion_gray = cv2.cvtColor(lesion_pixels.reshape(-1,1,3).astype(np.uint8), cv2.COLOR_RGB2GRAY).flatten()
-
-            # Contrast = standard deviation of lesion grayscale intensities
-            contrast_std = np.std(lesion_gray)
-            contrast_mean = np.mean(lesion_gray)
-
-            features = {
-                'filename': filename,
-                'contrast_mean_gray': contrast_mean,
-                'contrast_std_gray': contrast_std,
-                'lesion_pixel_count': lesion_gray.size
-            }
+            with stage_timer("Contrast.integral"):
+                features = {'filename': filename}
+                features.update(compute_contrast_features(gray, lesion_mask))
+            contrast_std = features['contrast_otsu_std_gray']
 
             results.append(features)
 
             if visualize:
+                img_resized = cv2.cvtColor(img_resized, cv2.COLOR_BGR2RGB)
                 plt.figure(figsize=(12, 4))
                 plt.subplot(1, 3, 1)
                 plt.imshow(img_resized)
@@ -118,18 +180,18 @@ def extract_feature_contrast(folder_path, output_csv=None, visualize=False):
                 plt.close()
 
         except Exception as e:
-            print(f"Error processing {filename}: {e}")
+            errors.record(filename, e)
 
-    df_new = pd.DataFrame(results)
-
-    if existing_df is not None:
-        df_final = pd.concat([existing_df, df_new], ignore_index=True)
-    else:
-        df_final = df_new
+    df_final = writer.finish(results)
+    if output_csv and not df_final.empty:
+        logger.info("Contrast features saved to %s", output_csv)
 
+    errors.log_summary()
+    log_run_summary(logger, "Contrast", images=len(files), extracted=len(results), no_lesion=no_lesion_count, errors=errors.count)
     return df_final
 
 if __name__ == "__main__":
+    configure_logging()
     folder = r"C:\path\to\your\skin_lesion_images"
     output_csv_path = r"C:\path\to\your\output\contrast_features.csv"
 
@@ -0,0 +1,166 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+from sklearn.model_selection import StratifiedKFold, StratifiedGroupKFold, train_test_split
+
+from util.logging_util import get_logger
+from util.cache_util import CACHE_DIR
+
+logger = get_logger("cv_folds")
+
+# Folds go in their own subfolder of the shared cache directory
+CV_FOLDS_CACHE_DIR = os.path.join(CACHE_DIR, "cv_folds")
+
+# Bump when the fold construction changes, so cached folds are not reused
+CV_FOLDS_VERSION = 1
+
+CV_GROUPINGS = (None, 'patient')
+
+
+class CVFold:
+    """Index arrays (positions into the full matrix) of one outer fold and its inner split."""
+
+    def __init__(self, dev, test, train, val):
+        self.dev, self.test, self.train, self.val = dev, test, train, val
+
+
+def _inner_split(dev, y, groups, inner_val_size, seed):
+    """Split the dev part into train/validation; grouped if groups are given."""
+    if groups is None:
+        return train_test_split(dev, test_size=inner_val_size, random_state=seed, stratify=y[dev])
+    n_inner = max(2, int(round(1 / inner_val_size)))
+    splitter = StratifiedGroupKFold(n_splits=n_inner, shuffle=True, random_state=seed)
+    train_pos, val_pos = next(splitter.split(dev, y[dev], groups[dev]))
+    return dev[train_pos], dev[val_pos]
+
+
+def make_folds(y, groups=None, n_splits=5, seed=42, inner_val_size=0.25):
+    """
+    Outer CV folds plus the inner train/validation split of every fold.
+
+    Without groups this reproduces the original loop exactly (StratifiedKFold, then
+    train_test_split(test_size=inner_val_size, stratify) on the dev part). With groups
+    (e.g. patient ids) both levels use StratifiedGroupKFold, so no group appears on
+    both sides of any split.
+
+    Returns:
+    list: CVFold per outer fold; train/val are None if the inner split failed.
+    """
+    y = np.asarray(y)
+    groups = None if groups is None else np.asarray(groups)
+    if groups is None:
+        outer = StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=seed).split(np.zeros(len(y)), y)
+    else:
+        outer = StratifiedGroupKFold(n_splits=n_splits, shuffle=True, random_state=seed).split(np.zeros(len(y)), y, groups)
+
+    folds = []
+    for fold_num, (dev, test) in enumerate(outer):
+        try:
+            train, val = _inner_split(dev, y, groups, inner_val_size, seed)
+        except ValueError as e:
+            logger.error("Error during inner data splitting for fold %s: %s.", fold_num + 1, e)
+            train = val = None
+        folds.append(CVFold(dev, test, train, val))
+    return folds
+
+
+def max_grouped_splits(y, groups):
+    """Largest n_splits a stratified grouped split supports: distinct groups of the rarest class."""
+    y, groups = np.asarray(y), np.asarray(groups)
+    return min(len(np.unique(groups[y == label])) for label in np.unique(y))
+
+
+def check_group_leakage(folds, groups):
+    """Number of groups that occur on both sides of an outer or inner split (0 = no leakage)."""
+    groups = np.asarray(groups)
+    leaked = 0
+    for fold in folds:
+        leaked += len(np.intersect1d(groups[fold.dev], groups[fold.test]))
+        if fold.train is not None:
+            leaked += len(np.intersect1d(groups[fold.train], groups[fold.val]))
+    return leaked
+
+
+def fold_cache_key(filenames, y, groups, n_splits, seed, inner_val_size):
+    """Hash of everything the folds depend on: sample order, labels, groups and settings."""
+    digest = hashlib.sha256()
+    # n_splits may be a numpy integer (reduced to the smallest class count), which json cannot encode
+    digest.update(json.dumps({'version': CV_FOLDS_VERSION, 'n_splits': int(n_splits), 'seed': int(seed),
+                              'inner_val_size': inner_val_size, 'grouped': groups is not None}).encode())
+    digest.update("\0".join(map(str, filenames)).encode('utf-8'))
+    digest.update(np.asarray(y, dtype=np.int64).tobytes())
+    if groups is not None:
+        digest.update("\0".join(map(str, groups)).encode('utf-8'))
+    return digest.hexdigest()[:20]
+
+
+def save_folds(path, folds):
+    arrays = {}
+    for i, fold in enumerate(folds):
+        for part in ('dev', 'test', 'train', 'val'):
+            value = getattr(fold, part)
+            arrays[f"{i}_{part}"] = value if value is not None else np.array([-1], dtype=np.int64)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = path + f".{os.getpid()}.tmp.npz"
+    np.savez_compressed(tmp_path, n_folds=len(folds), **arrays)
+    os.replace(tmp_path, path)
+
+
+def load_folds(path):
+    with np.load(path) as data:
+        folds = []
+        for i in range(int(data['n_folds'])):
+            parts = {part: data[f"{i}_{part}"] for part in ('dev', 'test', 'train', 'val')}
+            for part in ('train', 'val'):
+                if parts[part].size == 1 and parts[part][0] == -1:
+                    parts[part] = None
+            folds.append(CVFold(**parts))
+    return folds
+
+
+def get_cv_folds(filenames, y, groups=None, n_splits=5, seed=42, inner_val_size=0.25, cache_dir=CV_FOLDS_CACHE_DIR):
+    """
+    Fold index arrays for this dataset, computed once and cached as .npz.
+
+    The cache key covers the file order, labels, groups and settings, so every model and
+    experiment on the same data reuses identical folds (and results stay comparable),
+    while any change to the data gives new folds. Pass cache_dir=None to skip the cache.
+
+    Parameters:
+    filenames (sequence): Sample ids in matrix row order.
+    y (sequence): Binary labels.
+    groups (sequence or None): Group per sample (e.g. patient_id) for grouped CV.
+    n_splits (int): Outer folds.
+    seed (int): random_state of the splitters.
+    inner_val_size (float): Fraction of each dev part used for inner validation.
+    cache_dir (str or None): Where fold files are kept.
+
+    Returns:
+    list: CVFold per outer fold.
+    """
+    cache_path = None
+    if cache_dir:
+        key = fold_cache_key(filenames, y, groups, n_splits, seed, inner_val_size)
+        cache_path = os.path.join(cache_dir, f"folds_{key}.npz")
+        if os.path.exists(cache_path):
+            try:
+                folds = load_folds(cache_path)
+                logger.debug("Loaded %d cached CV folds from %s", len(folds), cache_path)
+                return folds
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning("Could not read cached folds %s: %s. Recomputing.", cache_path, e)
+
+    folds = make_folds(y, groups=groups, n_splits=n_splits, seed=seed, inner_val_size=inner_val_size)
+    if groups is not None:
+        leaked = check_group_leakage(folds, groups)
+        if leaked:
+            raise RuntimeError(f"{leaked} group(s) appear on both sides of a split")
+    if cache_path:
+        try:
+            save_folds(cache_path, folds)
+            logger.debug("Saved CV folds to %s", cache_path)
+        except OSError as e:
+            logger.warning("Could not save CV folds to %s: %s", cache_path, e)
+    return folds
@@ -0,0 +1,395 @@
+import os
+import threading
+import multiprocessing
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import pandas as pd
+
+from util.profiling import cprofile_enabled, pop_stage_timings, merge_stage_timings
+from util.logging_util import get_logger, log_run_summary
+from util.checkpoint import file_signature, MAX_FAILURES
+from util.feature_sink import FeatureSink
+
+logger = get_logger("dag")
+
+# Images per task; small enough that downstream stages start early, large enough to keep overhead low
+CHUNK_SIZE = 32
+# How many chunks a stage may run ahead of the oldest chunk that is not fully extracted yet
+MAX_CHUNKS_AHEAD = 4
+# Time an isolated worker process may take to start and import the stage code
+WORKER_STARTUP_TIMEOUT_S = 120
+
+
+class Stage:
+    """
+    One node of the extraction DAG.
+
+    `func(folders, file_list)` processes the images in `file_list` and returns a DataFrame
+    with a 'filename' column; `folders` maps input names ('raw', 'hair_removed', 'mask',
+    ...) to folder paths. A stage that writes images for other stages names that folder
+    in `produces`; its consumers start on a chunk as soon as the producer finished that
+    chunk. `finalize` runs once on the joined rows of all chunks (e.g. scores normalised
+    over the whole dataset).
+    """
+
+    def __init__(self, name, func, inputs=('raw',), produces=None, finalize=None):
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inputs)
+        self.produces = produces
+        self.finalize = finalize
+
+
+class _FolderExtractor:
+    # A class rather than a closure, so the task can be pickled to an isolated worker process
+    def __init__(self, extract_func, input_name, kwargs):
+        self.extract_func, self.input_name, self.kwargs = extract_func, input_name, kwargs
+
+    def __call__(self, folders, file_list):
+        return self.extract_func(folder_path=folders[self.input_name], output_csv=None, visualize=False,
+                                 file_list=file_list, **self.kwargs)
+
+
+def extractor_stage(name, extract_func, input_name='raw', finalize=None, **kwargs):
+    """Stage for a folder extractor with the usual (folder_path, output_csv, visualize, file_list) signature."""
+    return Stage(name, _FolderExtractor(extract_func, input_name, kwargs), inputs=(input_name,), finalize=finalize)
+
+
+def _worker_loop(conn):
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        func, folders, files = task
+        conn.send(('started', None))
+        # Stage timers run in this process; their timings travel back with the result
+        try:
+            result = func(folders, files)
+            conn.send(('ok', (result, pop_stage_timings())))
+        except Exception as e:
+            conn.send(('error', (f"{type(e).__name__}: {e}", pop_stage_timings())))
+
+
+class IsolatedWorker:
+    """
+    A child process that runs stage tasks. If a task hangs past its timeout or the process
+    dies (segfault in a decoder, OOM kill), only this worker is lost: it is killed and a
+    fresh one is started for the next task. The stage timings recorded in the child are
+    merged into the parent's profile with every result.
+    """
+
+    def __init__(self):
+        self._process = None
+        self._conn = None
+
+    def _start(self):
+        ctx = multiprocessing.get_context("spawn")
+        self._conn, child_conn = ctx.Pipe()
+        self._process = ctx.Process(target=_worker_loop, args=(child_conn,), daemon=True)
+        self._process.start()
+        child_conn.close()
+
+    def kill(self):
+        if self._process is not None:
+            self._process.kill()
+            self._process.join()
+            self._conn.close()
+        self._process = self._conn = None
+
+    def close(self):
+        if self._process is not None and self._process.is_alive():
+            try:
+                self._conn.send(None)
+                self._process.join(timeout=5)
+            except OSError:
+                pass
+        self.kill()
+
+    def _receive(self, timeout):
+        if not self._conn.poll(timeout):
+            self.kill()
+            raise TimeoutError(f"no result within {timeout:.0f}s")
+        try:
+            return self._conn.recv()
+        except (EOFError, OSError):
+            self._died()
+
+    def _died(self):
+        self._process.join(timeout=5)
+        exitcode = self._process.exitcode
+        self.kill()
+        raise ChildProcessError(f"worker process died (exit code {exitcode})")
+
+    def run(self, func, folders, files, timeout):
+        if self._process is None or not self._process.is_alive():
+            self._start()
+        try:
+            self._conn.send((func, folders, files))
+        except OSError:
+            self._died()
+        # Unpickling the task imports the stage code in the child; that does not count as task time
+        self._receive(WORKER_STARTUP_TIMEOUT_S)
+        status, (value, timings) = self._receive(timeout)
+        merge_stage_timings(timings)
+        if status == 'error':
+            raise RuntimeError(value)
+        return value
+
+
+class StreamingJoiner:
+    """
+    Collects per-chunk results as they finish. An image counts as joined once every stage
+    has returned its row, at which point `on_image(filename)` is called, so consumers can
+    act on complete images before the whole folder is done.
+
+    With `sink_dir`, each stage's rows go to a FeatureSink in `sink_dir/<stage>` as they
+    arrive instead of staying in memory; the frames are then in completion order, which
+    is fine for the merge on 'filename'.
+    """
+
+    def __init__(self, stage_names, on_image=None, sink_dir=None):
+        self.stage_names = list(stage_names)
+        self.on_image = on_image
+        self.joined = 0
+        self._parts = defaultdict(dict)
+        self._seen = defaultdict(set)
+        self._sinks = None
+        if sink_dir is not None:
+            self._sinks = {name: FeatureSink(os.path.join(sink_dir, name)) for name in self.stage_names}
+
+    def add(self, stage_name, chunk_index, df):
+        if self._sinks is not None:
+            self._sinks[stage_name].append_frame(df)
+        else:
+            self._parts[stage_name][chunk_index] = df
+        if df is None or df.empty or 'filename' not in df.columns:
+            return
+        for filename in df['filename']:
+            seen = self._seen[filename]
+            seen.add(stage_name)
+            if len(seen) == len(self.stage_names):
+                self.joined += 1
+                if self.on_image is not None:
+                    self.on_image(filename)
+
+    def frames(self, stages):
+        """{stage name: rows of all chunks in chunk order, finalized}."""
+        result = {}
+        for stage in stages:
+            if self._sinks is not None:
+                df = self._sinks[stage.name].to_frame()
+                self._sinks[stage.name].close()
+                if df.empty:
+                    df = pd.DataFrame(columns=['filename'])
+            else:
+                parts = [df for _, df in sorted(self._parts[stage.name].items()) if df is not None and not df.empty]
+                df = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=['filename'])
+            if stage.finalize is not None and not df.empty:
+                df = stage.finalize(df)
+            result[stage.name] = df
+        return result
+
+
+def _check_graph(stages, folders):
+    producers = {}
+    for stage in stages:
+        if stage.produces:
+            if stage.produces in producers:
+                raise ValueError(f"Folder '{stage.produces}' is produced by both {producers[stage.produces]} and {stage.name}")
+            producers[stage.produces] = stage.name
+    for stage in stages:
+        for name in stage.inputs + ((stage.produces,) if stage.produces else ()):
+            if name not in folders:
+                raise ValueError(f"Stage {stage.name} uses folder '{name}', which has no path")
+
+    # Depth = longest chain of producers above a stage; fails on cycles
+    by_name = {stage.name: stage for stage in stages}
+    depth = {}
+
+    def stage_depth(stage, visiting=()):
+        if stage.name in visiting:
+            raise ValueError(f"Cycle in stage graph at {stage.name}")
+        if stage.name not in depth:
+            upstream = [by_name[producers[name]] for name in stage.inputs if name in producers]
+            depth[stage.name] = 1 + max((stage_depth(s, visiting + (stage.name,)) for s in upstream), default=-1)
+        return depth[stage.name]
+
+    for stage in stages:
+        stage_depth(stage)
+    return producers, depth
+
+
+def _concat_rows(frames):
+    frames = [df for df in frames if df is not None and not df.empty]
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=['filename'])
+
+
+def run_dag(stages, folders, file_names, chunk_size=CHUNK_SIZE, max_workers=None, max_chunks_ahead=MAX_CHUNKS_AHEAD,
+            on_image=None, checkpoint=None, image_timeout=None, max_failures=MAX_FAILURES, sink_dir=None):
+    """
+    Run the stages over `file_names` in chunks on a shared thread pool.
+
+    Every (stage, chunk) is one task. A task is ready once the producers of its input
+    folders finished the same chunk, so e.g. all extractors work on chunk 0 while hair
+    removal continues with chunk 1, and a slow extractor only delays its own column.
+    Backpressure: at most `max_workers` tasks run at a time, earlier chunks go first,
+    and no task starts more than `max_chunks_ahead` chunks past the oldest unfinished
+    chunk. OpenCV, NumPy and scikit-learn release the GIL in their heavy parts, so
+    threads overlap well.
+
+    Failures are isolated per image: if a task fails, its images are retried one by one
+    and only the ones that fail again are dropped (and recorded in the checkpoint). With
+    `image_timeout`, tasks run in IsolatedWorker processes, so a hanging or crashing image
+    costs one worker instead of the whole run. With a `checkpoint`, every finished task is
+    saved, a restarted run only processes what is missing, and images that failed
+    `max_failures` times are skipped.
+
+    Parameters:
+    stages (list): Stage objects; the order is the order of the returned frames.
+    folders (dict): {input name: folder path}, including the folders stages produce.
+    file_names (list): Images to process (file names inside the 'raw' folder).
+    chunk_size (int): Images per task.
+    max_workers (int or None): Pool size; defaults to min(len(stages), cpu count).
+    max_chunks_ahead (int): Backpressure window in chunks.
+    on_image (callable or None): Called with each file name once all stages have its row.
+    checkpoint (ExtractionCheckpoint or None): Where finished tasks and failures are kept.
+    image_timeout (float or None): Seconds allowed per image; a task gets this times its size.
+        Workers are started with 'spawn', so the calling script needs an `if __name__ == "__main__":` guard.
+    max_failures (int): Failures after which an image is quarantined.
+    sink_dir (str or None): Spill each stage's rows to disk here while running (flat memory).
+
+    Returns:
+    dict: {stage name: pd.DataFrame}
+    """
+    producers, depth = _check_graph(stages, folders)
+    for name in producers:
+        os.makedirs(folders[name], exist_ok=True)
+    if max_workers is None:
+        max_workers = min(len(stages), os.cpu_count() or 1)
+    if cprofile_enabled():
+        # cProfile profiles one thread at a time; keep the per-stage profiles meaningful
+        max_workers = 1
+
+    file_names = sorted(file_names)
+    quarantined = set()
+    signatures = {}
+    if checkpoint is not None:
+        quarantined = checkpoint.quarantined(max_failures) & set(file_names)
+        if quarantined:
+            logger.warning("Skipping %d quarantined images (failed %d+ times): %s", len(quarantined), max_failures,
+                           ", ".join(sorted(quarantined)[:10]) + (" ..." if len(quarantined) > 10 else ""))
+            file_names = [f for f in file_names if f not in quarantined]
+        signatures = {f: file_signature(folders['raw'], f) for f in file_names}
+
+    chunks = [file_names[i:i + chunk_size] for i in range(0, len(file_names), chunk_size)]
+    # Earlier chunks first; within a chunk, producers before their consumers
+    todo = sorted(((c, depth[stage.name], i) for c in range(len(chunks)) for i, stage in enumerate(stages)))
+    done = set()
+    remaining = defaultdict(int)
+    for c, _, _ in todo:
+        remaining[c] += 1
+    joiner = StreamingJoiner([stage.name for stage in stages], on_image=on_image, sink_dir=sink_dir)
+
+    # Rows from an earlier run go in front of all chunks (index -1)
+    finished = {stage.name: set() for stage in stages}
+    if checkpoint is not None:
+        for stage in stages:
+            rows, stage_finished = checkpoint.load_rows(stage.name, signatures)
+            if stage.produces:
+                # Producer rows only count while the images they wrote are still there
+                stage_finished = {f for f in stage_finished
+                                  if os.path.exists(os.path.join(folders[stage.produces], f))}
+                rows = rows[rows['filename'].isin(stage_finished)]
+            finished[stage.name] = stage_finished
+            joiner.add(stage.name, -1, rows)
+    resumed = sum(len(f) for f in finished.values())
+    if resumed:
+        logger.info("Resuming from checkpoint: %d (stage, image) results already done", resumed)
+
+    failed_images = []
+    worker_local = threading.local()
+    workers = []
+
+    def call(stage, files):
+        if image_timeout is None:
+            return stage.func(folders, files)
+        worker = getattr(worker_local, 'worker', None)
+        if worker is None:
+            worker = worker_local.worker = IsolatedWorker()
+            workers.append(worker)
+        return worker.run(stage.func, folders, files, image_timeout * len(files))
+
+    def execute(stage, chunk_index):
+        files = [f for f in chunks[chunk_index] if f not in finished[stage.name]]
+        if not files:
+            return None
+        try:
+            df = call(stage, files)
+        except Exception as e:
+            parts, succeeded, failures = [], [], []
+            if len(files) == 1:
+                failures.append((files[0], e))
+            else:
+                logger.warning("Stage %s failed on chunk %d (%d images): %s. Retrying the images one by one.",
+                               stage.name, chunk_index, len(files), e)
+                for filename in files:
+                    try:
+                        parts.append(call(stage, [filename]))
+                        succeeded.append(filename)
+                    except Exception as image_error:
+                        failures.append((filename, image_error))
+            for filename, error in failures:
+                logger.error("Stage %s failed on %s: %s", stage.name, filename, error)
+                failed_images.append((stage.name, filename))
+                if checkpoint is not None:
+                    checkpoint.record_failure(filename, stage.name, error)
+            df, files = _concat_rows(parts), succeeded
+        if checkpoint is not None:
+            checkpoint.save_rows(stage.name, files, df, signatures)
+        return df
+
+    def ready(chunk_index, stage):
+        return all((producers[name], chunk_index) in done for name in stage.inputs if name in producers)
+
+    logger.info("Running %d stages over %d images in %d chunks with %d workers", len(stages), len(file_names),
+                len(chunks), max_workers)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="dag") as pool:
+            running = {}
+            while todo or running:
+                oldest = min((c for c, n in remaining.items() if n), default=0)
+                for task in list(todo):
+                    if len(running) >= max_workers:
+                        break
+                    c, _, i = task
+                    stage = stages[i]
+                    if c < oldest + max_chunks_ahead and ready(c, stage):
+                        todo.remove(task)
+                        running[pool.submit(execute, stage, c)] = (stage, c)
+                if not running:
+                    raise RuntimeError("Stage graph is stuck: no task is ready")
+
+                finished_tasks, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished_tasks:
+                    stage, c = running.pop(future)
+                    try:
+                        df = future.result()
+                    except Exception as e:
+                        # Only bookkeeping (e.g. writing the checkpoint) gets here
+                        logger.error("Stage %s failed on chunk %d: %s", stage.name, c, e)
+                        df = None
+                    joiner.add(stage.name, c, df)
+                    done.add((stage.name, c))
+                    remaining[c] -= 1
+    finally:
+        for worker in workers:
+            worker.close()
+
+    log_run_summary(logger, "DAG", stages=len(stages), images=len(file_names), chunks=len(chunks),
+                    joined=joiner.joined, resumed=resumed, failed_images=len(failed_images),
+                    quarantined=len(quarantined))
+    return joiner.frames(stages)
@@ -0,0 +1,267 @@
+import os
+import sys
+import json
+import copy
+import argparse
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+
+from util.logging_util import get_logger, configure_logging, log_run_summary
+from util.importance import column_families, family_costs
+from util.pipeline import (PIPELINE_CACHE_DIR, MODELS, NON_FEATURE_COLUMNS, load_pipeline_config, apply_overrides,
+                           run_pipeline, cached_stage, stage_key, measure_untimed_stages, prepare_model_data,
+                           resolve_cv_folds, run_cross_validation, cv_matrix, _read_pickle, _write_pickle)
+
+logger = get_logger("family_selection")
+
+DIRECTIONS = ('forward', 'backward')
+
+# Accuracy points a family must add per 100 ms of extraction per image to be worth it
+COST_WEIGHT = 1.0
+
+
+def selection_score(accuracy, ms_per_image, cost_weight=COST_WEIGHT):
+    """Accuracy in percentage points minus `cost_weight` points per 100 ms of extraction per image."""
+    return accuracy * 100 - cost_weight * ms_per_image / 100
+
+
+def subset_frame(data_df, family_of, families):
+    """Merged dataset restricted to the labels/metadata columns and the columns of `families`."""
+    families = set(families)
+    return data_df[[col for col in data_df.columns
+                    if col in NON_FEATURE_COLUMNS or family_of.get(col) in families]]
+
+
+def evaluate_families(data_df, labels_csv, cv_config, model_config):
+    """
+    Mean and std of the outer-fold test accuracy on `data_df`, with the same folds,
+    imputation and model as the pipeline's cv stage.
+
+    Returns:
+    dict or None: 'accuracy', 'accuracy_std', 'folds' (None if nothing could be trained).
+    """
+    model_data = prepare_model_data(data_df)
+    if model_data is None:
+        return None
+    x_all, y_all, filenames, _, _ = model_data
+    cv_folds = resolve_cv_folds(y_all, filenames, labels_csv, n_splits=cv_config['n_splits'], seed=cv_config['seed'],
+                                inner_val_size=cv_config['inner_val_size'], grouping=cv_config.get('grouping'))
+    if cv_folds is None:
+        return None
+    # Same matrix as the cv stage, so a 'prebin' model is scored on its bin codes
+    x_cv, _ = cv_matrix(x_all, model_config)
+    fold_results_list, _ = run_cross_validation(x_cv, y_all, filenames, cv_folds,
+                                                model_class=MODELS[model_config['type']],
+                                                model_params=model_config.get('params', {}),
+                                                model_name=model_config['name'])
+    if not fold_results_list:
+        return None
+    accuracies = [fold['test_accuracy_fold'] for fold in fold_results_list]
+    return {'accuracy': float(np.mean(accuracies)), 'accuracy_std': float(np.std(accuracies, ddof=1)) if len(accuracies) > 1 else 0.0,
+            'folds': len(accuracies)}
+
+
+def _cached_evaluation(cache_dir, key, data_df, labels_csv, cv_config, model_config):
+    """evaluate_families as a cached 'selection' stage; runs in a joblib worker."""
+    status = {}
+
+    def build(stage_dir):
+        _write_pickle(evaluate_families(data_df, labels_csv, cv_config, model_config),
+                      os.path.join(stage_dir, "evaluation.pkl"))
+
+    return cached_stage(cache_dir, 'selection', key, build,
+                        lambda d: _read_pickle(os.path.join(d, "evaluation.pkl")), status)
+
+
+def selected_config(config, families):
+    """Copy of `config` that only extracts the selected families (hair removal is kept if it was on)."""
+    selected = copy.deepcopy(config)
+    selected['name'] = f"{config.get('name', 'pipeline')}_selected"
+    selected['extractors'] = {name: params for name, params in config['extractors'].items() if name in families}
+    if selected.get('hair_removal'):
+        selected['hair_removal']['hair_ratio_feature'] = 'Hair_Ratio' in families
+    return selected
+
+
+def run_family_selection(config, images_dir, labels_csv, output_dir, cache_dir=PIPELINE_CACHE_DIR,
+                         direction='forward', cost_weight=COST_WEIGHT, n_jobs=-1):
+    """
+    Greedy forward or backward selection over whole feature families (the extractors of
+    `config` plus Hair_Ratio), scored on CV accuracy against extraction time per image.
+
+    Every family is extracted once through the pipeline (cached stages, so usually no
+    extraction at all); candidates are then evaluated on column subsets of the cached merged
+    dataset with the pipeline's folds and model, in parallel, and each evaluation is cached
+    under its family set, so later runs (other directions or cost weights) reuse them.
+
+    Score = accuracy points - cost_weight per 100 ms of extraction per image. Forward
+    starts from the best single family and adds the family that raises the score most;
+    backward starts from all families and drops the one whose removal raises it most. Both
+    stop when no step improves the score. Hair removal, when configured, is a shared cost
+    of every non-empty selection (the extractors run on its output), so Hair_Ratio itself
+    is free.
+
+    The selected config is written to <output_dir>/<name>_selected.json; running the
+    pipeline with it only extracts the selected families.
+
+    Parameters:
+    config (dict): Pipeline config (see configs/); all its extractors are candidates.
+    images_dir (str): Folder with the original images.
+    labels_csv (str): Metadata CSV (dataset.csv).
+    output_dir (str): Where the selection trace and the selected config are written.
+    cache_dir (str): Root of the stage cache.
+    direction (str): 'forward' or 'backward'.
+    cost_weight (float): Accuracy points per 100 ms/image of extraction.
+    n_jobs (int): Parallel candidate evaluations (joblib; -1 = all cores).
+
+    Returns:
+    dict: 'families' (selected, in selection order), 'trace' (pd.DataFrame of every
+          candidate), 'config' (selected config) and 'config_path'.
+    """
+    if direction not in DIRECTIONS:
+        raise ValueError(f"direction must be one of {DIRECTIONS}, got {direction!r}")
+    if not labels_csv:
+        raise ValueError("Family selection needs labels (labels_csv).")
+    name = config.get('name', 'pipeline')
+
+    pipeline_result = run_pipeline(config, images_dir, labels_csv, output_dir, cache_dir=cache_dir)
+    keys = pipeline_result['keys']
+    if 'matrix' not in keys:
+        raise RuntimeError("The pipeline produced no labelled rows; nothing to select on.")
+    # Cache entries without a (warm) build time are measured once, so the costs below are per-image work
+    keys = measure_untimed_stages(config, images_dir, labels_csv, output_dir, cache_dir, pipeline_result)['keys']
+
+    data_df = _read_pickle(os.path.join(cache_dir, 'merge', keys['merge'], "merged.pkl"))
+    family_of = column_families(cache_dir, keys)
+    # Only families with columns in the merged data (e.g. not Hair_Ratio when hair_ratio_feature is off)
+    candidates = list(dict.fromkeys(family_of[col] for col in data_df.columns if col in family_of))
+    n_images = len(data_df)
+    costs = family_costs(cache_dir, keys, n_images)
+    shared_ms = 0.0
+    if 'Hair_Ratio' in costs:
+        shared_ms = costs['Hair_Ratio']['ms_per_image']
+        costs['Hair_Ratio'] = {'extraction_s': 0.0, 'ms_per_image': 0.0}
+    logger.info("Candidate families: %s (ms/image: %s%s)", ", ".join(candidates),
+                ", ".join(f"{f}={costs[f]['ms_per_image']:.1f}" for f in candidates),
+                f"; shared hair removal {shared_ms:.1f}" if shared_ms else "")
+
+    cv_config, model_config = config['cv'], config['model']
+    evaluations = {}
+
+    def evaluate(family_sets):
+        """Evaluate (in parallel) the family sets that were not evaluated yet in this run."""
+        todo = [fs for fs in dict.fromkeys(family_sets) if fs not in evaluations]
+        results = Parallel(n_jobs=n_jobs)(
+            delayed(_cached_evaluation)(cache_dir, stage_key('selection', keys['merge'], sorted(fs), cv_config,
+                                                             model_config),
+                                        subset_frame(data_df, family_of, fs), labels_csv, cv_config, model_config)
+            for fs in todo)
+        for fs, result in zip(todo, results):
+            ms_per_image = shared_ms + sum(costs[f]['ms_per_image'] for f in fs)
+            if result is None:
+                evaluations[fs] = None
+                continue
+            evaluations[fs] = dict(result, ms_per_image=ms_per_image,
+                                   score=selection_score(result['accuracy'], ms_per_image, cost_weight))
+
+    trace = []
+
+    def record(step, action, family, family_set, chosen):
+        evaluation = evaluations.get(family_set) or {}
+        trace.append({'step': step, 'action': action, 'family': family, 'families': "+".join(sorted(family_set)),
+                      'accuracy': evaluation.get('accuracy', np.nan),
+                      'accuracy_std': evaluation.get('accuracy_std', np.nan),
+                      'ms_per_image': evaluation.get('ms_per_image', np.nan),
+                      'score': evaluation.get('score', np.nan), 'chosen': chosen})
+
+    def best(options):
+        scored = [(evaluations[fs]['score'], family, fs) for family, fs in options if evaluations.get(fs)]
+        return max(scored, key=lambda item: item[0]) if scored else None
+
+    if direction == 'forward':
+        current, current_score, order = frozenset(), -np.inf, []
+        step = 0
+        while len(current) < len(candidates):
+            step += 1
+            options = [(family, current | {family}) for family in candidates if family not in current]
+            evaluate([fs for _, fs in options])
+            winner = best(options)
+            improved = winner is not None and winner[0] > current_score
+            for family, fs in options:
+                record(step, 'add', family, fs, improved and family == winner[1])
+            if not improved:
+                break
+            current_score, current = winner[0], winner[2]
+            order.append(winner[1])
+            logger.info("Step %d: add %s (score %.2f)", step, winner[1], current_score)
+    else:
+        current = frozenset(candidates)
+        evaluate([current])
+        if not evaluations.get(current):
+            raise RuntimeError("Could not evaluate the full family set.")
+        current_score = evaluations[current]['score']
+        record(0, 'start', None, current, True)
+        step = 0
+        while len(current) > 1:
+            step += 1
+            options = [(family, current - {family}) for family in candidates if family in current]
+            evaluate([fs for _, fs in options])
+            winner = best(options)
+            improved = winner is not None and winner[0] > current_score
+            for family, fs in options:
+                record(step, 'drop', family, fs, improved and family == winner[1])
+            if not improved:
+                break
+            current_score, current = winner[0], winner[2]
+            logger.info("Step %d: drop %s (score %.2f)", step, winner[1], current_score)
+        order = [family for family in candidates if family in current]
+
+    trace_df = pd.DataFrame(trace)
+    selected = selected_config(config, set(current))
+    os.makedirs(output_dir, exist_ok=True)
+    trace_path = os.path.join(output_dir, f"{name}_family_selection.csv")
+    config_path = os.path.join(output_dir, f"{name}_selected.json")
+    trace_df.to_csv(trace_path, index=False)
+    with open(config_path, 'w') as f:
+        json.dump(selected, f, indent=2)
+
+    final = evaluations.get(current) or {}
+    logger.info("Selected families (%s): %s; accuracy %.4f at %.1f ms/image (all families: %s)",
+                direction, ", ".join(order), final.get('accuracy', np.nan), final.get('ms_per_image', np.nan),
+                ", ".join(candidates))
+    logger.info("Selection trace saved to %s; selected config saved to %s (run it with python -m util.pipeline %s ...)",
+                trace_path, config_path, config_path)
+    log_run_summary(logger, "Family selection", direction=direction, candidates=len(candidates),
+                    evaluated=len(evaluations), selected=len(current),
+                    accuracy=round(final.get('accuracy', np.nan), 4),
+                    ms_per_image=round(final.get('ms_per_image', np.nan), 1))
+    return {'families': order, 'trace': trace_df, 'config': selected, 'config_path': config_path}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Greedy cost-aware selection of feature families (run from the "
+                                                 "repository root: python -m util.family_selection extended ...).")
+    parser.add_argument("config", help="Config JSON, or the name of one in configs/ (baseline, extended).")
+    parser.add_argument("--images", required=True, help="Folder with the original images.")
+    parser.add_argument("--labels", required=True, help="Metadata CSV, e.g. dataset.csv.")
+    parser.add_argument("--output-dir", required=True)
+    parser.add_argument("--cache-dir", default=PIPELINE_CACHE_DIR)
+    parser.add_argument("--set", dest="overrides", action="append", default=[], metavar="KEY=VALUE",
+                        help="Override a config value (see python -m util.pipeline --help).")
+    parser.add_argument("--direction", choices=DIRECTIONS, default='forward')
+    parser.add_argument("--cost-weight", type=float, default=COST_WEIGHT,
+                        help="Accuracy points a family must add per 100 ms of extraction per image.")
+    parser.add_argument("--jobs", type=int, default=-1, help="Parallel candidate evaluations.")
+    args = parser.parse_args(argv)
+
+    configure_logging()
+    config = apply_overrides(load_pipeline_config(args.config), args.overrides)
+    run_family_selection(config, args.images, args.labels, args.output_dir, cache_dir=args.cache_dir,
+                         direction=args.direction, cost_weight=args.cost_weight, n_jobs=args.jobs)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,15 +3,24 @@ import numpy as np
 import matplotlib.pyplot as plt
 import os
 import pandas as pd
-from skimage import segmentation, color, io, filters, measure, transform, morphology
+from functools import lru_cache
+from skimage import color, io, filters, measure, transform, morphology
 from sklearn.cluster import KMeans
 from sklearn.decomposition import PCA
 from scipy.ndimage import distance_transform_edt
 from tqdm import tqdm 
 
+from util.profiling import stage_timer, timed_stage
+from util.logging_util import get_logger, configure_logging, ErrorSummary, log_run_summary
+from util.checkpoint import PartialResultsWriter
+from util.feature_sink import extractor_sink
+
+logger = get_logger("feature_A")
+
 folder_path= "your path"
  
-def extract_asymmetry_features(folder_path, output_csv=None, visualize=False):
+@timed_stage("A.folder")
+def extract_asymmetry_features(folder_path, output_csv=None, visualize=False, file_list=None):
     """
     Function to extract asymmetry features from skin lesion images in a folder
    
@@ -19,13 +28,14 @@ def extract_asymmetry_features(folder_path, output_csv=None, visualize=False):
     folder_path (str): Path to the folder containing skin lesion images
     output_csv (str): Path to output CSV file. If the file exists, features will be added to it
     visualize (bool): Whether to visualize the asymmetry calculations
+    file_list (list or None): Only process these file names (e.g. one shard), default all
    
     Returns:
     pd.DataFrame: DataFrame containing asymmetry features for all images
     """
     
-    results = []
-   
+    results = extractor_sink()
+    errors = ErrorSummary(logger, "A")
     
     valid_extensions = ['.jpg', '.jpeg', '.png', '.bmp']
    
@@ -34,14 +44,19 @@ def extract_asymmetry_features(folder_path, output_csv=None, visualize=False):
     if output_csv and os.path.exists(output_csv):
         try:
             existing_df = pd.read_csv(output_csv)
-            print(f"Loaded existing features from {output_csv}")
+            logger.info("Loaded existing features from %s", output_csv)
         except Exception as e:
-            print(f"Error loading existing CSV: {str(e)}")
+            logger.warning("Error loading existing CSV %s: %s", output_csv, e)
+    # Rows are saved every CHECKPOINT_EVERY images, so a crashed run resumes from there
+    writer = PartialResultsWriter(output_csv, existing_df)
    
     # Iterate through all files in the folder with a progress bar
     image_files = [f for f in os.listdir(folder_path) if os.path.splitext(f)[1].lower() in valid_extensions]
+    if file_list is not None:
+        wanted = set(file_list)
+        image_files = [f for f in image_files if f in wanted]
     for filename in tqdm(image_files, desc="Extracting Asymmetry Features"):
-        
+        writer.maybe_flush(results)
         if existing_df is not None and filename in existing_df['filename'].values:
            
             continue
@@ -50,74 +65,74 @@ def extract_asymmetry_features(folder_path, output_csv=None, visualize=False):
        
         try:
             # Read the image
-            img = cv2.imread(image_path)
-            if img is None:
-                print(f"Error reading {filename}, skipping...")
-                continue
+            with stage_timer("A.decode"):
+                img = cv2.imread(image_path)
+                if img is None:
+                    errors.record(filename, "unreadable image")
+                    continue
                
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+                img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
            
-            # Resize for consistency
-            img = cv2.resize(img, (256, 256))
-           
-            # Get binary mask using existing segmentation approach
-            lab = cv2.cvtColor(img, cv2.COLOR_RGB2LAB)
-            segments = segmentation.slic(img, n_segments=100, compactness=10, sigma=1)
-            h, w = img.shape[:2]
-            center_y, center_x = h // 2, w // 2
-            y, x = np.ogrid[:h, :w]
-            dist_from_center = np.sqrt((x - center_x)**2 + (y - center_x)**2)
-            mask = dist_from_center <= min(h, w) // 3
-            pixels = img.reshape(-1, 3)
-            kmeans = KMeans(n_clusters=2, random_state=0, n_init='auto').fit(pixels) 
-            labels = kmeans.labels_.reshape(h, w)
-            center_label = labels[center_y, center_x]
-            refined_mask = (labels == center_label)
-            final_mask = np.logical_and(mask, refined_mask)
-           
-            # Convert to binary for asymmetry calculations
-            binary_mask = final_mask.astype(np.uint8)
+                # Resize for consistency
+                img = cv2.resize(img, (256, 256))
            
             # Calculate all asymmetry features
             features = {'filename': filename}
-           
-            # 1. Basic mirror asymmetry
-            basic_score = compute_basic_asymmetry(binary_mask)
-            features['a_basic'] = basic_score
-           
-            # 2. PCA-aligned rotational asymmetry
-            pca_score = compute_pca_asymmetry(binary_mask)
-            features['a_pca'] = pca_score
-           
-            # 3. Boundary-weighted asymmetry
-            boundary_score = compute_boundary_asymmetry(binary_mask)
-            features['a_boundary'] = boundary_score
-           
-            # 4. Combined weighted score
-            combined_score = 0.4*basic_score + 0.3*pca_score + 0.3*boundary_score
-            features['a_combined'] = min(combined_score, 1.0)
-           
+            features.update(asymmetry_features_from_image(img))
             results.append(features)
            
         except Exception as e:
-            print(f"Error processing {filename}: {str(e)}")
+            errors.record(filename, e)
    
 
-    new_df = pd.DataFrame(results)
+    combined_df = writer.finish(results)
+    if output_csv and not combined_df.empty:
+        logger.info("Features saved to %s", output_csv)
 
-    if existing_df is not None and not new_df.empty:
-        combined_df = pd.concat([existing_df, new_df], ignore_index=True)
-    elif not new_df.empty:
-        combined_df = new_df
-    else:
-        combined_df = existing_df if existing_df is not None else pd.DataFrame()
-   
+    errors.log_summary()
+    log_run_summary(logger, "A", images=len(image_files), extracted=len(results), errors=errors.count)
+    return combined_df
+ 
+def asymmetry_features_from_image(img):
+    """
+    Asymmetry features of one RGB image at whatever size it is given
+    (256x256 in extract_asymmetry_features, any pyramid level in util.pyramid).
 
-    if output_csv and not combined_df.empty:
-        combined_df.to_csv(output_csv, index=False)
-        print(f"Features saved to {output_csv}")
+    Parameters:
+    img (np.ndarray): RGB image
+
+    Returns:
+    dict: a_basic, a_pca, a_boundary and a_combined
+    """
+    # Get binary mask using existing segmentation approach
+    h, w = img.shape[:2]
+    center_y, center_x = h // 2, w // 2
+    y, x = np.ogrid[:h, :w]
+    dist_from_center = np.sqrt((x - center_x)**2 + (y - center_x)**2)
+    mask = dist_from_center <= min(h, w) // 3
+    pixels = img.reshape(-1, 3)
+    with stage_timer("A.kmeans"):
+        kmeans = KMeans(n_clusters=2, random_state=0, n_init='auto').fit(pixels) 
+    labels = kmeans.labels_.reshape(h, w)
+    center_label = labels[center_y, center_x]
+    refined_mask = (labels == center_label)
+    final_mask = np.logical_and(mask, refined_mask)
    
-    return combined_df
+    # Convert to binary for asymmetry calculations
+    binary_mask = final_mask.astype(np.uint8)
+   
+    # 1.-3. Basic mirror, PCA-aligned rotational and boundary-weighted asymmetry
+    with stage_timer("A.asymmetry"):
+        basic_score, pca_score, boundary_score = compute_asymmetry_features(binary_mask)
+   
+    # 4. Combined weighted score
+    combined_score = 0.4*basic_score + 0.3*pca_score + 0.3*boundary_score
+    return {
+        'a_basic': basic_score,
+        'a_pca': pca_score,
+        'a_boundary': boundary_score,
+        'a_combined': min(combined_score, 1.0),
+    }
  
 def compute_basic_asymmetry(mask):
     """Compute basic vertical/horizontal mirror asymmetry"""
@@ -166,11 +181,126 @@ def compute_boundary_asymmetry(mask):
     weights = distance_transform_edt(~boundary)
     vert_flip = np.fliplr(mask)
     vert_diff = np.sum(weights * np.abs(mask.astype(int) - vert_flip.astype(int)))
-    return vert_diff / max(np.sum(weights), 1) 
- 
+    return vert_diff / max(np.sum(weights), 1)
+
+def compute_asymmetry_features(mask):
+    """
+    Fused basic, PCA and boundary asymmetry of a binary lesion mask.
+
+    Gives the same scores as compute_basic_asymmetry, compute_pca_asymmetry and
+    compute_boundary_asymmetry, but labels the mask once (cv2.connectedComponentsWithStats)
+    and works on the lesion bounding box with uint8/bool arrays:
+    - basic: mirror differences of the largest component's bounding box
+    - PCA: the principal axis comes from the 2x2 covariance of the crop's pixel
+      coordinates, and only the part of the rotated frame that can contain lesion
+      pixels is sampled (same nearest-neighbour mapping as transform.rotate(order=0))
+    - boundary: see boundary_weights(); only the rows of the bounding box can differ
+      from their mirror image
+
+    Parameters:
+    mask (np.ndarray): uint8/bool lesion mask
+
+    Returns:
+    tuple: (basic_score, pca_score, boundary_score)
+    """
+    mask = np.ascontiguousarray(mask, dtype=np.uint8)
+    h, w = mask.shape
+    n_labels, _, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    if n_labels < 2:
+        # Empty mask: same values the separate functions return
+        return 1.0, 1.0, 0.0
+
+    # Bounding box of all lesion pixels (every component is used by the PCA/boundary scores)
+    fg = stats[1:]
+    minr, minc = fg[:, cv2.CC_STAT_TOP].min(), fg[:, cv2.CC_STAT_LEFT].min()
+    maxr = (fg[:, cv2.CC_STAT_TOP] + fg[:, cv2.CC_STAT_HEIGHT]).max()
+    maxc = (fg[:, cv2.CC_STAT_LEFT] + fg[:, cv2.CC_STAT_WIDTH]).max()
+    crop = mask[minr:maxr, minc:maxc].astype(bool)
+    total_pixels = int(fg[:, cv2.CC_STAT_AREA].sum())
+
+    # 1. Basic mirror asymmetry on the largest component's bounding box
+    largest = fg[np.argmax(fg[:, cv2.CC_STAT_AREA])]
+    top, left = largest[cv2.CC_STAT_TOP], largest[cv2.CC_STAT_LEFT]
+    lesion_box = mask[top:top + largest[cv2.CC_STAT_HEIGHT], left:left + largest[cv2.CC_STAT_WIDTH]].astype(bool)
+    basic_score = (np.count_nonzero(lesion_box != lesion_box[:, ::-1]) +
+                   np.count_nonzero(lesion_box != lesion_box[::-1, :])) / (2 * largest[cv2.CC_STAT_AREA])
+
+    # 2. PCA-aligned rotational asymmetry
+    pca_score = 1.0
+    if total_pixels >= 2:
+        pca_score = _pca_asymmetry_on_crop(crop, minr, minc, (h, w), total_pixels)
+
+    # 3. Boundary-weighted asymmetry (only the rows of the bounding box contribute)
+    weights = boundary_weights((h, w))
+    rows = mask[minr:maxr].astype(bool)
+    boundary_score = np.sum(weights[minr:maxr][rows != rows[:, ::-1]]) / max(weights.sum(), 1)
+
+    return basic_score, pca_score, boundary_score
+
+def _pca_asymmetry_on_crop(crop, minr, minc, shape, total_pixels):
+    """PCA asymmetry of a mask of `shape` whose nonzero pixels are all inside `crop` at (minr, minc)."""
+    y, x = np.nonzero(crop)
+    x = x.astype(np.float64) + minc
+    y = y.astype(np.float64) + minr
+    x -= x.mean()
+    y -= y.mean()
+    # Principal axis = eigenvector of the largest eigenvalue, sign chosen like sklearn's PCA
+    # (largest absolute entry positive)
+    _, vecs = np.linalg.eigh(np.array([[x @ x, x @ y], [x @ y, y @ y]]))
+    component = vecs[:, 1]
+    component = component * np.sign(component[np.argmax(np.abs(component))])
+    angle = np.arctan2(component[1], component[0]) * 180 / np.pi
+
+    # Same transform and output shape as transform.rotate(mask, angle, resize=True)
+    rows, cols = shape
+    center = np.array((cols, rows)) / 2.0 - 0.5
+    tform = (transform.SimilarityTransform(translation=-center)
+             + transform.SimilarityTransform(rotation=np.deg2rad(angle))
+             + transform.SimilarityTransform(translation=center))
+    corners = tform.inverse(np.array([[0, 0], [0, rows - 1], [cols - 1, rows - 1], [cols - 1, 0]]))
+    out_rows, out_cols = np.around((corners[:, 1].max() - corners[:, 1].min() + 1,
+                                    corners[:, 0].max() - corners[:, 0].min() + 1)).astype(int)
+    tform = transform.SimilarityTransform(translation=(corners[:, 0].min(), corners[:, 1].min())) + tform
+    tform.params[2] = (0, 0, 1)
+
+    # Output pixels that can map into the crop (+1 pixel margin for the rounding)
+    ch, cw = crop.shape
+    crop_corners = np.array([[minc - 1, minr - 1], [minc - 1, minr + ch], [minc + cw, minr + ch], [minc + cw, minr - 1]])
+    out_corners = tform.inverse(crop_corners)
+    r0 = max(int(np.floor(out_corners[:, 1].min())) - 1, 0)
+    r1 = min(int(np.ceil(out_corners[:, 1].max())) + 2, out_rows)
+    c0 = max(int(np.floor(out_corners[:, 0].min())) - 1, 0)
+    c1 = min(int(np.ceil(out_corners[:, 0].max())) + 2, out_cols)
+
+    # Nearest-neighbour sampling as in ndi.map_coordinates(order=0): index = floor(coord + 0.5)
+    out_c, out_r = np.meshgrid(np.arange(c0, c1, dtype=np.float64), np.arange(r0, r1, dtype=np.float64))
+    src = tform(np.column_stack([out_c.ravel(), out_r.ravel()]))
+    src_c = np.floor(src[:, 0] + 0.5).astype(np.intp) - minc
+    src_r = np.floor(src[:, 1] + 0.5).astype(np.intp) - minr
+    inside = (src_r >= 0) & (src_r < ch) & (src_c >= 0) & (src_c < cw)
+    sampled = np.zeros(src_r.shape, dtype=bool)
+    sampled[inside] = crop[src_r[inside], src_c[inside]]
+
+    strip = np.zeros((r1 - r0, out_cols), dtype=bool)
+    strip[:, c0:c1] = sampled.reshape(r1 - r0, c1 - c0)
+    return np.count_nonzero(strip != strip[:, ::-1]) / (2 * total_pixels)
+
+@lru_cache(maxsize=4)
+def boundary_weights(shape):
+    """
+    Pixel weights used by the boundary asymmetry for a mask of `shape`.
+
+    compute_boundary_asymmetry takes distance_transform_edt(~boundary) of a uint8 mask;
+    `~` turns every pixel nonzero, so the weights do not depend on the mask at all and
+    are the same distance ramp for every image of this shape. It is computed once here.
+    """
+    weights = distance_transform_edt(np.ones(shape, dtype=np.uint8))
+    weights.setflags(write=False)
+    return weights
 
 
 if __name__ == "__main__":
+    configure_logging()
     folder_path = "your path" 
 
     output_csv_path = os.path.join(folder_path, "asymmetry_features.csv") 
@@ -2,25 +2,54 @@ import os
 import cv2
 import numpy as np
 import pandas as pd
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 from tqdm import tqdm  
 
+from util.profiling import stage_timer, timed_stage
+from util.feature_sink import extractor_sink
+from util.logging_util import get_logger, configure_logging, ErrorSummary, log_run_summary
+
+logger = get_logger("feature_B")
+
+IMAGE_SIZE = 256
+EMPTY_BORDER_FEATURES = {
+    "contour_count": 0,
+    "avg_contour_area": 0.0,
+    "contour_area_std": 0.0,
+    "avg_contour_perimeter": 0.0,
+    "contour_perimeter_std": 0.0,
+    "sobel_mean": 0.0,
+    "sobel_std": 0.0,
+    "laplacian_mean": 0.0,
+    "laplacian_std": 0.0
+}
+
+@timed_stage("B.folder")
 def extract_border_features_from_folder(
     folder_path: str,
     output_csv: Optional[str] = None,
     visualize: bool = False,
     block_size: int = 11,
-    morph_kernel_size: int = 3
+    morph_kernel_size: int = 3,
+    batch_size: int = 16,
+    file_list: Optional[List[str]] = None
 ) -> pd.DataFrame:
     """
     Extract border features from all images in a folder and return as DataFrame.
     
+    Images are decoded one by one but filtered in batches of `batch_size`
+    (see compute_border_features_batch).
+    
     Args:
         folder_path: Path to folder containing images
         output_csv: Optional path to save results as CSV
         visualize: Whether to display intermediate results
-        block_size: Adaptive thresholding block size (must be odd)
-        morph_kernel_size: Size of morphological operation kernel
+        block_size: Unused, kept for backwards compatibility (the adaptive threshold
+            it configured never contributed to the features)
+        morph_kernel_size: Unused, kept for backwards compatibility
+        batch_size: Number of images filtered together (the default keeps one tile's
+            float32 filter outputs inside a typical 2 MB L2 cache; much larger tiles are slower)
+        file_list: Only process these file names (e.g. one shard); default all
         
     Returns:
         DataFrame containing border features for all images
@@ -29,27 +58,48 @@ def extract_border_features_from_folder(
     valid_extensions = ('.jpg', '.jpeg', '.png', '.bmp')
     image_files = [f for f in os.listdir(folder_path) 
                   if f.lower().endswith(valid_extensions)]
+    if file_list is not None:
+        wanted = set(file_list)
+        image_files = [f for f in image_files if f in wanted]
     
-    features_list = []
+    features_list = extractor_sink()
+    errors = ErrorSummary(logger, "B")
     
-    for filename in tqdm(image_files, desc="Processing images"):
-        try:
-            image_path = os.path.join(folder_path, filename)
-            features = extract_border_features(
-                image_path=image_path,
-                visualize=visualize,
-                block_size=block_size,
-                morph_kernel_size=morph_kernel_size
-            )
-            features['filename'] = filename
-            features_list.append(features)
-            
-        except Exception as e:
-            print(f"\nError processing {filename}: {str(e)}")
-            continue
+    with tqdm(total=len(image_files), desc="Processing images") as progress:
+        for start in range(0, len(image_files), batch_size):
+            batch_files = image_files[start:start + batch_size]
+            images, loaded_files = [], []
+            for filename in batch_files:
+                try:
+                    images.append(load_border_image(os.path.join(folder_path, filename)))
+                    loaded_files.append(filename)
+                except Exception as e:
+                    errors.record(filename, e)
+                    # Same as before: unreadable images get zero features
+                    features_list.append({**EMPTY_BORDER_FEATURES, 'filename': filename})
+
+            if images:
+                try:
+                    batch_features = compute_border_features_batch(np.stack(images), visualize=visualize)
+                    for filename, features in zip(loaded_files, batch_features):
+                        features['filename'] = filename
+                        features_list.append(features)
+                except Exception:
+                    # One bad image must not cost the whole batch: redo it image by image, and
+                    # give the ones that still fail zero features like unreadable images
+                    for filename, image in zip(loaded_files, images):
+                        try:
+                            features = compute_border_features_batch(image[np.newaxis], visualize=visualize)[0]
+                        except Exception as e:
+                            errors.record(filename, e)
+                            features = dict(EMPTY_BORDER_FEATURES)
+                        features['filename'] = filename
+                        features_list.append(features)
+            progress.update(len(batch_files))
     
 
-    df = pd.DataFrame(features_list)
+    df = features_list.to_frame()
+    features_list.close()
     
 
     cols = ['filename'] + [col for col in df.columns if col != 'filename']
@@ -57,105 +107,181 @@ def extract_border_features_from_folder(
     
     if output_csv:
         df.to_csv(output_csv, index=False)
-        print(f"\nSaved features to {output_csv}")
-    
+        logger.info("Saved features to %s", output_csv)
+
+    errors.log_summary()
+    log_run_summary(logger, "B", images=len(image_files), extracted=len(features_list), errors=errors.count)
     return df
 
-def extract_border_features(
-    image_path: str,
-    visualize: bool = False,
-    block_size: int = 11,
-    morph_kernel_size: int = 3
-) -> Dict[str, float]:
-    """
-    Enhanced border feature extraction focused on essential border characteristics.
-    """
-    try:
-        
+def load_border_image(image_path: str) -> np.ndarray:
+    """Read an image as grayscale and resize it to IMAGE_SIZE x IMAGE_SIZE."""
+    with stage_timer("B.decode"):
         img = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
         if img is None:
             raise FileNotFoundError(f"Image not found or corrupted: {image_path}")
+        return cv2.resize(img, (IMAGE_SIZE, IMAGE_SIZE))
+
+def contour_areas_perimeters(contours) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Areas and closed perimeters of all contours at once, instead of one
+    cv2.contourArea / cv2.arcLength call per contour.
+    
+    All contour points are concatenated into one array; the shoelace terms and the
+    segment lengths are computed for every point together and summed per contour
+    with np.add.reduceat. Results match cv2.contourArea and cv2.arcLength(cnt, True)
+    (segment lengths are rounded to float32 like OpenCV does).
+    
+    Args:
+        contours: Sequence of (k, 1, 2) int32 point arrays from cv2.findContours
         
-       
-        img = cv2.resize(img, (256, 256))
-        
+    Returns:
+        (areas, perimeters), two float64 arrays with one entry per contour
+    """
+    if len(contours) == 0:
+        return np.empty(0), np.empty(0)
+    lengths = np.fromiter(map(len, contours), dtype=np.intp, count=len(contours))
+    points = np.concatenate(contours).reshape(-1, 2).astype(np.float64)
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    
+    # Index of the previous point on the same (closed) contour
+    prev = np.arange(len(points)) - 1
+    prev[starts] = starts + lengths - 1
+    x, y = points[:, 0], points[:, 1]
+    x_prev, y_prev = x[prev], y[prev]
+    
+    # Integer coordinates: the shoelace sums are exact in float64
+    areas = np.abs(np.add.reduceat(x_prev * y - x * y_prev, starts)) * 0.5
+    
+    dx = (x - x_prev).astype(np.float32)
+    dy = (y - y_prev).astype(np.float32)
+    segment_lengths = np.sqrt(dx * dx + dy * dy).astype(np.float64)
+    perimeters = np.add.reduceat(segment_lengths, starts)
+    return areas, perimeters
+
+def compute_border_features_batch(
+    images: np.ndarray,
+    visualize: bool = False
+) -> List[Dict[str, float]]:
+    """
+    Border features for a stack of equally sized grayscale images, shape (n, h, w).
+    
+    Every image is copied into one tall canvas with a 1-pixel BORDER_REFLECT_101 frame
+    (the border mode cv2.Sobel/cv2.Laplacian use by default), so the 3x3 filters run
+    once over the whole batch without any cross-talk between neighbouring images, and
+    cropping the frames gives exactly the per-image results.
+    
+    Args:
+        images: uint8 array of shape (n, h, w)
+        visualize: Whether to display the detected contours of each image
         
-        if block_size % 2 == 0:
-            block_size += 1  
-        img_adapt = cv2.adaptiveThreshold(
-            img, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-            cv2.THRESH_BINARY_INV, block_size, 2
-        )
+    Returns:
+        One feature dict per image
+    """
+    n, h, w = images.shape
+    
+    # --- Edge Detection on the padded canvas ---
+    with stage_timer("B.edges"):
+        canvas = np.empty((n, h + 2, w + 2), dtype=np.uint8)
+        for i in range(n):
+            cv2.copyMakeBorder(images[i], 1, 1, 1, 1, cv2.BORDER_REFLECT_101, dst=canvas[i])
+        flat = canvas.reshape(n * (h + 2), w + 2)
         
-        # --- Morphological Processing ---
-        kernel = np.ones((morph_kernel_size, morph_kernel_size), np.uint8)
-        img_clean = cv2.morphologyEx(img_adapt, cv2.MORPH_CLOSE, kernel)
-
-        # --- Edge Detection on Original Image ---
-        sobel_x = cv2.Sobel(img, cv2.CV_32F, 1, 0, ksize=3)
-        sobel_y = cv2.Sobel(img, cv2.CV_32F, 0, 1, ksize=3)
-        sobel_mag = np.hypot(sobel_x, sobel_y)
+        def crop(filtered):
+            # View without the frame; OpenCV accepts the strided per-image slices as they are
+            return filtered.reshape(n, h + 2, w + 2)[:, 1:-1, 1:-1]
         
-        laplacian = cv2.Laplacian(img, cv2.CV_32F)
+        sobel_x = crop(cv2.Sobel(flat, cv2.CV_32F, 1, 0, ksize=3))
+        sobel_y = crop(cv2.Sobel(flat, cv2.CV_32F, 0, 1, ksize=3))
+        # Sobel responses of uint8 images are small integers, so x^2 + y^2 is exact in float32 and
+        # sqrt gives the same values as np.hypot, computed in place without temporaries
+        sobel_mag = np.multiply(sobel_x, sobel_x, out=sobel_x)
+        sobel_mag += np.square(sobel_y, out=sobel_y)
+        np.sqrt(sobel_mag, out=sobel_mag)
+        laplacian = crop(cv2.Laplacian(flat, cv2.CV_32F))
         
-        # --- Contour Analysis (All Contours) ---
-        _, fused_edges = cv2.threshold(
-            cv2.normalize(sobel_mag, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8),
-            50, 255, cv2.THRESH_BINARY
-        )
-        contours, _ = cv2.findContours(
-            fused_edges, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE
-        )
+        # Filter outputs of uint8 images are always finite, so mean/std need no NaN handling;
+        # meanStdDev does both in one pass with double accumulators
+        sobel_stats = np.array([cv2.meanStdDev(sobel_mag[i]) for i in range(n)]).reshape(n, 2)
+        laplacian_stats = np.array([cv2.meanStdDev(laplacian[i]) for i in range(n)]).reshape(n, 2)
+    
+    # --- Contour Analysis (All Contours) ---
+    features_list = []
+    for i in range(n):
+        with stage_timer("B.contours"):
+            _, fused_edges = cv2.threshold(
+                cv2.normalize(sobel_mag[i], None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8),
+                50, 255, cv2.THRESH_BINARY
+            )
+            contours, _ = cv2.findContours(
+                fused_edges, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE
+            )
         
-        # Handle empty contours
-        contour_count = len(contours)
-        areas = [cv2.contourArea(cnt) for cnt in contours]
-        perimeters = [cv2.arcLength(cnt, True) for cnt in contours]
+            # Handle empty contours
+            contour_count = len(contours)
+            areas, perimeters = contour_areas_perimeters(contours)
         
         # --- Visualization ---
         if visualize:
-            viz_img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+            viz_img = cv2.cvtColor(images[i], cv2.COLOR_GRAY2BGR)
             cv2.drawContours(viz_img, contours, -1, (0, 255, 0), 1)
             cv2.imshow("Contours", viz_img)
             cv2.waitKey(0)
             cv2.destroyAllWindows()
 
         # --- Feature Engineering ---
-        features = {
+        features_list.append({
             # Contour Features
             "contour_count": contour_count,
-            "avg_contour_area": np.nanmean(areas) if areas else 0.0,
-            "contour_area_std": np.nanstd(areas) if areas else 0.0,
-            "avg_contour_perimeter": np.nanmean(perimeters) if perimeters else 0.0,
-            "contour_perimeter_std": np.nanstd(perimeters) if perimeters else 0.0,
+            "avg_contour_area": np.nanmean(areas) if contour_count else 0.0,
+            "contour_area_std": np.nanstd(areas) if contour_count else 0.0,
+            "avg_contour_perimeter": np.nanmean(perimeters) if contour_count else 0.0,
+            "contour_perimeter_std": np.nanstd(perimeters) if contour_count else 0.0,
             # Edge Features
-            "sobel_mean": np.nanmean(sobel_mag),
-            "sobel_std": np.nanstd(sobel_mag),
-            "laplacian_mean": np.nanmean(laplacian),
-            "laplacian_std": np.nanstd(laplacian)
-        }
-        
-        return features
+            "sobel_mean": sobel_stats[i, 0],
+            "sobel_std": sobel_stats[i, 1],
+            "laplacian_mean": laplacian_stats[i, 0],
+            "laplacian_std": laplacian_stats[i, 1]
+        })
+    
+    return features_list
+
+def extract_border_features(
+    image_path: str,
+    visualize: bool = False,
+    block_size: int = 11,
+    morph_kernel_size: int = 3,
+    error_summary: Optional[ErrorSummary] = None
+) -> Dict[str, float]:
+    """
+    Enhanced border feature extraction focused on essential border characteristics,
+    for a single image (a batch of one for compute_border_features_batch).
+    `block_size` and `morph_kernel_size` are unused and kept for backwards compatibility.
+    Failures are reported to `error_summary` when given (zero features are returned).
+    """
+    try:
+        img = load_border_image(image_path)
+        return compute_border_features_batch(img[np.newaxis], visualize=visualize)[0]
         
     except Exception as e:
-        print(f"Error processing {image_path}: {str(e)}")
+        if error_summary is not None:
+            error_summary.record(os.path.basename(image_path), e)
+        else:
+            logger.warning("Error processing %s: %s", image_path, e)
         # Return empty features with same structure
-        return {
-            "contour_count": 0,
-            "avg_contour_area": 0.0,
-            "contour_area_std": 0.0,
-            "avg_contour_perimeter": 0.0,
-            "contour_perimeter_std": 0.0,
-            "sobel_mean": 0.0,
-            "sobel_std": 0.0,
-            "laplacian_mean": 0.0,
-            "laplacian_std": 0.0
-        }
-
-def calculate_border_score(df: pd.DataFrame) -> pd.DataFrame:
+        return dict(EMPTY_BORDER_FEATURES)
+
+def border_compactness(df: pd.DataFrame) -> pd.Series:
+    """Contour perimeter / sqrt(contour area) per image, the compactness term of the border score."""
+    return df['avg_contour_perimeter'] / np.sqrt(df['avg_contour_area'].replace(0, 1))
+
+def calculate_border_score(df: pd.DataFrame, compactness_mean: Optional[float] = None) -> pd.DataFrame:
     """
     Calculate a single border irregularity score from extracted features.
     Higher scores indicate more irregular borders (potentially malignant).
+
+    Compactness is normalised by its mean over `df`. A handful of new images (one
+    escalated triage image, a watch-mode batch) should pass the mean of the training
+    data instead, since over a single row the term is always 1.
     """
     df_copy = df.copy()
     
@@ -169,20 +295,23 @@ def calculate_border_score(df: pd.DataFrame) -> pd.DataFrame:
     perimeter_irregularity = df_copy['contour_perimeter_std'] / df_copy['avg_contour_perimeter_safe']
     edge_irregularity = df_copy['sobel_std'] / df_copy['sobel_mean_safe']
     laplacian_irregularity = df_copy['laplacian_std'] / df_copy['laplacian_mean_safe']
-    compactness = df_copy['avg_contour_perimeter'] / np.sqrt(df_copy['avg_contour_area_safe'])
+    compactness = border_compactness(df_copy)
+    if compactness_mean is None:
+        compactness_mean = compactness.mean()
     
     # Combine into border score (normalized)
     df_copy['border_score'] = (
         0.3 * perimeter_irregularity +
         0.3 * edge_irregularity + 
         0.2 * laplacian_irregularity +
-        0.2 * (compactness / compactness.mean())  # Normalize compactness
+        0.2 * (compactness / compactness_mean)  # Normalize compactness
     )
     
     return df_copy
 
 
 if __name__ == "__main__":
+    configure_logging()
 
     folder_path = r"C:\Users\Erik\OneDrive - ITU\Escritorio\2 semester\Semester project\Introduction to final project\matched_pairs\masks"
     output_csv = r"C:\Users\Erik\OneDrive - ITU\Escritorio\2 semester\Semester project\Introduction to final project\2025-FYP-Final\resultborder_features.csv"
@@ -3,11 +3,139 @@ import numpy as np
 import matplotlib.pyplot as plt
 import os
 import pandas as pd
-from skimage import segmentation, color
 from sklearn.cluster import KMeans
+from skimage import color
 from tqdm import tqdm 
 
-def extract_feature_C(folder_path, output_csv=None, normalize_colors=True, visualize=False):
+from util.profiling import stage_timer, timed_stage
+from util.logging_util import get_logger, configure_logging, ErrorSummary, log_run_summary
+from util.checkpoint import PartialResultsWriter
+from util.feature_sink import extractor_sink
+
+logger = get_logger("feature_C")
+
+def default_color_features():
+    """Feature values used when no lesion is found or the image fails."""
+    features = {f: 0.0 for f in [
+        'c_mean_red', 'c_mean_green', 'c_mean_blue', 'c_std_red', 'c_std_green', 'c_std_blue',
+        'c_mean_hue', 'c_mean_saturation', 'c_mean_value', 'c_std_hue', 'c_std_saturation', 'c_std_value',
+        'c_red_asymmetry', 'c_green_asymmetry', 'c_blue_asymmetry', 'c_color_variance',
+        'c_red_green_ratio', 'c_red_blue_ratio', 'c_green_blue_ratio'
+    ]}
+    features['c_dominant_channel'] = 'none'
+    return features
+
+def color_features_from_image(img, normalize_colors=True):
+    """
+    Color features of one RGB image at whatever size it is given
+    (256x256 in extract_feature_C, any pyramid level in util.pyramid).
+    
+    Parameters:
+    img (np.ndarray): RGB image
+    normalize_colors (bool): Whether to normalize color values to range [0,1]
+    
+    Returns:
+    tuple: (features dict or None if no lesion was found, lesion mask)
+    """
+    # Step 1: Segment the lesion from the background
+    # Create a mask for the lesion area
+    h, w = img.shape[:2]
+    center_y, center_x = h // 2, w // 2
+    
+    # Create a circular mask around the center
+    y, x = np.ogrid[:h, :w]
+    dist_from_center = np.sqrt((x - center_x)**2 + (y - center_y)**2)
+    mask = dist_from_center <= min(h, w) // 3
+    
+    # Refine mask using color information
+    pixels = img.reshape(-1, 3)
+    with stage_timer("C.kmeans"):
+        kmeans = KMeans(n_clusters=2, random_state=0, n_init='auto').fit(pixels) # Added n_init='auto' for KMeans
+    labels = kmeans.labels_.reshape(h, w)
+    
+    # Determine which label corresponds to the lesion
+    center_label = labels[center_y, center_x]
+    refined_mask = (labels == center_label)
+    
+    # Combine masks
+    final_mask = np.logical_and(mask, refined_mask)
+    
+    # Step 2: Extract color features from the lesion area
+    lesion_pixels = img[final_mask]
+    
+    if len(lesion_pixels) == 0:
+        return None, final_mask
+    
+    # Calculate color features
+    features = {}
+    
+    # Apply normalization if requested
+    if normalize_colors:
+        lesion_pixels = lesion_pixels / 255.0
+        divisor = 1.0  
+    else:
+        divisor = 1.0  
+    
+    # RGB color space features
+    features['c_mean_red'] = np.mean(lesion_pixels[:, 0])
+    features['c_mean_green'] = np.mean(lesion_pixels[:, 1])
+    features['c_mean_blue'] = np.mean(lesion_pixels[:, 2])
+    features['c_std_red'] = np.std(lesion_pixels[:, 0])
+    features['c_std_green'] = np.std(lesion_pixels[:, 1])
+    features['c_std_blue'] = np.std(lesion_pixels[:, 2])
+    
+    # Convert to HSV for additional features
+    with stage_timer("C.hsv"):
+        if normalize_colors:
+            hsv_pixels = color.rgb2hsv(lesion_pixels)
+        else:
+            hsv_pixels = color.rgb2hsv(lesion_pixels / 255.0)
+        
+    features['c_mean_hue'] = np.mean(hsv_pixels[:, 0])
+    features['c_mean_saturation'] = np.mean(hsv_pixels[:, 1])
+    features['c_mean_value'] = np.mean(hsv_pixels[:, 2])
+    features['c_std_hue'] = np.std(hsv_pixels[:, 0])
+    features['c_std_saturation'] = np.std(hsv_pixels[:, 1])
+    features['c_std_value'] = np.std(hsv_pixels[:, 2])
+    
+    # Color asymmetry features
+    left_mask = np.zeros_like(final_mask)
+    left_mask[:, :w//2] = final_mask[:, :w//2]
+    right_mask = np.zeros_like(final_mask)
+    right_mask[:, w//2:] = final_mask[:, w//2:]
+    
+    left_pixels = img[left_mask]
+    right_pixels = img[right_mask]
+    
+    if len(left_pixels) > 0 and len(right_pixels) > 0:
+        if normalize_colors:
+            left_pixels = left_pixels / 255.0
+            right_pixels = right_pixels / 255.0
+            
+        features['c_red_asymmetry'] = abs(np.mean(left_pixels[:, 0]) - np.mean(right_pixels[:, 0]))
+        features['c_green_asymmetry'] = abs(np.mean(left_pixels[:, 1]) - np.mean(right_pixels[:, 1]))
+        features['c_blue_asymmetry'] = abs(np.mean(left_pixels[:, 2]) - np.mean(right_pixels[:, 2]))
+    else:
+        features['c_red_asymmetry'] = 0
+        features['c_green_asymmetry'] = 0
+        features['c_blue_asymmetry'] = 0
+    
+    # Color variance (indicates color homogeneity/heterogeneity)
+    features['c_color_variance'] = np.sum(np.var(lesion_pixels, axis=0))
+    
+    # Additional color features
+    features['c_red_green_ratio'] = features['c_mean_red'] / max(features['c_mean_green'], divisor)
+    features['c_red_blue_ratio'] = features['c_mean_red'] / max(features['c_mean_blue'], divisor)
+    features['c_green_blue_ratio'] = features['c_mean_green'] / max(features['c_mean_blue'], divisor)
+    
+    # Color dominance
+    rgb_means = [features['c_mean_red'], features['c_mean_green'], features['c_mean_blue']]
+    features['c_dominant_channel'] = ['red', 'green', 'blue'][np.argmax(rgb_means)]
+    
+    return features, final_mask
+
+@timed_stage("C.folder")
+def extract_feature_C(folder_path, output_csv=None, normalize_colors=True, visualize=False, file_list=None):
     """
     Function to extract color features from skin lesion images in a folder
     
@@ -16,12 +144,15 @@ def extract_feature_C(folder_path, output_csv=None, normalize_colors=True, visua
     output_csv (str): Path to output CSV file. If the file exists, features will be added to it
     normalize_colors (bool): Whether to normalize color values to range [0,1]
     visualize (bool): Whether to visualize the segmentation results
+    file_list (list or None): Only process these file names (e.g. one shard), default all
     
     Returns:
     pd.DataFrame: DataFrame containing color features for all images
     """
  
-    results = []
+    results = extractor_sink()
+    errors = ErrorSummary(logger, "C")
+    no_lesion_count = 0
     
     valid_extensions = ['.jpg', '.jpeg', '.png', '.bmp']
     
@@ -29,14 +160,19 @@ def extract_feature_C(folder_path, output_csv=None, normalize_colors=True, visua
     if output_csv and os.path.exists(output_csv):
         try:
             existing_df = pd.read_csv(output_csv)
-            print(f"Loaded existing features from {output_csv}")
+            logger.info("Loaded existing features from %s", output_csv)
         except Exception as e:
-            print(f"Error loading existing CSV: {str(e)}")
+            logger.warning("Error loading existing CSV %s: %s", output_csv, e)
+    # Rows are saved every CHECKPOINT_EVERY images, so a crashed run resumes from there
+    writer = PartialResultsWriter(output_csv, existing_df)
     
     image_files = [f for f in os.listdir(folder_path) if os.path.splitext(f)[1].lower() in valid_extensions]
+    if file_list is not None:
+        wanted = set(file_list)
+        image_files = [f for f in image_files if f in wanted]
 
     for filename in tqdm(image_files, desc="Extracting Color Features (C)"): 
-       
+        writer.maybe_flush(results)
         if existing_df is not None and filename in existing_df['filename'].values:
         
             continue
@@ -44,127 +180,24 @@ def extract_feature_C(folder_path, output_csv=None, normalize_colors=True, visua
         image_path = os.path.join(folder_path, filename)
         
         try:
-            img = cv2.imread(image_path)
-            if img is None:
-                print(f"Error reading {filename}, skipping...")
-                continue
+            with stage_timer("C.decode"):
+                img = cv2.imread(image_path)
+                if img is None:
+                    errors.record(filename, "unreadable image")
+                    continue
                 
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-            
-            # Resize for consistency (optional)
-            img = cv2.resize(img, (256, 256))
-            
-            # Step 1: Segment the lesion from the background
-            # Convert to LAB color space for better segmentation
-            lab = cv2.cvtColor(img, cv2.COLOR_RGB2LAB)
+                img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
             
-            # Apply SLIC segmentation to get superpixels
-            segments = segmentation.slic(img, n_segments=100, compactness=10, sigma=1)
+                # Resize for consistency (optional)
+                img = cv2.resize(img, (256, 256))
             
-            # Create a mask for the lesion area
-            h, w = img.shape[:2]
-            center_y, center_x = h // 2, w // 2
-            
-            # Create a circular mask around the center
-            y, x = np.ogrid[:h, :w]
-            dist_from_center = np.sqrt((x - center_x)**2 + (y - center_y)**2)
-            mask = dist_from_center <= min(h, w) // 3
-            
-            # Refine mask using color information
-            pixels = img.reshape(-1, 3)
-            kmeans = KMeans(n_clusters=2, random_state=0, n_init='auto').fit(pixels) # Added n_init='auto' for KMeans
-            labels = kmeans.labels_.reshape(h, w)
-            
-            # Determine which label corresponds to the lesion
-            center_label = labels[center_y, center_x]
-            refined_mask = (labels == center_label)
-            
-            # Combine masks
-            final_mask = np.logical_and(mask, refined_mask)
-            
-            # Step 2: Extract color features from the lesion area
-            lesion_pixels = img[final_mask]
-            
-            if len(lesion_pixels) == 0:
-                print(f"No lesion detected in {filename}, skipping...")
-                
-                features = {'filename': filename}
-                default_color_features = [
-                    'c_mean_red', 'c_mean_green', 'c_mean_blue', 'c_std_red', 'c_std_green', 'c_std_blue',
-                    'c_mean_hue', 'c_mean_saturation', 'c_mean_value', 'c_std_hue', 'c_std_saturation', 'c_std_value',
-                    'c_red_asymmetry', 'c_green_asymmetry', 'c_blue_asymmetry', 'c_color_variance',
-                    'c_red_green_ratio', 'c_red_blue_ratio', 'c_green_blue_ratio'
-                ]
-                for f in default_color_features:
-                    features[f] = 0.0
-                features['c_dominant_channel'] = 'none' 
-                results.append(features)
+            features, final_mask = color_features_from_image(img, normalize_colors=normalize_colors)
+            if features is None:
+                logger.debug("No lesion detected in %s, using default color features", filename)
+                no_lesion_count += 1
+                results.append({'filename': filename, **default_color_features()})
                 continue
-            
-            # Calculate color features
-            features = {'filename': filename}
-            
-            # Apply normalization if requested
-            if normalize_colors:
-                lesion_pixels = lesion_pixels / 255.0
-                divisor = 1.0  
-            else:
-                divisor = 1.0  
-            
-            # RGB color space features
-            features['c_mean_red'] = np.mean(lesion_pixels[:, 0])
-            features['c_mean_green'] = np.mean(lesion_pixels[:, 1])
-            features['c_mean_blue'] = np.mean(lesion_pixels[:, 2])
-            features['c_std_red'] = np.std(lesion_pixels[:, 0])
-            features['c_std_green'] = np.std(lesion_pixels[:, 1])
-            features['c_std_blue'] = np.std(lesion_pixels[:, 2])
-            
-            # Convert to HSV for additional features
-            if normalize_colors:
-                hsv_pixels = color.rgb2hsv(lesion_pixels)
-            else:
-                hsv_pixels = color.rgb2hsv(lesion_pixels / 255.0)
-                
-            features['c_mean_hue'] = np.mean(hsv_pixels[:, 0])
-            features['c_mean_saturation'] = np.mean(hsv_pixels[:, 1])
-            features['c_mean_value'] = np.mean(hsv_pixels[:, 2])
-            features['c_std_hue'] = np.std(hsv_pixels[:, 0])
-            features['c_std_saturation'] = np.std(hsv_pixels[:, 1])
-            features['c_std_value'] = np.std(hsv_pixels[:, 2])
-            
-            # Color asymmetry features
-            left_mask = np.zeros_like(final_mask)
-            left_mask[:, :w//2] = final_mask[:, :w//2]
-            right_mask = np.zeros_like(final_mask)
-            right_mask[:, w//2:] = final_mask[:, w//2:]
-            
-            left_pixels = img[left_mask]
-            right_pixels = img[right_mask]
-            
-            if len(left_pixels) > 0 and len(right_pixels) > 0:
-                if normalize_colors:
-                    left_pixels = left_pixels / 255.0
-                    right_pixels = right_pixels / 255.0
-                    
-                features['c_red_asymmetry'] = abs(np.mean(left_pixels[:, 0]) - np.mean(right_pixels[:, 0]))
-                features['c_green_asymmetry'] = abs(np.mean(left_pixels[:, 1]) - np.mean(right_pixels[:, 1]))
-                features['c_blue_asymmetry'] = abs(np.mean(left_pixels[:, 2]) - np.mean(right_pixels[:, 2]))
-            else:
-                features['c_red_asymmetry'] = 0
-                features['c_green_asymmetry'] = 0
-                features['c_blue_asymmetry'] = 0
-            
-            # Color variance (indicates color homogeneity/heterogeneity)
-            features['c_color_variance'] = np.sum(np.var(lesion_pixels, axis=0))
-            
-            # Additional color features
-            features['c_red_green_ratio'] = features['c_mean_red'] / max(features['c_mean_green'], divisor)
-            features['c_red_blue_ratio'] = features['c_mean_red'] / max(features['c_mean_blue'], divisor)
-            features['c_green_blue_ratio'] = features['c_mean_green'] / max(features['c_mean_blue'], divisor)
-            
-            # Color dominance
-            rgb_means = [features['c_mean_red'], features['c_mean_green'], features['c_mean_blue']]
-            features['c_dominant_channel'] = ['red', 'green', 'blue'][np.argmax(rgb_means)]
+            features = {'filename': filename, **features}
             
             # Visualization (if enabled)
             if visualize:
@@ -194,32 +227,20 @@ def extract_feature_C(folder_path, output_csv=None, normalize_colors=True, visua
             results.append(features)
             
         except Exception as e:
-            print(f"Error processing {filename}: {str(e)}")
+            errors.record(filename, e)
 
-            features = {'filename': filename}
-            default_color_features = [
-                'c_mean_red', 'c_mean_green', 'c_mean_blue', 'c_std_red', 'c_std_green', 'c_std_blue',
-                'c_mean_hue', 'c_mean_saturation', 'c_mean_value', 'c_std_hue', 'c_std_saturation', 'c_std_value',
-                'c_red_asymmetry', 'c_green_asymmetry', 'c_blue_asymmetry', 'c_color_variance',
-                'c_red_green_ratio', 'c_red_blue_ratio', 'c_green_blue_ratio'
-            ]
-            for f in default_color_features:
-                features[f] = 0.0
-            features['c_dominant_channel'] = 'none' 
-            results.append(features)
+            results.append({'filename': filename, **default_color_features()})
 
-    new_df = pd.DataFrame(results)
-    
-    if existing_df is not None and not new_df.empty:
-        combined_df = pd.concat([existing_df, new_df], ignore_index=True)
-    elif not new_df.empty:
-        combined_df = new_df
-    else:
-        combined_df = existing_df if existing_df is not None else pd.DataFrame()
+    combined_df = writer.finish(results)
+    if output_csv and not combined_df.empty:
+        logger.info("Features saved to %s", output_csv)
 
+    errors.log_summary()
+    log_run_summary(logger, "C", images=len(image_files), extracted=len(results), no_lesion=no_lesion_count, errors=errors.count)
     return combined_df
 
 if __name__ == "__main__":
+    configure_logging()
     image_folder = r"C:\Users\Erik\OneDrive - ITU\Escritorio\2 semester\Semester project\Introduction to final project\matched_pairs\images" # Example path
     
     output_csv_for_standalone_run = r"C:\Users\Erik\OneDrive - ITU\Escritorio\2 semester\Semester project\Introduction to final project\2025-FYP-Final\result\color_features_standalone.csv"
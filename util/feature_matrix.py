@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+
+# Categorical feature columns and the prefix used for their one-hot columns
+CATEGORICAL_FEATURES = {'c_dominant_channel': 'c_dom_channel'}
+
+
+def build_feature_matrix(data_df, feature_columns, categorical_columns=None, dtype=np.float32):
+    """
+    Build one contiguous feature matrix from the merged feature DataFrame.
+
+    Numeric columns are converted with pd.to_numeric (errors -> NaN) straight into a
+    preallocated array, categorical columns are one-hot encoded once and appended at the
+    end (same order as pd.get_dummies), and +/-inf is replaced by NaN.
+    float32 is what the sklearn trees use internally, so the forests no longer make their
+    own converted copy of the data for every fit.
+
+    Parameters:
+    data_df (pd.DataFrame): Merged dataset.
+    feature_columns (list): Columns to use as features (may include categorical ones).
+    categorical_columns (dict or None): {column: one-hot prefix}; defaults to CATEGORICAL_FEATURES.
+    dtype (np.dtype): dtype of the returned matrix.
+
+    Returns:
+    tuple: (np.ndarray of shape (n_rows, n_features), list of feature names)
+    """
+    if categorical_columns is None:
+        categorical_columns = CATEGORICAL_FEATURES
+    numeric_cols = [col for col in feature_columns if col not in categorical_columns]
+    cat_cols = [col for col in feature_columns if col in categorical_columns]
+
+    # Categories per categorical column, sorted like pd.get_dummies does
+    categories = {col: sorted(data_df[col].dropna().unique()) for col in cat_cols}
+    n_onehot = sum(len(cats) for cats in categories.values())
+
+    X = np.empty((len(data_df), len(numeric_cols) + n_onehot), dtype=dtype, order='C')
+    names = list(numeric_cols)
+    for j, col in enumerate(numeric_cols):
+        X[:, j] = pd.to_numeric(data_df[col], errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+
+    j = len(numeric_cols)
+    for col in cat_cols:
+        values = data_df[col].to_numpy()
+        for cat in categories[col]:
+            X[:, j] = values == cat
+            names.append(f"{categorical_columns[col]}_{cat}")
+            j += 1
+
+    X[np.isinf(X)] = np.nan
+    return X, names
+
+
+def drop_all_nan_columns(X, feature_names):
+    """
+    Remove columns that contain only NaN.
+
+    Returns:
+    tuple: (matrix without those columns, remaining names, dropped names)
+    """
+    all_nan = np.isnan(X).all(axis=0)
+    if not all_nan.any():
+        return X, feature_names, []
+    dropped = [name for name, drop in zip(feature_names, all_nan) if drop]
+    kept = [name for name, drop in zip(feature_names, all_nan) if not drop]
+    return np.ascontiguousarray(X[:, ~all_nan]), kept, dropped
+
+
+def impute_mean_inplace(X):
+    """
+    Replace NaNs by the column mean, modifying X in place (same result as
+    SimpleImputer(strategy='mean') without allocating a second matrix).
+
+    Returns:
+    np.ndarray: The column means (computed in float64) that were used.
+    """
+    means = np.nanmean(X, axis=0, dtype=np.float64)
+    rows, cols = np.nonzero(np.isnan(X))
+    X[rows, cols] = means[cols]
+    return means
+
+
+def matrix_memory_mb(X):
+    """Size of a feature matrix (ndarray or DataFrame) in MB."""
+    if isinstance(X, pd.DataFrame):
+        return X.memory_usage(deep=True).sum() / (1024 * 1024)
+    return X.nbytes / (1024 * 1024)
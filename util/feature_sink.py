@@ -0,0 +1,166 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from util.logging_util import get_logger
+
+logger = get_logger("feature_sink")
+
+# Rows per record batch; only one batch of row dicts is ever held in memory
+SINK_BATCH_SIZE = 1024
+
+
+def _frame_to_columns(df):
+    return {col: df[col].to_numpy() for col in df.columns}
+
+
+class FeatureSink:
+    """
+    Append-only store for feature rows, kept as columnar record batches.
+
+    Extractors `append` one dict per image as before; every `batch_size` rows the buffer
+    is turned into one array per column. Without `path` the batches stay in memory (a few
+    bytes per value instead of a dict per row); with `path` each batch is written to
+    `path/batch-XXXXXX.npz` and dropped, so memory stays flat however many images are
+    processed. With `spill=True` and no `path`, the sink starts in memory and moves to a
+    temporary folder once it holds more than one batch, so small runs never touch the disk.
+    `to_frame()` reads the batches back column by column.
+
+    Parameters:
+    path (str or None): Folder for spilled batches; it is emptied when the sink is created.
+    batch_size (int): Rows per record batch.
+    spill (bool): Without `path`, spill to a temporary folder once the rows exceed one batch.
+    """
+
+    def __init__(self, path=None, batch_size=SINK_BATCH_SIZE, spill=False):
+        self.path = path
+        self.batch_size = batch_size
+        self.spill = spill
+        self._spilled = False  # path is a temporary folder created by the sink itself
+        self._buffer = []
+        self._batches = []  # in-memory mode: [(n_rows, {column: array})]
+        self._batch_rows = []  # rows per batch, so a tail of the rows can be read without the rest
+        self._rows = 0
+        if path is not None:
+            shutil.rmtree(path, ignore_errors=True)
+            os.makedirs(path, exist_ok=True)
+
+    def __len__(self):
+        return self._rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def append(self, row):
+        """Add one row (dict of column -> value)."""
+        self._buffer.append(row)
+        self._rows += 1
+        if len(self._buffer) >= self.batch_size:
+            self._flush()
+
+    def append_frame(self, df):
+        """Add the rows of a DataFrame as one batch (e.g. the result of a whole chunk)."""
+        if df is None or df.empty:
+            return
+        self._flush()
+        self._write_batch(len(df), _frame_to_columns(df))
+        self._rows += len(df)
+
+    def _flush(self):
+        if self._buffer:
+            # One batch at a time, so the dtypes are inferred exactly as for the whole list
+            self._write_batch(len(self._buffer), _frame_to_columns(pd.DataFrame(self._buffer)))
+            self._buffer = []
+
+    def _write_batch(self, n_rows, columns):
+        if self.path is None and self.spill and sum(self._batch_rows) + n_rows > self.batch_size:
+            self._spill_to_disk()
+        if self.path is None:
+            self._batches.append((n_rows, columns))
+        else:
+            batch_path = os.path.join(self.path, f"batch-{len(self._batch_rows):06d}.npz")
+            np.savez(batch_path, **columns)
+        self._batch_rows.append(n_rows)
+
+    def _spill_to_disk(self):
+        # Move the batches held so far to a temporary folder; later batches go straight there
+        self.path = tempfile.mkdtemp(prefix="feature_sink_")
+        self._spilled = True
+        for i, (_, columns) in enumerate(self._batches):
+            np.savez(os.path.join(self.path, f"batch-{i:06d}.npz"), **columns)
+        self._batches = []
+
+    def _iter_batches(self, start=0):
+        # Batches holding rows start..end, the first one cut to begin at row `start`
+        first_row = 0
+        for i, n_rows in enumerate(self._batch_rows):
+            if first_row + n_rows > start:
+                if self.path is None:
+                    columns = self._batches[i][1]
+                else:
+                    with np.load(os.path.join(self.path, f"batch-{i:06d}.npz"), allow_pickle=True) as data:
+                        columns = {name: data[name] for name in data.files}
+                offset = max(start - first_row, 0)
+                if offset:
+                    columns = {name: values[offset:] for name, values in columns.items()}
+                yield n_rows - offset, columns
+            first_row += n_rows
+
+    def to_frame(self, start=0):
+        """
+        Rows from `start` on (all by default) as a DataFrame, with the same columns and
+        dtypes as pd.DataFrame(list_of_rows). Only the batches holding those rows are read.
+        """
+        self._flush()
+        return _batches_to_frame(self._iter_batches(start))
+
+    def close(self):
+        """Drop the buffered rows and any spilled batches."""
+        self._buffer, self._batches, self._batch_rows = [], [], []
+        if self.path is not None:
+            shutil.rmtree(self.path, ignore_errors=True)
+        if self._spilled:
+            self.path, self._spilled = None, False
+
+
+def _batches_to_frame(batches):
+    batches = list(batches)
+    if not batches:
+        return pd.DataFrame()
+    order = {}
+    for _, columns in batches:
+        for name in columns:
+            order.setdefault(name, None)
+    data = {}
+    for name in order:
+        arrays = [columns.get(name) for _, columns in batches]
+        if all(a is not None for a in arrays) and len({a.dtype for a in arrays}) == 1:
+            data[name] = np.concatenate(arrays) if len(arrays) > 1 else arrays[0]
+        else:
+            # Missing column in some batch or differing dtypes: let pandas promote (e.g. int + NaN -> float)
+            parts = [pd.Series(a) if a is not None else pd.Series(np.full(n_rows, np.nan))
+                     for a, (n_rows, _) in zip(arrays, batches)]
+            data[name] = pd.concat(parts, ignore_index=True)
+    return pd.DataFrame(data)
+
+
+def results_frame(results, start=0):
+    """DataFrame of an extractor's results from row `start` on, whether a FeatureSink or a plain list of row dicts."""
+    if isinstance(results, FeatureSink):
+        return results.to_frame(start)
+    return pd.DataFrame(results[start:])
+
+
+def extractor_sink():
+    """
+    Sink for a folder extractor. The decision to spill follows the run size, not the caller:
+    runs up to one batch (e.g. a DAG chunk) stay in memory, larger ones (a whole folder,
+    whether or not it is saved to a CSV) spill to a temporary folder that close() removes.
+    """
+    return FeatureSink(spill=True)
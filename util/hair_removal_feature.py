@@ -1,9 +1,16 @@
 import cv2
 import numpy as np
+import pandas as pd
 import os
 import shutil
 from tqdm import tqdm
 
+from util.profiling import stage_timer, timed_stage
+from util.logging_util import get_logger, configure_logging, ErrorSummary, log_run_summary
+
+logger = get_logger("hair_removal")
+
+@timed_stage("Hair.total")
 def remove_and_save_hairs(
     image_path,
     output_dir,
@@ -18,20 +25,22 @@ def remove_and_save_hairs(
     os.makedirs(output_dir, exist_ok=True)
     filename = os.path.basename(image_path)
 
-    img = cv2.imread(image_path, cv2.IMREAD_COLOR)
-    if img is None:
-        raise FileNotFoundError(f"Image not found at: {image_path}")
+    with stage_timer("Hair.decode"):
+        img = cv2.imread(image_path, cv2.IMREAD_COLOR)
+        if img is None:
+            raise FileNotFoundError(f"Image not found at: {image_path}")
 
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
 
     # Morphological operations to detect hairs
-    kernel_blackhat = cv2.getStructuringElement(cv2.MORPH_RECT, blackhat_kernel_size)
-    blackhat = cv2.morphologyEx(gray, cv2.MORPH_BLACKHAT, kernel_blackhat)
+    with stage_timer("Hair.detect"):
+        kernel_blackhat = cv2.getStructuringElement(cv2.MORPH_RECT, blackhat_kernel_size)
+        blackhat = cv2.morphologyEx(gray, cv2.MORPH_BLACKHAT, kernel_blackhat)
 
-    _, thresh = cv2.threshold(blackhat, threshold_value, 255, cv2.THRESH_BINARY)
+        _, thresh = cv2.threshold(blackhat, threshold_value, 255, cv2.THRESH_BINARY)
 
-    kernel_dilate = cv2.getStructuringElement(cv2.MORPH_RECT, dilation_kernel_size)
-    dilated_mask = cv2.dilate(thresh, kernel_dilate, iterations=dilation_iterations)
+        kernel_dilate = cv2.getStructuringElement(cv2.MORPH_RECT, dilation_kernel_size)
+        dilated_mask = cv2.dilate(thresh, kernel_dilate, iterations=dilation_iterations)
 
     # Calculate hair ratio based on the area of the dilated_mask
     total_image_pixels = gray.shape[0] * gray.shape[1]
@@ -52,23 +61,98 @@ def remove_and_save_hairs(
 
     # Decision to inpaint is based on the count of significant hair contours
     if hair_count < min_hair_contours_to_process:
-        shutil.copy2(image_path, output_path)
+        with stage_timer("Hair.copy"):
+            shutil.copy2(image_path, output_path)
 
         return hair_ratio, output_path, "No significant hairs found, original image copied."
     else:
-        inpainted_image = cv2.inpaint(img, dilated_mask, inpaint_radius, cv2.INPAINT_TELEA)
-        cv2.imwrite(output_path, inpainted_image)
+        with stage_timer("Hair.inpaint"):
+            inpainted_image = cv2.inpaint(img, dilated_mask, inpaint_radius, cv2.INPAINT_TELEA)
+        with stage_timer("Hair.write"):
+            cv2.imwrite(output_path, inpainted_image)
         # Return the hair_ratio. The message still uses hair_count for specific information.
         return hair_ratio, output_path, f"{hair_count} hairs removed."
 
 
+def remove_hair_from_folder(original_img_dir, output_dir, image_files, hair_params, skip_existing=False):
+    """
+    Hair removal for a list of images: inpainted (or copied) images go to output_dir.
+
+    An image whose hair removal fails is copied unchanged, so every image still reaches
+    feature extraction.
+
+    Parameters:
+    original_img_dir (str): Folder with the original images.
+    output_dir (str): Folder the processed images are written to.
+    image_files (list): File names in original_img_dir to process.
+    hair_params (dict): Keyword arguments of remove_and_save_hairs (lists are accepted for kernel sizes).
+    skip_existing (bool): Keep images already in output_dir (their hair ratio is then 0).
+
+    Returns:
+    pd.DataFrame: filename, hair_ratio (fraction of the image covered by the hair mask).
+    """
+    hair_params = {k: tuple(v) if isinstance(v, list) else v for k, v in hair_params.items()}
+    os.makedirs(output_dir, exist_ok=True)
+
+    processed_files_in_loop = 0
+    inpainted_count = 0
+    copied_original_count = 0
+    hair_errors = ErrorSummary(logger, "Hair removal")
+    hair_ratios_data = []
+
+    for filename in tqdm(image_files, desc="Performing Hair Removal"):
+        original_image_path = os.path.join(original_img_dir, filename)
+        target_path = os.path.join(output_dir, filename)
+        current_hair_ratio_val = 0.0
+
+        if skip_existing and os.path.exists(target_path):
+            logger.debug("Skipping hair removal for %s, already exists. Hair ratio will be 0.", filename)
+            hair_ratios_data.append({'filename': filename, 'hair_ratio': current_hair_ratio_val})
+            processed_files_in_loop += 1
+            continue
+
+        try:
+            current_hair_ratio_val, saved_img_path, msg = remove_and_save_hairs(
+                image_path=original_image_path,
+                output_dir=output_dir,
+                **hair_params
+            )
+            if "hairs removed" in msg and saved_img_path and os.path.exists(saved_img_path):
+                inpainted_count += 1
+            elif "No significant hairs found" in msg and saved_img_path and os.path.exists(saved_img_path):
+                copied_original_count += 1
+            elif not os.path.exists(target_path):
+                # remove_and_save_hairs did not write the file: fall back to the original
+                logger.debug("Hair removal for %s - message: '%s'. Output file '%s' not found. Copying original.", filename, msg, target_path)
+                shutil.copy2(original_image_path, target_path)
+                copied_original_count += 1
+            processed_files_in_loop += 1
+
+        except FileNotFoundError:
+            hair_errors.record(filename, FileNotFoundError(f"original image not found at {original_image_path}"))
+        except Exception as e_hair:
+            hair_errors.record(filename, e_hair)
+            try:
+                if not os.path.exists(target_path):
+                    shutil.copy2(original_image_path, target_path)
+                copied_original_count += 1
+            except Exception as e_copy:
+                logger.error("Failed to copy original %s after hair removal error: %s", filename, e_copy)
+
+        hair_ratios_data.append({'filename': filename, 'hair_ratio': current_hair_ratio_val})
+
+    hair_errors.log_summary()
+    log_run_summary(logger, "Hair removal", images=len(image_files), processed=processed_files_in_loop,
+                    inpainted=inpainted_count, copied=copied_original_count, errors=hair_errors.count)
+    return pd.DataFrame(hair_ratios_data, columns=['filename', 'hair_ratio'])
+
+
 def process_folder(input_folder, output_folder="output_cleaned"):
     supported_extensions = ('.jpg', '.jpeg', '.png', '.bmp', '.tiff')
     os.makedirs(output_folder, exist_ok=True)
 
-    print(f"Processing images from: {input_folder}")
-    print(f"Saving results to: {output_folder}")
-    print("-" * 40)
+    logger.info("Processing images from: %s", input_folder)
+    logger.info("Saving results to: %s", output_folder)
 
     params = {
         "blackhat_kernel_size": (15, 15),
@@ -82,7 +166,7 @@ def process_folder(input_folder, output_folder="output_cleaned"):
 
     processed = 0
     skipped = 0
-    errored = 0
+    errors = ErrorSummary(logger, "Hair")
     total = 0
 
     image_files = [f for f in os.listdir(input_folder) if f.lower().endswith(supported_extensions)]
@@ -102,16 +186,13 @@ def process_folder(input_folder, output_folder="output_cleaned"):
             else:
                 processed += 1
         except Exception as e:
-            print(f"\n[ERROR] {filename}: {e}")
-            errored += 1
+            errors.record(filename, e)
 
-    print("-" * 40)
-    print(f"Total image files found: {total}")
-    print(f"Images where inpainting was applied: {processed}")
-    print(f"Images where original was copied (no/few hairs): {skipped}")
-    print(f"Errors during processing: {errored}")
+    errors.log_summary()
+    log_run_summary(logger, "Hair removal", images=total, inpainted=processed, copied=skipped, errors=errors.count)
 
 if __name__ == "__main__":
+    configure_logging()
     input_folder = r"C:\Users\laura\Documents\University\2nd semester\Projects in Data Science\Projects\Final Project\matched_pairs\images"
     output_folder = r"C:\Users\laura\Documents\University\2nd semester\Projects in Data Science\Projects\Final Project\images after hair removal"
 
@@ -0,0 +1,72 @@
+import numpy as np
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.pipeline import Pipeline
+
+# Numeric values go to codes 0..MAX_BINS-1; MISSING_CODE is kept for NaN
+MAX_BINS = 255
+MISSING_CODE = 255
+
+
+class FeatureBinner(BaseEstimator, TransformerMixin):
+    """
+    Maps every feature column to uint8 bin codes. Fitted once on the whole imputed matrix
+    (label-free, like the mean imputation), the codes are reused by every CV fold instead
+    of each fold finding its own quantiles.
+
+    Thresholds follow HistGradientBoostingClassifier's own binning: midpoints between the
+    distinct values when a column has at most `max_bins` of them, quantiles otherwise; a
+    value v goes to the first bin whose threshold is >= v. The codes of a column therefore
+    take at most `max_bins` distinct values, so the model (with max_bins=255) keeps one bin
+    per code and splits on exactly these thresholds. NaN gets MISSING_CODE.
+
+    Parameters:
+    max_bins (int): Bins per feature for non-missing values (at most 255).
+    """
+
+    def __init__(self, max_bins=MAX_BINS):
+        self.max_bins = max_bins
+
+    def fit(self, X, y=None):
+        if not 2 <= self.max_bins <= MAX_BINS:
+            raise ValueError(f"max_bins must be between 2 and {MAX_BINS}, got {self.max_bins}")
+        X = np.asarray(X)
+        percentiles = np.linspace(0, 100, self.max_bins + 1)[1:-1]
+        self.thresholds_ = []
+        for j in range(X.shape[1]):
+            col = X[:, j].astype(np.float64)
+            col = col[~np.isnan(col)]
+            distinct = np.unique(col)
+            if len(distinct) <= self.max_bins:
+                thresholds = (distinct[:-1] + distinct[1:]) / 2
+            else:
+                thresholds = np.unique(np.percentile(col, percentiles, method='midpoint'))
+            self.thresholds_.append(thresholds)
+        self.n_features_in_ = X.shape[1]
+        return self
+
+    def transform(self, X):
+        X = np.asarray(X)
+        if X.shape[1] != self.n_features_in_:
+            raise ValueError(f"Expected {self.n_features_in_} features, got {X.shape[1]}")
+        codes = np.empty(X.shape, dtype=np.uint8)
+        for j, thresholds in enumerate(self.thresholds_):
+            col = X[:, j]
+            codes[:, j] = np.searchsorted(thresholds, col, side='left')
+            codes[np.isnan(col), j] = MISSING_CODE
+        return codes
+
+
+def prebin_matrix(X, max_bins=MAX_BINS):
+    """
+    Bin a feature matrix once for all CV folds.
+
+    Returns:
+    tuple: (uint8 code matrix, fitted FeatureBinner)
+    """
+    binner = FeatureBinner(max_bins=max_bins).fit(X)
+    return binner.transform(X), binner
+
+
+def with_binner(binner, model):
+    """Pipeline that bins raw feature rows with a fitted binner before `model`, for predicting on unbinned data."""
+    return Pipeline([('bin', binner), ('model', model)])
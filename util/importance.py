@@ -0,0 +1,239 @@
+import os
+import sys
+import argparse
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from sklearn.inspection import permutation_importance
+from sklearn.metrics import accuracy_score
+
+from util.logging_util import get_logger, configure_logging, log_run_summary
+from util.feature_matrix import CATEGORICAL_FEATURES
+from util.pipeline import (PIPELINE_CACHE_DIR, load_pipeline_config, apply_overrides, run_pipeline, cached_stage,
+                           stage_key, stage_build_seconds, measure_untimed_stages, _read_pickle, _write_pickle)
+
+logger = get_logger("importance")
+
+# Shuffles per feature (and per family) in the permutation importance
+PERMUTATION_REPEATS = 10
+
+
+def column_families(cache_dir, keys):
+    """
+    {column: family} for the feature columns of the cached extract stages. A family is the
+    extractor that produced the column ('A', 'B', ..., plus 'Hair_Ratio').
+    """
+    family_of = {}
+    for stage, key in keys.items():
+        if stage == 'hair_removal':
+            family, path = 'Hair_Ratio', os.path.join(cache_dir, stage, key, "hair_ratio.pkl")
+        elif stage.startswith('extract.'):
+            family, path = stage.split('.', 1)[1], os.path.join(cache_dir, stage, key, "features.pkl")
+        else:
+            continue
+        for col in _read_pickle(path).columns:
+            if col != 'filename':
+                family_of.setdefault(col, family)
+    return family_of
+
+
+def feature_families(cache_dir, keys, feature_names):
+    """
+    {family: [column positions]} for the matrix columns (see column_families); one-hot
+    columns belong to the family of their categorical source column.
+    """
+    family_of = column_families(cache_dir, keys)
+    for source, prefix in CATEGORICAL_FEATURES.items():
+        if source in family_of:
+            for name in feature_names:
+                if name.startswith(f"{prefix}_"):
+                    family_of.setdefault(name, family_of[source])
+
+    families = {}
+    for j, name in enumerate(feature_names):
+        families.setdefault(family_of.get(name, 'other'), []).append(j)
+    return families
+
+
+def fold_importance(fold, model, X_test, y_test, feature_names, families, n_repeats, seed):
+    """
+    Impurity and permutation importance of one fold model on its held-out test part.
+
+    Permutation importance is computed per feature (sklearn) and per family: all columns
+    of a family are shuffled together, which measures what dropping the extractor would
+    cost even when its features are correlated with each other.
+
+    Returns:
+    tuple: (per-feature pd.DataFrame, per-family pd.DataFrame)
+    """
+    impurity = getattr(model, 'feature_importances_', np.full(len(feature_names), np.nan))
+    perm = permutation_importance(model, X_test, y_test, scoring='accuracy', n_repeats=n_repeats,
+                                  random_state=seed, n_jobs=1)
+    features_df = pd.DataFrame({
+        'fold': fold,
+        'feature': feature_names,
+        'impurity_importance': impurity,
+        'permutation_importance': perm.importances_mean,
+    })
+
+    rng = np.random.RandomState(seed)
+    base_accuracy = accuracy_score(y_test, model.predict(X_test))
+    rows = []
+    for family, cols in families.items():
+        drops = []
+        for _ in range(n_repeats):
+            shuffled = X_test.copy()
+            shuffled[:, cols] = X_test[rng.permutation(len(X_test))][:, cols]
+            drops.append(base_accuracy - accuracy_score(y_test, model.predict(shuffled)))
+        rows.append({'fold': fold, 'family': family, 'n_features': len(cols),
+                     'impurity_importance': float(np.sum(impurity[cols])),
+                     'permutation_drop': float(np.mean(drops))})
+    return features_df, pd.DataFrame(rows)
+
+
+def family_costs(cache_dir, keys, n_images):
+    """Extraction seconds per family from the build times kept with the cached stages."""
+    costs = {}
+    for stage, key in keys.items():
+        if stage == 'hair_removal':
+            family = 'Hair_Ratio'
+        elif stage.startswith('extract.'):
+            family = stage.split('.', 1)[1]
+        else:
+            continue
+        seconds = stage_build_seconds(cache_dir, stage, key)
+        costs[family] = {
+            'extraction_s': seconds if seconds is not None else np.nan,
+            'ms_per_image': seconds * 1000 / n_images if seconds is not None and n_images else np.nan,
+        }
+    return costs
+
+
+def run_importance(config, images_dir, labels_csv, output_dir, cache_dir=PIPELINE_CACHE_DIR,
+                   n_repeats=PERMUTATION_REPEATS, seed=42, n_jobs=-1):
+    """
+    Per-fold impurity and permutation importance of the pipeline's fold models, with the
+    extraction cost of every feature family next to it.
+
+    The pipeline runs first, so hair removal, the extractors, the matrix and the fold
+    models come from the stage cache when nothing changed (the cv stage keeps its fitted
+    models); the importance itself is a cached stage too. Folds are evaluated in parallel.
+
+    Costs are the build times of the extract stages (hair removal for 'Hair_Ratio'),
+    without one-off warm-ups such as the blue-veil LUT; stages cached without such a time
+    are rebuilt once to measure it. With
+    hair removal enabled every extractor also depends on it, so dropping only Hair_Ratio
+    saves nothing unless no extractor needs the hair-removed images.
+    `ms_per_accuracy_point` is the extraction time per image divided by the accuracy (in
+    percentage points) lost when the family is shuffled: high values (or families whose
+    shuffle does not lower accuracy) are the candidates for pruning.
+
+    Parameters:
+    config (dict): Pipeline config (see configs/).
+    images_dir (str): Folder with the original images.
+    labels_csv (str): Metadata CSV (dataset.csv).
+    output_dir (str): Where <name>_importance_features.csv and _families.csv are written.
+    cache_dir (str): Root of the stage cache.
+    n_repeats (int): Shuffles per feature / family.
+    seed (int): Seed of the shuffles.
+    n_jobs (int): Parallel fold evaluations (joblib; -1 = all cores).
+
+    Returns:
+    dict: 'features' and 'families' DataFrames.
+    """
+    if not labels_csv:
+        raise ValueError("Importance needs labels (labels_csv).")
+    name = config.get('name', 'pipeline')
+    pipeline_result = run_pipeline(config, images_dir, labels_csv, output_dir, cache_dir=cache_dir)
+    pipeline_result = measure_untimed_stages(config, images_dir, labels_csv, output_dir, cache_dir, pipeline_result)
+    keys = pipeline_result['keys']
+    if 'cv' not in keys:
+        raise RuntimeError("The pipeline did not reach the cv stage; nothing to analyse.")
+    models_path = os.path.join(cache_dir, 'cv', keys['cv'], "models.pkl")
+    if not os.path.exists(models_path):
+        # cv entry from before the fold models were kept
+        logger.info("Cached cv stage has no fold models; rebuilding it.")
+        pipeline_result = run_pipeline(config, images_dir, labels_csv, output_dir, cache_dir=cache_dir,
+                                       force_stages=('cv',))
+
+    x_all, y_all, _, feature_columns, _ = _read_pickle(os.path.join(cache_dir, 'matrix', keys['matrix'], "matrix.pkl"))
+    fold_models, cv_folds = _read_pickle(models_path)
+    families = feature_families(cache_dir, keys, feature_columns)
+    y = np.asarray(y_all)
+    status = {}
+    importance_key = stage_key('importance', keys['cv'], {'n_repeats': n_repeats, 'seed': seed})
+
+    def build_importance(stage_dir):
+        parts = Parallel(n_jobs=n_jobs)(
+            delayed(fold_importance)(fold, model, x_all[cv_folds[fold - 1].test], y[cv_folds[fold - 1].test],
+                                     feature_columns, families, n_repeats, seed)
+            for fold, model in sorted(fold_models.items()))
+        _write_pickle((pd.concat([p[0] for p in parts], ignore_index=True),
+                       pd.concat([p[1] for p in parts], ignore_index=True)),
+                      os.path.join(stage_dir, "importance.pkl"))
+
+    per_fold_features, per_fold_families = cached_stage(
+        cache_dir, 'importance', importance_key, build_importance,
+        lambda d: _read_pickle(os.path.join(d, "importance.pkl")), status)
+
+    family_of = {feature_columns[j]: family for family, cols in families.items() for j in cols}
+    features_df = (per_fold_features.groupby('feature', sort=False)
+                   .agg(impurity_mean=('impurity_importance', 'mean'), impurity_std=('impurity_importance', 'std'),
+                        permutation_mean=('permutation_importance', 'mean'),
+                        permutation_std=('permutation_importance', 'std'))
+                   .reset_index())
+    features_df.insert(1, 'family', features_df['feature'].map(family_of))
+    features_df = features_df.sort_values('permutation_mean', ascending=False).reset_index(drop=True)
+
+    families_df = (per_fold_families.groupby('family', sort=False)
+                   .agg(n_features=('n_features', 'first'), impurity_importance=('impurity_importance', 'mean'),
+                        permutation_drop_mean=('permutation_drop', 'mean'),
+                        permutation_drop_std=('permutation_drop', 'std'))
+                   .reset_index())
+    costs = family_costs(cache_dir, keys, len(x_all))
+    families_df['extraction_s'] = families_df['family'].map(lambda f: costs.get(f, {}).get('extraction_s', np.nan))
+    families_df['ms_per_image'] = families_df['family'].map(lambda f: costs.get(f, {}).get('ms_per_image', np.nan))
+    accuracy_points = families_df['permutation_drop_mean'] * 100
+    families_df['ms_per_accuracy_point'] = np.where(accuracy_points > 0,
+                                                    families_df['ms_per_image'] / accuracy_points.where(accuracy_points > 0),
+                                                    np.inf)
+    families_df = families_df.sort_values('ms_per_accuracy_point', ascending=False).reset_index(drop=True)
+
+    os.makedirs(output_dir, exist_ok=True)
+    features_path = os.path.join(output_dir, f"{name}_importance_features.csv")
+    families_path = os.path.join(output_dir, f"{name}_importance_families.csv")
+    features_df.to_csv(features_path, index=False)
+    families_df.to_csv(families_path, index=False)
+    logger.info("Feature families by cost per accuracy point:\n%s", families_df.to_string(index=False))
+    logger.info("Importance reports saved to %s and %s", features_path, families_path)
+    log_run_summary(logger, "Importance", folds=len(fold_models), features=len(features_df),
+                    families=len(families_df), importance_stage=status.get('importance'))
+    return {'features': features_df, 'families': families_df}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Impurity and permutation importance per fold, with extraction cost "
+                                                 "per feature family (run from the repository root: "
+                                                 "python -m util.importance baseline ...).")
+    parser.add_argument("config", help="Config JSON, or the name of one in configs/ (baseline, extended).")
+    parser.add_argument("--images", required=True, help="Folder with the original images.")
+    parser.add_argument("--labels", required=True, help="Metadata CSV, e.g. dataset.csv.")
+    parser.add_argument("--output-dir", required=True)
+    parser.add_argument("--cache-dir", default=PIPELINE_CACHE_DIR)
+    parser.add_argument("--set", dest="overrides", action="append", default=[], metavar="KEY=VALUE",
+                        help="Override a config value (see python -m util.pipeline --help).")
+    parser.add_argument("--repeats", type=int, default=PERMUTATION_REPEATS)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--jobs", type=int, default=-1, help="Parallel fold evaluations.")
+    args = parser.parse_args(argv)
+
+    configure_logging()
+    config = apply_overrides(load_pipeline_config(args.config), args.overrides)
+    run_importance(config, args.images, args.labels, args.output_dir, cache_dir=args.cache_dir,
+                   n_repeats=args.repeats, seed=args.seed, n_jobs=args.jobs)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,84 @@
+import cv2
+import numpy as np
+
+
+class IntegralImage:
+    """
+    Summed-area tables (sum and squared sum) of a grayscale image.
+
+    The image is reflect-padded by `pad` pixels before integration, so windows centred
+    near the border still cover `window x window` pixels. Every box sum is then four
+    table lookups, independent of the box size.
+    """
+
+    def __init__(self, gray, pad=0):
+        self.pad = pad
+        self.shape = gray.shape[:2]
+        if pad:
+            gray = cv2.copyMakeBorder(gray, pad, pad, pad, pad, cv2.BORDER_REFLECT_101)
+        self.sum, self.sqsum = cv2.integral2(gray, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+
+    def box_sums(self, y0, x0, y1, x1):
+        """
+        Sum and squared sum over [y0, y1) x [x0, x1), given in original-image coordinates.
+        Works on scalars or on broadcastable index arrays.
+        """
+        p = self.pad
+        y0, x0, y1, x1 = y0 + p, x0 + p, y1 + p, x1 + p
+        s = self.sum[y1, x1] - self.sum[y0, x1] - self.sum[y1, x0] + self.sum[y0, x0]
+        sq = self.sqsum[y1, x1] - self.sqsum[y0, x1] - self.sqsum[y1, x0] + self.sqsum[y0, x0]
+        return s, sq
+
+    def local_mean_var(self, window):
+        """
+        Mean and variance maps (same shape as the image) for a centred `window x window` box.
+        Needs pad >= window // 2.
+        """
+        r = window // 2
+        if r > self.pad:
+            raise ValueError(f"window {window} needs pad >= {r}, integral image was built with pad={self.pad}")
+        h, w = self.shape
+        p = self.pad
+        # Slices of the padded tables give every window's four corners at once
+        top, bottom = p - r, p + r + 1
+        left, right = p - r, p + r + 1
+        n = float(window * window)
+
+        def window_sums(table):
+            return (table[bottom:bottom + h, right:right + w] - table[top:top + h, right:right + w]
+                    - table[bottom:bottom + h, left:left + w] + table[top:top + h, left:left + w])
+
+        mean = window_sums(self.sum) / n
+        var = np.maximum(window_sums(self.sqsum) / n - mean ** 2, 0.0)
+        return mean, var
+
+
+def box_mean_std(integral, y0, x0, y1, x1):
+    """Mean and standard deviation of the pixels in a box (clipped to the image)."""
+    h, w = integral.shape
+    y0, x0 = max(0, y0), max(0, x0)
+    y1, x1 = min(h, y1), min(w, x1)
+    n = (y1 - y0) * (x1 - x0)
+    if n <= 0:
+        return np.nan, np.nan
+    s, sq = integral.box_sums(y0, x0, y1, x1)
+    mean = s / n
+    return mean, np.sqrt(max(sq / n - mean ** 2, 0.0))
+
+
+def ring_mean_std(integral, bbox, width):
+    """
+    Mean and standard deviation of the rectangular ring of `width` pixels around `bbox`
+    (y0, x0, y1, x1), as outer box minus inner box. The ring is clipped to the image.
+    """
+    h, w = integral.shape
+    y0, x0, y1, x1 = bbox
+    oy0, ox0 = max(0, y0 - width), max(0, x0 - width)
+    oy1, ox1 = min(h, y1 + width), min(w, x1 + width)
+    n = (oy1 - oy0) * (ox1 - ox0) - (y1 - y0) * (x1 - x0)
+    if n <= 0:
+        return np.nan, np.nan
+    s_out, sq_out = integral.box_sums(oy0, ox0, oy1, ox1)
+    s_in, sq_in = integral.box_sums(y0, x0, y1, x1)
+    mean = (s_out - s_in) / n
+    return mean, np.sqrt(max((sq_out - sq_in) / n - mean ** 2, 0.0))
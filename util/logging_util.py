@@ -0,0 +1,115 @@
+import os
+import json
+import logging
+from collections import Counter
+
+# All pipeline loggers live under this namespace so one call configures them together.
+ROOT_LOGGER_NAME = "fyp"
+
+_RESERVED_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class KeyValueFormatter(logging.Formatter):
+    """Plain-text formatter that appends any `extra={...}` fields as key=value pairs."""
+
+    def format(self, record):
+        base = super().format(record)
+        fields = {k: v for k, v in vars(record).items() if k not in _RESERVED_RECORD_ATTRS}
+        if not fields:
+            return base
+        return base + " | " + " ".join(f"{k}={v}" for k, v in fields.items())
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, for log aggregation."""
+
+    def format(self, record):
+        payload = {
+            'time': self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        payload.update({k: v for k, v in vars(record).items() if k not in _RESERVED_RECORD_ATTRS})
+        if record.exc_info:
+            payload['exception'] = self.formatException(record.exc_info)
+        return json.dumps(payload, default=str)
+
+
+def get_logger(name):
+    """Return a logger in the pipeline namespace, e.g. get_logger("feature_A") -> 'fyp.feature_A'."""
+    return logging.getLogger(f"{ROOT_LOGGER_NAME}.{name}")
+
+
+def configure_logging(verbosity=None, log_file=None, json_format=False):
+    """
+    Configure the pipeline loggers once, typically from a script's __main__ block.
+
+    Parameters:
+    verbosity (str or int or None): Level name/number; defaults to $FYP_LOG_LEVEL or INFO.
+    log_file (str or None): Optional file that receives the same records as the console.
+    json_format (bool): Emit JSON lines instead of plain text.
+    """
+    if verbosity is None:
+        verbosity = os.environ.get("FYP_LOG_LEVEL", "INFO")
+    level = logging.getLevelName(verbosity.upper()) if isinstance(verbosity, str) else verbosity
+
+    root = logging.getLogger(ROOT_LOGGER_NAME)
+    root.setLevel(level)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+
+    if json_format:
+        formatter = JsonFormatter()
+    else:
+        formatter = KeyValueFormatter("%(asctime)s %(levelname)-7s %(name)s: %(message)s", "%H:%M:%S")
+
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        os.makedirs(os.path.dirname(log_file) or '.', exist_ok=True)
+        handlers.append(logging.FileHandler(log_file))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+        root.addHandler(handler)
+    root.propagate = False
+    return root
+
+
+class ErrorSummary:
+    """
+    Rate-limited collector for per-file errors inside extraction loops.
+
+    The first `max_logged` errors are logged as warnings, the rest only at DEBUG level;
+    `log_summary()` then emits a single line with the totals per exception type.
+    """
+
+    def __init__(self, logger, stage, max_logged=5):
+        self.logger = logger
+        self.stage = stage
+        self.max_logged = max_logged
+        self.count = 0
+        self.by_type = Counter()
+        self.sample_files = []
+
+    def record(self, filename, error):
+        self.count += 1
+        self.by_type[type(error).__name__ if isinstance(error, BaseException) else str(error)] += 1
+        if len(self.sample_files) < self.max_logged:
+            self.sample_files.append(filename)
+        if self.count <= self.max_logged:
+            self.logger.warning("%s: error processing %s: %s", self.stage, filename, error)
+            if self.count == self.max_logged:
+                self.logger.warning("%s: further per-file errors are only logged at DEBUG level", self.stage)
+        else:
+            self.logger.debug("%s: error processing %s: %s", self.stage, filename, error)
+
+    def log_summary(self):
+        if self.count:
+            self.logger.warning("%s: %d file(s) failed (%s); first: %s", self.stage, self.count,
+                                ", ".join(f"{k}={v}" for k, v in self.by_type.items()),
+                                ", ".join(self.sample_files))
+
+
+def log_run_summary(logger, stage, **counts):
+    """Log one summary line for a stage; the counts are attached as structured fields."""
+    logger.info("%s summary", stage, extra={'stage': stage, **counts})
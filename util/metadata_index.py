@@ -0,0 +1,138 @@
+import os
+import pickle
+import hashlib
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from util.logging_util import get_logger
+from util.cache_util import CACHE_DIR
+
+logger = get_logger("metadata_index")
+
+# Index pickles sit directly in the shared cache directory
+METADATA_CACHE_DIR = CACHE_DIR
+
+# Bump when the index layout changes, so old cache files are ignored
+METADATA_INDEX_VERSION = 2
+
+CANCER_DIAGNOSES = ("BCC", "SCC", "MEL")
+LABEL_COLUMN = 'diagnostic'
+CATEGORICAL_METADATA_COLUMNS = ['region', 'gender', 'background_father', 'background_mother']
+# Answers stored as 'True' / 'False' / 'UNK' strings
+TRI_STATE_COLUMNS = ['itch', 'grew', 'hurt', 'changed', 'bleed', 'elevation']
+
+
+class MetadataIndex:
+    """
+    Typed, pre-processed view of the metadata CSV (dataset.csv), built once per CSV version.
+
+    - `frame`: one row per image with 'filename' (from img_id), 'real_label' (from
+      diagnostic), 'binary_target', pandas categoricals for the CATEGORICAL_METADATA_COLUMNS
+      and nullable booleans for the True/False/UNK answers.
+    - a filename -> row dictionary, so looking up a feature row costs one hash lookup.
+    - patient ids per file for grouped cross-validation.
+    """
+
+    def __init__(self, raw_df, source_hash=None):
+        df = raw_df.copy()
+        if 'img_id' in df.columns:
+            df = df.rename(columns={'img_id': 'filename'})
+        if 'filename' not in df.columns:
+            raise ValueError("Metadata CSV must contain 'filename' (or 'img_id') column.")
+        if LABEL_COLUMN in df.columns:
+            df = df.rename(columns={LABEL_COLUMN: 'real_label'})
+        if 'real_label' in df.columns:
+            df['binary_target'] = df['real_label'].isin(CANCER_DIAGNOSES).astype(np.int64)
+
+        for col in CATEGORICAL_METADATA_COLUMNS:
+            if col in df.columns:
+                df[col] = df[col].astype('category')
+        for col in TRI_STATE_COLUMNS:
+            if col in df.columns:
+                df[col] = df[col].astype(str).map({'True': True, 'False': False}).astype('boolean')
+
+        if df['filename'].duplicated().any():
+            logger.warning("Duplicate filenames in metadata; keeping the first occurrence.")
+            df = df.drop_duplicates(subset=['filename'], keep='first')
+        self.frame = df.reset_index(drop=True)
+        self.source_hash = source_hash
+        self.version = METADATA_INDEX_VERSION
+        self._row_of = {name: i for i, name in enumerate(self.frame['filename'])}
+
+    def __len__(self):
+        return len(self.frame)
+
+    def __contains__(self, filename):
+        return filename in self._row_of
+
+    def rows_for(self, filenames):
+        """Row positions for `filenames` (-1 where a file has no metadata)."""
+        row_of = self._row_of
+        return np.fromiter((row_of.get(name, -1) for name in filenames), dtype=np.int64, count=len(filenames))
+
+    def labels_frame(self):
+        """filename, real_label, binary_target: the columns the feature merge keeps."""
+        return self.frame[['filename', 'real_label', 'binary_target']].copy()
+
+    def patient_groups(self, filenames=None):
+        """
+        Patient id per file (for GroupKFold-style splits). Files without metadata get
+        their own file name as group, so they can never leak across folds with others.
+        """
+        if filenames is None:
+            return self.frame['patient_id'].to_numpy()
+        rows = self.rows_for(list(filenames))
+        patient_ids = self.frame['patient_id'].to_numpy()
+        return np.array([patient_ids[r] if r >= 0 else name for r, name in zip(rows, filenames)], dtype=object)
+
+
+def _file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+@lru_cache(maxsize=8)
+def _load_index(path, mtime_ns, size, cache_dir):
+    # mtime_ns and size are only part of the memo key: a changed CSV means a new entry
+    source_hash = _file_hash(path)
+    cache_path = os.path.join(cache_dir, f"metadata_{source_hash}_v{METADATA_INDEX_VERSION}.pkl") if cache_dir else None
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with open(cache_path, 'rb') as f:
+                index = pickle.load(f)
+            if getattr(index, 'version', None) == METADATA_INDEX_VERSION and index.source_hash == source_hash:
+                logger.debug("Loaded metadata index from cache %s", cache_path)
+                return index
+        except Exception as e:
+            logger.warning("Could not read metadata cache %s: %s. Rebuilding.", cache_path, e)
+
+    logger.info("Building metadata index for %s", path)
+    index = MetadataIndex(pd.read_csv(path), source_hash=source_hash)
+    if cache_path:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = cache_path + f".{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            logger.warning("Could not save metadata cache to %s: %s", cache_path, e)
+    return index
+
+
+def load_metadata_index(labels_csv, cache_dir=METADATA_CACHE_DIR):
+    """
+    Metadata index for `labels_csv`, built at most once per version of the file.
+
+    Within a process the index is memoised on (path, mtime, size); across processes it is
+    pickled in `cache_dir` under the SHA-256 of the CSV contents, so it is rebuilt only
+    when the CSV actually changes. Pass cache_dir=None to skip the disk cache.
+    """
+    path = os.path.abspath(labels_csv)
+    stat = os.stat(path)
+    return _load_index(path, stat.st_mtime_ns, stat.st_size, cache_dir)
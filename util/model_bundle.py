@@ -0,0 +1,80 @@
+import os
+
+import joblib
+import numpy as np
+import pandas as pd
+
+from util.feature_matrix import build_feature_matrix, CATEGORICAL_FEATURES
+
+
+def save_model_bundle(path, model, feature_names, impute_means, **metadata):
+    """
+    Save a fitted model together with everything needed to score new feature rows:
+    the matrix column order and the training column means used for imputation.
+
+    Parameters:
+    path (str): Output file (joblib).
+    model: Fitted classifier with predict_proba.
+    feature_names (list): Columns of the training matrix, in order.
+    impute_means (np.ndarray): Training column means (from impute_mean_inplace).
+    **metadata: Extra information stored alongside (e.g. model type, number of samples).
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    bundle = {
+        'model': model,
+        'feature_names': list(feature_names),
+        'impute_means': np.asarray(impute_means, dtype=np.float64),
+        'metadata': metadata,
+    }
+    joblib.dump(bundle, path)
+    return path
+
+
+def load_model_bundle(path):
+    """Load a bundle written by save_model_bundle."""
+    bundle = joblib.load(path)
+    if not isinstance(bundle, dict) or 'model' not in bundle or 'feature_names' not in bundle:
+        raise ValueError(f"{path} is not a model bundle written by save_model_bundle")
+    return bundle
+
+
+def bundle_feature_matrix(bundle, data_df):
+    """
+    Build the float32 matrix for `data_df` in the bundle's column order.
+
+    One-hot columns for categories that did not occur in `data_df` are 0, numeric columns
+    that are missing or NaN get the training mean.
+    """
+    feature_names = bundle['feature_names']
+    present = [col for col in data_df.columns if col != 'filename']
+    X, names = build_feature_matrix(data_df, present)
+    column_of = {name: j for j, name in enumerate(names)}
+    onehot_prefixes = set(CATEGORICAL_FEATURES.values())
+
+    out = np.empty((len(data_df), len(feature_names)), dtype=np.float32)
+    for j, name in enumerate(feature_names):
+        if name in column_of:
+            out[:, j] = X[:, column_of[name]]
+        else:
+            # Unseen one-hot columns mean "not this category"; anything else is unknown
+            out[:, j] = 0.0 if name.rsplit('_', 1)[0] in onehot_prefixes else np.nan
+    nan_rows, nan_cols = np.nonzero(np.isnan(out))
+    out[nan_rows, nan_cols] = bundle['impute_means'][nan_cols]
+    return out
+
+
+def score_dataframe(bundle, data_df, positive_label=1):
+    """
+    Score feature rows with a saved model.
+
+    Returns:
+    pd.DataFrame: filename, probability of the positive class and predicted label.
+    """
+    X = bundle_feature_matrix(bundle, data_df)
+    model = bundle['model']
+    proba = model.predict_proba(X)[:, list(model.classes_).index(positive_label)]
+    return pd.DataFrame({
+        'filename': data_df['filename'].to_numpy(),
+        'prob_cancer': proba,
+        'predicted_label': model.predict(X),
+    })
@@ -0,0 +1,770 @@
+import os
+import sys
+import json
+import copy
+import time
+import pickle
+import shutil
+import hashlib
+import argparse
+from functools import partial
+
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import RandomForestClassifier, HistGradientBoostingClassifier
+from sklearn.metrics import accuracy_score, confusion_matrix, classification_report
+
+from util.profiling import stage_timer, save_profile, reset_profile
+from util.logging_util import get_logger, configure_logging, log_run_summary
+from util.cache_util import CACHE_DIR
+from util.feature_matrix import build_feature_matrix, drop_all_nan_columns, impute_mean_inplace, matrix_memory_mb
+from util.hist_gbm import FeatureBinner, MAX_BINS, prebin_matrix, with_binner
+from util.metadata_index import load_metadata_index
+from util.cv_folds import get_cv_folds, max_grouped_splits, CV_GROUPINGS
+from util.feature_A import extract_asymmetry_features
+from util.feature_B import extract_border_features_from_folder, calculate_border_score
+from util.feature_C import extract_feature_C
+from util.contrast_feature import extract_feature_contrast
+from util.blue_veil import extract_feature_BV, build_bv_lut, BV_HSV_THRESHOLDS
+from util.hair_removal_feature import remove_hair_from_folder
+
+logger = get_logger("pipeline")
+
+CONFIG_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "configs")
+
+# Stage outputs live in <cache>/<stage>/<key>/, next to the other caches (BV LUT, metadata, folds)
+PIPELINE_CACHE_DIR = os.path.join(CACHE_DIR, "pipeline")
+
+# Bump when a stage's output changes for the same config, so old cache entries are not reused
+PIPELINE_VERSION = 2
+
+VALID_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+# Folder extractors by config name; each is called as func(folder_path=..., output_csv=None, visualize=False, **params)
+EXTRACTORS = {
+    "A": extract_asymmetry_features,
+    "B": extract_border_features_from_folder,
+    "C": extract_feature_C,
+    "Contrast": extract_feature_contrast,
+    "BV": extract_feature_BV,
+}
+
+# One-off setup of an extractor (e.g. the blue-veil LUT, seconds on a cold cache), done before
+# its stage is timed so the recorded build time is per-image work only
+EXTRACTOR_WARMUPS = {
+    "BV": lambda params: build_bv_lut(tuple(params.get('hsv_thresholds', BV_HSV_THRESHOLDS))),
+}
+
+# Stored in _TIMING.json; entries without it may include warm-up time and count as unmeasured
+TIMING_VERSION = 2
+
+# Model configs may set "prebin": true to train on uint8 bin codes computed once for all folds (util/hist_gbm.py)
+MODELS = {
+    "RandomForestClassifier": RandomForestClassifier,
+    "HistGradientBoostingClassifier": HistGradientBoostingClassifier,
+}
+
+CLASS_NAMES = ['non-cancer', 'cancer']
+CANCER_DIAGNOSES = ["BCC", "SCC", "MEL"]
+
+# Columns of the merged dataset that are labels, ids or clinical metadata rather than image features
+NON_FEATURE_COLUMNS = ['filename', 'real_label', 'binary_target', 'label', 'diagnostic',
+                       'patient_id', 'lesion_id', 'smoke', 'drink', 'background_father',
+                       'background_mother', 'age', 'pesticide', 'gender',
+                       'skin_cancer_history', 'cancer_history', 'has_piped_water',
+                       'has_sewage_system', 'fitspatrick', 'region', 'diameter_1',
+                       'diameter_2', 'itch', 'grew', 'hurt', 'changed', 'bleed',
+                       'elevation', 'biopsed', 'label_text_binary']
+
+# Intermediate columns of calculate_border_score that are not features
+_BORDER_HELPER_COLUMNS = ['sobel_mean_safe', 'avg_contour_perimeter_safe', 'laplacian_mean_safe', 'avg_contour_area_safe']
+
+
+# ---------------------------------------------------------------------------
+# Steps shared by main_baseline.py, main_extended.py and the config runner
+# ---------------------------------------------------------------------------
+
+def border_features(df_raw, compactness_mean=None):
+    """
+    Raw border measurements -> B features: adds border_score and drops the helper columns.
+    `compactness_mean` fixes the compactness normalisation (see calculate_border_score).
+    """
+    if df_raw.empty:
+        return pd.DataFrame(columns=['filename'])
+    df_B = calculate_border_score(df_raw, compactness_mean=compactness_mean)
+    return df_B.drop(columns=[col for col in _BORDER_HELPER_COLUMNS if col in df_B.columns])
+
+
+def load_labels_frame(labels_csv):
+    """filename, real_label, binary_target from the metadata CSV, or None if it is unusable."""
+    if not labels_csv or not os.path.exists(labels_csv):
+        logger.info("No metadata file provided or found. Proceeding without metadata.")
+        return None
+    logger.info("Loading metadata from %s", labels_csv)
+    try:
+        # Typed index, rebuilt only when the CSV changes (see util/metadata_index.py)
+        metadata_index = load_metadata_index(labels_csv)
+    except Exception as e:
+        logger.error("Error loading or processing metadata: %s", e)
+        return None
+    if 'real_label' not in metadata_index.frame.columns:
+        logger.error("Metadata CSV must contain 'filename' (or 'img_id') and 'diagnostic'. Metadata will not be used.")
+        return None
+    metadata_df = metadata_index.labels_frame()
+    logger.debug("Metadata selected. Shape: %s entries.", metadata_df.shape[0])
+    return metadata_df
+
+
+def merge_feature_frames(metadata_df, feature_dfs):
+    """
+    Inner-join the metadata and the feature DataFrames on 'filename', in the given order.
+
+    Frames that are empty or have no 'filename' column are skipped, and duplicate filenames
+    keep their first row, so the result has one row per image.
+
+    Parameters:
+    metadata_df (pd.DataFrame or None): Labels (first in the merge, so its row order is kept).
+    feature_dfs (dict): {name: DataFrame} of feature sets.
+
+    Returns:
+    pd.DataFrame: Merged dataset (empty if nothing could be merged).
+    """
+    frames = []
+    if metadata_df is not None and not metadata_df.empty and 'filename' in metadata_df.columns:
+        frames.append(('metadata', metadata_df))
+    else:
+        logger.warning("metadata_df is None, empty, or missing 'filename'. Not added to merge.")
+    for name, df in feature_dfs.items():
+        if df is not None and not df.empty and 'filename' in df.columns:
+            frames.append((name, df))
+        else:
+            logger.warning("df_%s is None, empty, or missing 'filename'. Not added to merge.", name)
+
+    if not frames:
+        logger.warning("No DataFrames to merge. Exiting feature creation.")
+        return pd.DataFrame()
+
+    final_df = None
+    for name, df in frames:
+        if df['filename'].duplicated().any():
+            logger.warning("Duplicate filenames found in df_%s. Keeping first occurrence.", name)
+            df = df.drop_duplicates(subset=['filename'], keep='first')
+        if final_df is None:
+            final_df = df
+            continue
+        final_df = pd.merge(final_df, df, on='filename', how='inner')
+        if final_df.empty:
+            logger.error("CRITICAL WARNING: DataFrame empty after merging with %s. This often means no common filenames or issues with filename consistency (e.g. '.jpg').", name)
+            break
+        logger.debug("Shape after merging with %s: %s", name, final_df.shape)
+
+    if final_df.empty:
+        logger.warning("Resulting merged DataFrame is empty.")
+    return final_df.reset_index(drop=True)
+
+
+def prepare_model_data(data_df):
+    """
+    Labels, float32 feature matrix and mean imputation for the CV loop.
+
+    'binary_target' is derived from 'real_label' (or 'diagnostic') if it is missing, rows
+    without a label are dropped, 'c_dominant_channel' is one-hot encoded and all-NaN
+    columns are removed.
+
+    Returns:
+    tuple or None: (x_all, y_all, filenames, feature_columns, impute_means), or None if
+                   the data cannot be used for training.
+    """
+    data_df = data_df.copy()
+    if 'binary_target' not in data_df.columns:
+        source_label_col = next((col for col in ['real_label', 'diagnostic'] if col in data_df.columns), None)
+        if source_label_col is None:
+            logger.error("CRITICAL ERROR: Target label column ('binary_target', 'real_label', or 'diagnostic') not found. Cannot proceed.")
+            return None
+        logger.info("Creating 'binary_target' from '%s'.", source_label_col)
+        data_df['binary_target'] = data_df[source_label_col].isin(CANCER_DIAGNOSES).astype(int)
+
+    data_df = data_df.dropna(subset=['binary_target'])
+    if data_df.empty:
+        logger.error("CRITICAL ERROR: Dataset empty after dropping NaNs in 'binary_target'.")
+        return None
+    data_df['label'] = data_df['binary_target'].astype(int)
+    logger.debug("Label distribution:\n%s", data_df['label'].value_counts(normalize=True))
+
+    feature_columns = [col for col in data_df.columns if col not in NON_FEATURE_COLUMNS]
+    if not feature_columns:
+        logger.error("CRITICAL ERROR: No feature columns identified after exclusions. Cannot train model.")
+        return None
+    logger.debug("Using %s feature columns. First 10: %s...", len(feature_columns), feature_columns[:10])
+
+    y_all = data_df["label"].reset_index(drop=True)
+    filenames = data_df['filename'].reset_index(drop=True)
+
+    # One float32 matrix for the whole CV loop: 'c_dominant_channel' is one-hot encoded here, once
+    x_all, feature_columns = build_feature_matrix(data_df, feature_columns)
+    x_all, feature_columns, all_nan_cols = drop_all_nan_columns(x_all, feature_columns)
+    if all_nan_cols:
+        logger.warning("Columns dropped due to all NaN: %s", all_nan_cols)
+        if not feature_columns:
+            logger.error("CRITICAL ERROR: All feature columns were dropped. Cannot train model.")
+            return None
+
+    with stage_timer("imputation"):
+        impute_means = impute_mean_inplace(x_all)
+    logger.debug("Feature matrix: %s %s, %.2f MB", x_all.shape, x_all.dtype, matrix_memory_mb(x_all))
+
+    if len(x_all) == 0 or y_all.nunique() < 2:
+        logger.warning("Skipping model training: Samples: %s, Unique Labels: %s", len(x_all), y_all.nunique())
+        return None
+    return x_all, y_all, filenames, feature_columns, impute_means
+
+
+def resolve_cv_folds(y_all, filenames, labels_csv=None, n_splits=5, seed=42, inner_val_size=0.25, grouping=None):
+    """
+    Cached CV folds, with n_splits reduced to what the smallest class (or, grouped, its
+    number of patients) allows.
+
+    Returns:
+    list or None: CVFold per outer fold, or None if no valid split exists.
+    """
+    if grouping not in CV_GROUPINGS:
+        raise ValueError(f"cv_grouping must be one of {CV_GROUPINGS}, got {grouping!r}")
+    min_class_count = y_all.value_counts().min()
+    if n_splits > min_class_count:
+        logger.warning("N_SPLITS (%s) is greater than the number of samples in the smallest class (%s).", n_splits, min_class_count)
+        logger.info("Reducing N_SPLITS to %s to allow stratified splitting.", min_class_count)
+        n_splits = min_class_count
+        if n_splits < 2:
+            logger.warning("Smallest class has less than 2 samples. Cannot perform K-Fold CV. Exiting model training.")
+            return None
+
+    # --- Patient-grouped CV: all images of a patient end up on the same side of every split ---
+    groups_all = None
+    if grouping == 'patient':
+        if not labels_csv or not os.path.exists(labels_csv):
+            logger.error("cv_grouping='patient' needs the metadata CSV with 'patient_id'. Exiting model training.")
+            return None
+        groups_all = load_metadata_index(labels_csv).patient_groups(filenames)
+        max_splits = max_grouped_splits(y_all, groups_all)
+        if n_splits > max_splits:
+            logger.warning("Only %s patients in the smallest class; reducing N_SPLITS from %s.", max_splits, n_splits)
+            n_splits = max_splits
+            if n_splits < 2:
+                logger.warning("Not enough patients per class for grouped CV. Exiting model training.")
+                return None
+        logger.info("Grouped CV over %s patients (%s images).", len(set(groups_all)), len(groups_all))
+
+    # Fold index arrays (outer folds and inner train/val splits) are computed once and cached,
+    # so every model and experiment on this data uses the same folds
+    return get_cv_folds(list(filenames), y_all.to_numpy(), groups=groups_all,
+                        n_splits=n_splits, seed=seed, inner_val_size=inner_val_size)
+
+
+def cv_matrix(x_all, model_config):
+    """
+    Matrix the CV loop trains on: x_all, or its uint8 bin codes (binned once, reused by
+    every fold) when the model config sets 'prebin'.
+
+    Returns:
+    tuple: (matrix, fitted FeatureBinner or None)
+    """
+    if not model_config.get('prebin'):
+        return x_all, None
+    with stage_timer("cv.prebin"):
+        codes, binner = prebin_matrix(x_all, max_bins=model_config.get('max_bins', MAX_BINS))
+    logger.debug("Pre-binned feature matrix: %s uint8, %.2f MB", codes.shape, matrix_memory_mb(codes))
+    return codes, binner
+
+
+def build_model(model_config):
+    """Unfitted estimator for `model_config` that takes the imputed feature matrix (binning included if 'prebin')."""
+    model = MODELS[model_config['type']](**model_config.get('params', {}))
+    if model_config.get('prebin'):
+        return with_binner(FeatureBinner(max_bins=model_config.get('max_bins', MAX_BINS)), model)
+    return model
+
+
+def _fold_predictions(fold_number, filenames_test, y_test, y_pred, y_proba):
+    predictions_df = pd.DataFrame({
+        'fold': fold_number,
+        'filename': filenames_test.reset_index(drop=True).values,
+        'true_label_encoded': y_test.reset_index(drop=True).values,
+        'predicted_label_encoded': y_pred,
+        'true_label_text': y_test.reset_index(drop=True).map({0: 'non-cancer', 1: 'cancer'}).values,
+        'predicted_label_text': pd.Series(y_pred).map({0: 'non-cancer', 1: 'cancer'}).values
+    })
+    if y_proba is not None and y_proba.shape[0] == len(filenames_test) and y_proba.shape[1] >= len(CLASS_NAMES):
+        predictions_df[f'proba_{CLASS_NAMES[0]}'] = y_proba[:, 0]
+        predictions_df[f'proba_{CLASS_NAMES[1]}'] = y_proba[:, 1]
+    else:
+        logger.warning("Fold %s Mismatch/Missing probability array for detailed predictions.", fold_number)
+        predictions_df[f'proba_{CLASS_NAMES[0]}'] = np.nan
+        predictions_df[f'proba_{CLASS_NAMES[1]}'] = np.nan
+    return predictions_df
+
+
+def run_cross_validation(x_all, y_all, filenames, cv_folds, model_class=RandomForestClassifier, model_params=None,
+                         model_name="RandomForestClassifier", fold_models=None):
+    """
+    Fit and evaluate one model per fold on precomputed folds.
+
+    Parameters:
+    x_all (np.ndarray): Imputed feature matrix.
+    y_all (pd.Series): Binary labels.
+    filenames (pd.Series): File name of every row.
+    cv_folds (list): CVFold objects (from resolve_cv_folds / get_cv_folds).
+    model_class: Classifier class; instantiated with model_params for every fold.
+    model_params (dict or None): Defaults to n_estimators=100, random_state=42, class_weight='balanced'.
+    model_name (str): Name written to the fold details.
+    fold_models (dict or None): If given, filled with {fold number: fitted model}.
+
+    Returns:
+    tuple: (list of per-fold metric dicts, pd.DataFrame of all test predictions)
+    """
+    if model_params is None:
+        model_params = {'n_estimators': 100, 'random_state': 42, 'class_weight': 'balanced'}
+    n_splits = len(cv_folds)
+    cm_labels = [0, 1]
+    fold_results_list = []
+    fold_predictions = []
+
+    logger.info("--- %s-FOLD CROSS-VALIDATION (%s) ---", n_splits, model_name)
+    for fold_num, fold in enumerate(cv_folds):
+        logger.debug("--- FOLD %s/%s ---", fold_num + 1, n_splits)
+        x_test_fold = x_all[fold.test]
+        y_test_fold = y_all.iloc[fold.test]
+        filenames_test_fold = filenames.iloc[fold.test]
+
+        if fold.train is None:
+            logger.error("Error during inner data splitting for fold %s. Skipping this fold.", fold_num + 1)
+            logger.debug("Class distribution in the dev part: \n%s", y_all.iloc[fold.dev].value_counts())
+            continue
+        x_train_inner, y_train_inner = x_all[fold.train], y_all.iloc[fold.train]
+        x_val_inner, y_val_inner = x_all[fold.val], y_all.iloc[fold.val]
+        logger.debug("Fold %s: Train_inner size: %s, Val_inner size: %s, Test_fold size: %s", fold_num + 1, len(x_train_inner), len(x_val_inner), len(x_test_fold))
+
+        if len(x_train_inner) == 0 or len(x_val_inner) == 0 or y_train_inner.nunique() < 2:
+            logger.warning("Fold %s: Training_inner or validation_inner set is empty or has insufficient classes. Skipping this fold.", fold_num + 1)
+            continue
+
+        try:
+            model_fold = model_class(**model_params)
+            with stage_timer("cv.train"):
+                model_fold.fit(x_train_inner, y_train_inner)
+            if fold_models is not None:
+                fold_models[fold_num + 1] = model_fold
+
+            val_acc_inner_fold = accuracy_score(y_val_inner, model_fold.predict(x_val_inner))
+            logger.debug("Fold %s - Inner Validation Accuracy: %.4f", fold_num + 1, val_acc_inner_fold)
+
+            with stage_timer("cv.predict"):
+                y_test_pred_fold = model_fold.predict(x_test_fold)
+                if hasattr(model_fold, "predict_proba"):
+                    y_test_pred_proba_fold = model_fold.predict_proba(x_test_fold)
+                else:
+                    logger.warning("Model %s in fold %s does not have predict_proba.", model_name, fold_num + 1)
+                    y_test_pred_proba_fold = np.zeros((len(y_test_pred_fold), len(CLASS_NAMES)))
+                    y_test_pred_proba_fold[np.arange(len(y_test_pred_fold)), y_test_pred_fold] = 1.0
+
+            test_acc_fold = accuracy_score(y_test_fold, y_test_pred_fold)
+            cls_report_dict_fold = classification_report(
+                y_test_fold, y_test_pred_fold, labels=cm_labels,
+                target_names=CLASS_NAMES, output_dict=True, zero_division=0
+            )
+            logger.info("Fold %s - Test Accuracy on test_fold: %.4f", fold_num + 1, test_acc_fold)
+            logger.debug("Fold %s - Confusion Matrix (test_fold):\n%s", fold_num + 1, confusion_matrix(y_test_fold, y_test_pred_fold, labels=cm_labels))
+
+            fold_summary = {
+                'fold': fold_num + 1,
+                'model_name': model_name,
+                'validation_accuracy_inner': val_acc_inner_fold,
+                'test_accuracy_fold': test_acc_fold,
+                'num_training_samples_inner': len(x_train_inner),
+                'num_validation_samples_inner': len(x_val_inner),
+                'num_test_samples_fold': len(x_test_fold),
+                'num_features_used': x_all.shape[1]
+            }
+            for class_label in CLASS_NAMES:
+                if class_label in cls_report_dict_fold:
+                    for metric in ['precision', 'recall', 'f1-score', 'support']:
+                        fold_summary[f'{class_label}_{metric}_test_fold'] = cls_report_dict_fold[class_label][metric]
+            for avg_type in ['macro avg', 'weighted avg']:
+                if avg_type in cls_report_dict_fold:
+                    for metric in ['precision', 'recall', 'f1-score']:
+                        fold_summary[f'{avg_type.replace(" ", "_")}_{metric}_test_fold'] = cls_report_dict_fold[avg_type][metric]
+            fold_results_list.append(fold_summary)
+            fold_predictions.append(_fold_predictions(fold_num + 1, filenames_test_fold, y_test_fold,
+                                                      y_test_pred_fold, y_test_pred_proba_fold))
+
+        except Exception as e_model_fold:
+            logger.error("Error during model training/evaluation for fold %s: %s", fold_num + 1, e_model_fold, exc_info=True)
+
+    predictions_df = pd.concat(fold_predictions, ignore_index=True) if fold_predictions else pd.DataFrame()
+    return fold_results_list, predictions_df
+
+
+def summarize_cv(fold_results_list, model_name="RandomForestClassifier"):
+    """
+    Mean/std (and totals for support) of every fold metric.
+
+    Returns:
+    tuple: (pd.DataFrame with one row per fold, dict of aggregated metrics)
+    """
+    cv_summary_df = pd.DataFrame(fold_results_list)
+    avg_metrics_summary = {
+        'model_type_fixed': model_name,
+        'num_folds_processed': len(cv_summary_df),
+        'num_features_used': cv_summary_df['num_features_used'].iloc[0] if not cv_summary_df.empty else 0
+    }
+
+    metrics_to_process = ['test_accuracy_fold', 'validation_accuracy_inner']
+    for cl_label in CLASS_NAMES:
+        for metric in ['precision', 'recall', 'f1-score', 'support']:
+            metrics_to_process.append(f'{cl_label}_{metric}_test_fold')
+    for avg_type in ['macro avg', 'weighted avg']:
+        for metric in ['precision', 'recall', 'f1-score']:
+            metrics_to_process.append(f'{avg_type.replace(" ", "_")}_{metric}_test_fold')
+
+    for metric_col in metrics_to_process:
+        if metric_col in cv_summary_df.columns:
+            base_metric_name = metric_col.replace('_test_fold', '').replace('_inner', '_inner_val')
+            if 'support' in metric_col:
+                avg_metrics_summary[f'total_{base_metric_name}'] = cv_summary_df[metric_col].sum()
+            avg_metrics_summary[f'mean_{base_metric_name}'] = cv_summary_df[metric_col].mean()
+            avg_metrics_summary[f'std_{base_metric_name}'] = cv_summary_df[metric_col].std()
+            logger.debug("Mean %s: %.4f +/- %.4f", base_metric_name, avg_metrics_summary[f'mean_{base_metric_name}'], avg_metrics_summary[f'std_{base_metric_name}'])
+
+    n_folds = len(fold_results_list)
+    logger.info("Overall Average Inner Validation Accuracy across %s folds: %.4f +/- %.4f", n_folds, avg_metrics_summary.get('mean_validation_accuracy_inner_val', np.nan), avg_metrics_summary.get('std_validation_accuracy_inner_val', np.nan))
+    logger.info("Overall Average Test Accuracy across %s folds: %.4f +/- %.4f", n_folds, avg_metrics_summary.get('mean_test_accuracy_fold', np.nan), avg_metrics_summary.get('std_test_accuracy_fold', np.nan))
+    log_run_summary(logger, "Cross-validation", folds=n_folds,
+                    mean_test_accuracy=round(float(avg_metrics_summary.get('mean_test_accuracy_fold', np.nan)), 4))
+    return cv_summary_df, avg_metrics_summary
+
+
+def save_cv_reports(result_path, cv_summary_df, predictions_df, avg_metrics_summary):
+    """Write <result>_CV_fold_details.csv, <result>_CV_all_predictions.csv and the aggregated result_path."""
+    result_dir = os.path.dirname(result_path)
+    result_base = os.path.splitext(os.path.basename(result_path))[0]
+    os.makedirs(result_dir or '.', exist_ok=True)
+
+    fold_details_csv_path = os.path.join(result_dir, f"{result_base}_CV_fold_details.csv")
+    cv_summary_df.to_csv(fold_details_csv_path, index=False)
+    logger.info("Detailed K-Fold CV results per fold saved to %s", fold_details_csv_path)
+
+    all_predictions_csv_path = os.path.join(result_dir, f"{result_base}_CV_all_predictions.csv")
+    predictions_df.to_csv(all_predictions_csv_path, index=False)
+    logger.info("All test predictions from K-Fold CV saved to %s", all_predictions_csv_path)
+
+    pd.DataFrame([avg_metrics_summary]).to_csv(result_path, index=False)
+    logger.info("Aggregated K-Fold CV summary report saved to %s", result_path)
+
+
+# ---------------------------------------------------------------------------
+# Config-driven runner with per-stage caching
+# ---------------------------------------------------------------------------
+
+def load_pipeline_config(name_or_path):
+    """Pipeline config from a JSON file, or by name from configs/ ('baseline', 'extended')."""
+    path = name_or_path if os.path.exists(name_or_path) else os.path.join(CONFIG_DIR, f"{name_or_path}.json")
+    with open(path) as f:
+        return json.load(f)
+
+
+def apply_overrides(config, overrides):
+    """
+    Copy of `config` with dotted-path overrides applied, e.g. "cv.n_splits=3" or
+    "extractors.C.normalize_colors=false". Values are parsed as JSON, falling back to strings.
+    """
+    config = copy.deepcopy(config)
+    for override in overrides or ():
+        path, sep, raw_value = override.partition('=')
+        if not sep:
+            raise ValueError(f"Override must look like key.path=value, got '{override}'")
+        try:
+            value = json.loads(raw_value)
+        except ValueError:
+            value = raw_value
+        *parents, leaf = path.split('.')
+        node = config
+        for key in parents:
+            if node.get(key) is None:
+                node[key] = {}
+            node = node[key]
+        node[leaf] = value
+    return config
+
+
+def stage_key(stage, *parts):
+    """Cache key of a stage: hash of its name, its own config and the keys of its inputs."""
+    payload = json.dumps([PIPELINE_VERSION, stage, *parts], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:20]
+
+
+def folder_fingerprint(folder):
+    """Hash of the image names, sizes and mtimes in `folder` (changes when any image does)."""
+    digest = hashlib.sha256()
+    with os.scandir(folder) as entries:
+        images = [entry for entry in entries if entry.is_file() and entry.name.lower().endswith(VALID_EXTENSIONS)]
+    for entry in sorted(images, key=lambda e: e.name):
+        stat = entry.stat()
+        digest.update(f"{entry.name}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode('utf-8'))
+    return digest.hexdigest()[:20]
+
+
+def _read_pickle(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def _write_pickle(obj, path):
+    with open(path, 'wb') as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def cached_stage(cache_dir, stage, key, build, load, status, force=False, warm_up=None):
+    """
+    Output of `stage` for `key`: loaded from <cache_dir>/<stage>/<key>/ if a complete
+    entry exists, else built there. `build(stage_dir)` writes the files and `load(stage_dir)`
+    reads them back. Entries are built in a temp folder and renamed, so an interrupted
+    run never leaves a half-written entry behind. The build time is kept with the entry
+    (see stage_build_seconds), so costs stay known when the stage is later cached;
+    `warm_up()`, if given, runs untimed before the build.
+    """
+    stage_dir = os.path.join(cache_dir, stage, key)
+    if not force and os.path.exists(os.path.join(stage_dir, "_SUCCESS")):
+        logger.info("Stage %s: cached (%s)", stage, key)
+        status[stage] = 'cached'
+        return load(stage_dir)
+
+    logger.info("Stage %s: running (%s)", stage, key)
+    if warm_up is not None:
+        # Before the temp folder exists, so a failing warm-up leaves nothing behind
+        warm_up()
+    tmp_dir = f"{stage_dir}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    try:
+        start = time.perf_counter()
+        with stage_timer(stage):
+            build(tmp_dir)
+        with open(os.path.join(tmp_dir, "_TIMING.json"), 'w') as f:
+            json.dump({'seconds': time.perf_counter() - start, 'version': TIMING_VERSION}, f)
+        open(os.path.join(tmp_dir, "_SUCCESS"), 'w').close()
+        shutil.rmtree(stage_dir, ignore_errors=True)
+        os.replace(tmp_dir, stage_dir)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    status[stage] = 'ran'
+    return load(stage_dir)
+
+
+def stage_build_seconds(cache_dir, stage, key):
+    """
+    Seconds it took to build a cached stage entry, or None if unknown: entries from before
+    timing was kept, or from before warm-ups were excluded (TIMING_VERSION).
+    """
+    try:
+        with open(os.path.join(cache_dir, stage, key, "_TIMING.json")) as f:
+            timing = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return timing.get('seconds') if timing.get('version') == TIMING_VERSION else None
+
+
+def measure_untimed_stages(config, images_dir, labels_csv, output_dir, cache_dir, pipeline_result):
+    """
+    Rebuild the hair removal / extract stages of a finished run_pipeline whose build time
+    is unknown (see stage_build_seconds), so their cost can be reported. Returns the
+    result of the new run, or `pipeline_result` itself if every stage was timed.
+    """
+    keys = pipeline_result['keys']
+    untimed = [stage for stage, key in keys.items()
+               if (stage == 'hair_removal' or stage.startswith('extract.'))
+               and stage_build_seconds(cache_dir, stage, key) is None]
+    if not untimed:
+        return pipeline_result
+    logger.info("No extraction time recorded for %s; rebuilding to measure it.", ", ".join(untimed))
+    return run_pipeline(config, images_dir, labels_csv, output_dir, cache_dir=cache_dir, force_stages=untimed)
+
+
+def run_pipeline(config, images_dir, labels_csv, output_dir, cache_dir=PIPELINE_CACHE_DIR, force_stages=()):
+    """
+    Run the stages named in `config`, reusing every stage whose inputs did not change.
+
+    Stages: hair_removal (optional) -> extract.<name> for every extractor -> merge (with
+    the metadata labels) -> matrix (feature matrix + imputation) -> cv -> report. Each
+    stage's key is the hash of its own config section and the keys of the stages it
+    reads, so e.g. changing one extractor's parameter reruns that extractor, merge,
+    matrix and cv, while hair removal and the other extractors come from the cache.
+
+    Parameters:
+    config (dict): Pipeline config (see configs/baseline.json and configs/extended.json).
+    images_dir (str): Folder with the original images.
+    labels_csv (str or None): Metadata CSV (dataset.csv); without it the run stops after merge.
+    output_dir (str): Where <name>_features.csv, <name>_evaluation*.csv and the profile go.
+    cache_dir (str): Root of the stage cache.
+    force_stages (iterable): Stage names to rebuild even if cached ('extract' means all extractors).
+
+    Returns:
+    dict: 'metrics' (aggregated CV metrics or None), 'stages' ({stage: 'ran' | 'cached'}),
+          'keys' ({stage: cache key}), 'features_csv' and 'result_path'.
+    """
+    if not os.path.isdir(images_dir):
+        raise FileNotFoundError(f"Original image directory not found: {images_dir}")
+    unknown = [name for name in config['extractors'] if name not in EXTRACTORS]
+    if unknown:
+        raise ValueError(f"Unknown extractor(s) {unknown}; available: {sorted(EXTRACTORS)}")
+    model_config = config['model']
+    if model_config['type'] not in MODELS:
+        raise ValueError(f"Unknown model type '{model_config['type']}'; available: {sorted(MODELS)}")
+
+    name = config.get('name', 'pipeline')
+    force_stages = set(force_stages)
+    status, keys = {}, {}
+    reset_profile()
+
+    def forced(stage):
+        return stage in force_stages or stage.split('.')[0] in force_stages
+
+    # --- Hair removal: its output folder replaces the image folder for every extractor ---
+    source_key = folder_fingerprint(images_dir)
+    feature_dir, hair_df, hair_key = images_dir, None, None
+    hair_config = config.get('hair_removal')
+    if hair_config:
+        hair_key = keys['hair_removal'] = stage_key('hair_removal', source_key, hair_config['params'])
+
+        def build_hair(stage_dir):
+            image_files = sorted(f for f in os.listdir(images_dir) if f.lower().endswith(VALID_EXTENSIONS))
+            df = remove_hair_from_folder(images_dir, os.path.join(stage_dir, "images"), image_files,
+                                         hair_config['params'])
+            _write_pickle(df, os.path.join(stage_dir, "hair_ratio.pkl"))
+
+        hair_df = cached_stage(cache_dir, 'hair_removal', hair_key, build_hair,
+                               lambda d: _read_pickle(os.path.join(d, "hair_ratio.pkl")), status,
+                               force=forced('hair_removal'))
+        feature_dir = os.path.join(cache_dir, 'hair_removal', hair_key, "images")
+        if not hair_config.get('hair_ratio_feature', True):
+            hair_df = None
+
+    # --- Feature extractors, one cached stage each ---
+    input_key = hair_key or source_key
+    feature_dfs, extract_keys = {}, []
+    if hair_df is not None:
+        feature_dfs['Hair_Ratio'] = hair_df
+        extract_keys.append(hair_key)
+    for extractor_name, params in config['extractors'].items():
+        stage = f"extract.{extractor_name}"
+        key = keys[stage] = stage_key(stage, input_key, params)
+
+        def build_extract(stage_dir, extractor_name=extractor_name, params=params):
+            df = EXTRACTORS[extractor_name](folder_path=feature_dir, output_csv=None, visualize=False, **params)
+            if extractor_name == "B":
+                df = border_features(df)
+            _write_pickle(df, os.path.join(stage_dir, "features.pkl"))
+
+        warm_up = partial(EXTRACTOR_WARMUPS[extractor_name], params) if extractor_name in EXTRACTOR_WARMUPS else None
+        feature_dfs[extractor_name] = cached_stage(cache_dir, stage, key, build_extract,
+                                                   lambda d: _read_pickle(os.path.join(d, "features.pkl")), status,
+                                                   force=forced(stage), warm_up=warm_up)
+        extract_keys.append(key)
+
+    # --- Merge with the labels ---
+    metadata_df = load_labels_frame(labels_csv)
+    labels_key = load_metadata_index(labels_csv).source_hash if metadata_df is not None else None
+    merge_key = keys['merge'] = stage_key('merge', labels_key, list(feature_dfs), extract_keys)
+
+    def build_merge(stage_dir):
+        _write_pickle(merge_feature_frames(metadata_df, feature_dfs), os.path.join(stage_dir, "merged.pkl"))
+
+    data_df = cached_stage(cache_dir, 'merge', merge_key, build_merge,
+                           lambda d: _read_pickle(os.path.join(d, "merged.pkl")), status, force=forced('merge'))
+
+    os.makedirs(output_dir, exist_ok=True)
+    features_csv = os.path.join(output_dir, f"{name}_features.csv")
+    result_path = os.path.join(output_dir, f"{name}_evaluation.csv")
+    data_df.to_csv(features_csv, index=False)
+    logger.info("Merged feature dataset (%d rows x %d columns) saved to %s", data_df.shape[0], data_df.shape[1], features_csv)
+    result = {'metrics': None, 'stages': status, 'keys': keys, 'features_csv': features_csv, 'result_path': result_path}
+    if data_df.empty or metadata_df is None:
+        logger.warning("No labelled rows; skipping the matrix, cv and report stages.")
+        return result
+
+    # --- Feature matrix and imputation ---
+    matrix_key = keys['matrix'] = stage_key('matrix', merge_key)
+
+    def build_matrix(stage_dir):
+        _write_pickle(prepare_model_data(data_df), os.path.join(stage_dir, "matrix.pkl"))
+
+    model_data = cached_stage(cache_dir, 'matrix', matrix_key, build_matrix,
+                              lambda d: _read_pickle(os.path.join(d, "matrix.pkl")), status, force=forced('matrix'))
+    if model_data is None:
+        return result
+    x_all, y_all, filenames, feature_columns, impute_means = model_data
+
+    # --- Cross-validation ---
+    cv_config = config['cv']
+    cv_key = keys['cv'] = stage_key('cv', matrix_key, cv_config, model_config,
+                                    labels_key if cv_config.get('grouping') else None)
+
+    def build_cv(stage_dir):
+        cv_folds = resolve_cv_folds(y_all, filenames, labels_csv, n_splits=cv_config['n_splits'], seed=cv_config['seed'],
+                                    inner_val_size=cv_config['inner_val_size'], grouping=cv_config.get('grouping'))
+        fold_results_list, predictions_df, fold_models = [], pd.DataFrame(), {}
+        if cv_folds is not None:
+            x_cv, binner = cv_matrix(x_all, model_config)
+            fold_results_list, predictions_df = run_cross_validation(
+                x_cv, y_all, filenames, cv_folds, model_class=MODELS[model_config['type']],
+                model_params=model_config.get('params', {}), model_name=model_config['name'],
+                fold_models=fold_models)
+            if binner is not None:
+                # Stored models take the imputed matrix like every other model
+                fold_models = {fold: with_binner(binner, model) for fold, model in fold_models.items()}
+        _write_pickle((fold_results_list, predictions_df), os.path.join(stage_dir, "cv.pkl"))
+        # Fitted fold models and their folds, for later analysis (util/importance.py)
+        _write_pickle((fold_models, cv_folds), os.path.join(stage_dir, "models.pkl"))
+
+    fold_results_list, predictions_df = cached_stage(cache_dir, 'cv', cv_key, build_cv,
+                                                     lambda d: _read_pickle(os.path.join(d, "cv.pkl")), status,
+                                                     force=forced('cv'))
+    if not fold_results_list:
+        logger.error("No folds were successfully processed. Cannot generate CV summary.")
+        return result
+
+    # --- Reporting (always written, it only reads the cached results) ---
+    with stage_timer("reporting"):
+        cv_summary_df, avg_metrics_summary = summarize_cv(fold_results_list, model_name=model_config['name'])
+        save_cv_reports(result_path, cv_summary_df, predictions_df, avg_metrics_summary)
+    save_profile(output_dir, prefix=f"{name}_profile")
+    status['report'] = 'ran'
+    log_run_summary(logger, "Pipeline", stages_run=sum(v == 'ran' for v in status.values()),
+                    stages_cached=sum(v == 'cached' for v in status.values()))
+    result['metrics'] = avg_metrics_summary
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the feature/CV pipeline from a config (run from the repository "
+                                                 "root: python -m util.pipeline configs/extended.json ...).")
+    parser.add_argument("config", help="Config JSON, or the name of one in configs/ (baseline, extended).")
+    parser.add_argument("--images", required=True, help="Folder with the original images.")
+    parser.add_argument("--labels", default=None, help="Metadata CSV, e.g. dataset.csv.")
+    parser.add_argument("--output-dir", required=True)
+    parser.add_argument("--cache-dir", default=PIPELINE_CACHE_DIR)
+    parser.add_argument("--set", dest="overrides", action="append", default=[], metavar="KEY=VALUE",
+                        help="Override a config value, e.g. --set cv.grouping='\"patient\"' or "
+                             "--set extractors.C.normalize_colors=false (repeatable).")
+    parser.add_argument("--force", action="append", default=[], metavar="STAGE",
+                        help="Rebuild a stage even if cached (hair_removal, extract, extract.B, merge, matrix, cv).")
+    args = parser.parse_args(argv)
+
+    configure_logging()
+    config = apply_overrides(load_pipeline_config(args.config), args.overrides)
+    result = run_pipeline(config, args.images, args.labels, args.output_dir, cache_dir=args.cache_dir,
+                          force_stages=args.force)
+    logger.info("Stages: %s", ", ".join(f"{stage}={state}" for stage, state in result['stages'].items()))
+    return 0 if result['metrics'] is not None else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,144 @@
+import os
+import json
+import time
+import cProfile
+import functools
+from collections import defaultdict
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+# Wall-clock durations (seconds) of every timed call, keyed by stage name.
+_stage_timings = defaultdict(list)
+
+# Optional cProfile collectors, one per stage name (only used when enabled).
+_stage_profilers = {}
+_cprofile_enabled = False
+_active_cprofile_stage = None
+
+
+def enable_cprofile(enabled=True):
+    """Turn per-stage cProfile collection on or off for subsequent timed stages."""
+    global _cprofile_enabled
+    _cprofile_enabled = enabled
+
+
+def cprofile_enabled():
+    """True if per-stage cProfile collection is on (it only works for one thread at a time)."""
+    return _cprofile_enabled
+
+
+def reset_profile():
+    """Forget all recorded timings and cProfile data."""
+    global _active_cprofile_stage
+    _stage_timings.clear()
+    _stage_profilers.clear()
+    _active_cprofile_stage = None
+
+
+@contextmanager
+def stage_timer(stage):
+    """
+    Context manager that records the wall-clock time spent inside the block under `stage`.
+
+    When cProfile collection is enabled, the outermost active stage is also profiled
+    (nested stages are only timed, since only one profiler can be active at a time).
+    """
+    global _active_cprofile_stage
+    profiler = None
+    if _cprofile_enabled and _active_cprofile_stage is None:
+        profiler = _stage_profilers.setdefault(stage, cProfile.Profile())
+        _active_cprofile_stage = stage
+        profiler.enable()
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        if profiler is not None:
+            profiler.disable()
+            _active_cprofile_stage = None
+        _stage_timings[stage].append(elapsed)
+
+
+def timed_stage(stage):
+    """Decorator version of `stage_timer`."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage_timer(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def pop_stage_timings():
+    """Return the recorded timings as a plain dict and forget them (e.g. to send them out of a worker process)."""
+    timings = {stage: list(durations) for stage, durations in _stage_timings.items()}
+    _stage_timings.clear()
+    return timings
+
+
+def merge_stage_timings(timings):
+    """Add timings recorded in another process (see pop_stage_timings) to this process's profile."""
+    for stage, durations in timings.items():
+        _stage_timings[stage].extend(durations)
+
+
+def get_profile_summary():
+    """
+    Aggregate the recorded timings per stage.
+
+    Returns:
+    pd.DataFrame: One row per stage with count, total, mean, p50, p95 and max (seconds),
+                  sorted by total time descending.
+    """
+    rows = []
+    for stage, durations in _stage_timings.items():
+        arr = np.asarray(durations, dtype=np.float64)
+        rows.append({
+            'stage': stage,
+            'count': int(arr.size),
+            'total_s': float(arr.sum()),
+            'mean_s': float(arr.mean()),
+            'p50_s': float(np.percentile(arr, 50)),
+            'p95_s': float(np.percentile(arr, 95)),
+            'max_s': float(arr.max()),
+        })
+    columns = ['stage', 'count', 'total_s', 'mean_s', 'p50_s', 'p95_s', 'max_s']
+    if not rows:
+        return pd.DataFrame(columns=columns)
+    return pd.DataFrame(rows, columns=columns).sort_values('total_s', ascending=False).reset_index(drop=True)
+
+
+def save_profile(output_dir, prefix="profile"):
+    """
+    Write the per-stage profile as JSON and CSV (and .prof dumps if cProfile was enabled).
+
+    Parameters:
+    output_dir (str): Directory to write into, typically next to the results CSV.
+    prefix (str): Base name for the output files.
+
+    Returns:
+    dict: Paths of the written files.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    summary_df = get_profile_summary()
+
+    csv_path = os.path.join(output_dir, f"{prefix}_stages.csv")
+    json_path = os.path.join(output_dir, f"{prefix}_stages.json")
+    summary_df.to_csv(csv_path, index=False)
+    with open(json_path, 'w') as f:
+        json.dump(summary_df.to_dict(orient='records'), f, indent=2)
+
+    written = {'csv': csv_path, 'json': json_path, 'cprofile': []}
+    if _stage_profilers:
+        prof_dir = os.path.join(output_dir, f"{prefix}_cprofile")
+        os.makedirs(prof_dir, exist_ok=True)
+        for stage, profiler in _stage_profilers.items():
+            prof_path = os.path.join(prof_dir, f"{stage.replace('/', '_')}.prof")
+            profiler.dump_stats(prof_path)
+            written['cprofile'].append(prof_path)
+    return written
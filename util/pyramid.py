@@ -0,0 +1,183 @@
+import os
+
+import cv2
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from util.profiling import stage_timer, timed_stage
+from util.logging_util import get_logger, ErrorSummary, log_run_summary
+from util.feature_A import asymmetry_features_from_image
+from util.feature_B import compute_border_features_batch, EMPTY_BORDER_FEATURES
+from util.feature_C import color_features_from_image, default_color_features
+
+logger = get_logger("pyramid")
+
+# Size every extractor resizes to in the normal (non-pyramid) mode
+BASE_SIZE = 256
+
+# Named per-feature scale choices; 'full' matches the normal mode's resolution
+PYRAMID_PRESETS = {
+    'full': {'A': 256, 'B': 256, 'C': 256},
+    'mixed': {'A': 128, 'B': 256, 'C': 64},
+    'half': {'A': 128, 'B': 128, 'C': 128},
+    'quarter': {'A': 64, 'B': 64, 'C': 64},
+}
+
+FEATURE_FAMILIES = ('A', 'B', 'C')
+
+
+def resolve_scales(scales):
+    """Accept a preset name or a {family: size} dict and validate the sizes."""
+    if isinstance(scales, str):
+        if scales not in PYRAMID_PRESETS:
+            raise ValueError(f"Unknown pyramid preset '{scales}'. Choose from {sorted(PYRAMID_PRESETS)}.")
+        scales = PYRAMID_PRESETS[scales]
+    if not scales:
+        raise ValueError("Pyramid scales must name at least one feature family.")
+    unknown = set(scales) - set(FEATURE_FAMILIES)
+    if unknown:
+        raise ValueError(f"Unknown feature families in pyramid scales: {sorted(unknown)}")
+    for family, size in scales.items():
+        level = np.log2(BASE_SIZE / size) if size > 0 else -1
+        if size > BASE_SIZE or level != int(level):
+            raise ValueError(f"Scale {size} for feature {family} must be {BASE_SIZE} divided by a power of two.")
+    return dict(scales)
+
+
+def build_pyramid(img, sizes, base_size=BASE_SIZE):
+    """
+    Gaussian pyramid of one image: resized once to base_size x base_size, then halved
+    with cv2.pyrDown until the smallest requested size.
+
+    Parameters:
+    img (np.ndarray): Decoded image (any size, BGR or grayscale).
+    sizes (iterable): Sizes that are needed (base_size divided by powers of two).
+    base_size (int): Side length of the finest level.
+
+    Returns:
+    dict: {size: image}
+    """
+    smallest = min(sizes)
+    level = cv2.resize(img, (base_size, base_size))
+    pyramid = {base_size: level}
+    size = base_size
+    while size > smallest:
+        level = cv2.pyrDown(level)
+        size //= 2
+        pyramid[size] = level
+    return pyramid
+
+
+VALID_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.bmp']
+
+
+def iter_folder_images(folder_path, errors=None, file_list=None):
+    """Yield (filename, BGR image) for the readable images in a folder (or only `file_list`)."""
+    image_files = [f for f in os.listdir(folder_path) if os.path.splitext(f)[1].lower() in VALID_EXTENSIONS]
+    if file_list is not None:
+        wanted = set(file_list)
+        image_files = [f for f in image_files if f in wanted]
+    for filename in image_files:
+        with stage_timer("Pyramid.decode"):
+            img_bgr = cv2.imread(os.path.join(folder_path, filename))
+        if img_bgr is None:
+            if errors is not None:
+                errors.record(filename, "unreadable image")
+            continue
+        yield filename, img_bgr
+
+
+@timed_stage("Pyramid.folder")
+def extract_features_pyramid(folder_path, scales='mixed', normalize_colors=True, border_batch_size=16, file_list=None):
+    """
+    Extract the A (asymmetry), B (border) and C (color) features with one decode and one
+    Gaussian pyramid per image, each family reading the pyramid level given in `scales`.
+
+    Parameters:
+    folder_path (str): Folder with the lesion images.
+    scales (str or dict): Preset name from PYRAMID_PRESETS or {family: size}.
+    normalize_colors (bool): Passed to the color features.
+    border_batch_size (int): Images per batch for the border filters.
+    file_list (list or None): Only process these file names, default all.
+
+    Returns:
+    dict: {'A': df, 'B': df, 'C': df} with the same columns as the per-folder extractors.
+    """
+    errors = ErrorSummary(logger, "Pyramid")
+    return extract_features_pyramid_from_images(iter_folder_images(folder_path, errors, file_list), scales=scales,
+                                                normalize_colors=normalize_colors,
+                                                border_batch_size=border_batch_size, errors=errors)
+
+
+def extract_features_pyramid_from_images(images, scales='mixed', normalize_colors=True, border_batch_size=16,
+                                         errors=None):
+    """
+    Same as extract_features_pyramid, but for already decoded images, e.g. streamed from
+    util.async_ingest without being written to disk.
+
+    Parameters:
+    images (iterable): (filename, BGR image) pairs.
+    scales (str or dict): Preset name from PYRAMID_PRESETS or {family: size}.
+    normalize_colors (bool): Passed to the color features.
+    border_batch_size (int): Images per batch for the border filters.
+    errors (ErrorSummary or None): Collector shared with the image source, if any.
+
+    Returns:
+    dict: {'A': df, 'B': df, 'C': df}
+    """
+    scales = resolve_scales(scales)
+    results = {family: [] for family in FEATURE_FAMILIES}
+    n_images = 0
+    if errors is None:
+        errors = ErrorSummary(logger, "Pyramid")
+    pending_border = []
+
+    def flush_border():
+        if not pending_border:
+            return
+        names = [name for name, _ in pending_border]
+        try:
+            for name, features in zip(names, compute_border_features_batch(np.stack([g for _, g in pending_border]))):
+                results['B'].append({'filename': name, **features})
+        except Exception as e:
+            for name in names:
+                errors.record(name, e)
+                results['B'].append({'filename': name, **EMPTY_BORDER_FEATURES})
+        pending_border.clear()
+
+    for filename, img_bgr in tqdm(images, desc=f"Extracting pyramid features {scales}"):
+        n_images += 1
+        try:
+            with stage_timer("Pyramid.build"):
+                pyramid = build_pyramid(img_bgr, scales.values())
+        except Exception as e:
+            errors.record(filename, e)
+            continue
+
+        if 'A' in scales:
+            try:
+                img_rgb = cv2.cvtColor(pyramid[scales['A']], cv2.COLOR_BGR2RGB)
+                results['A'].append({'filename': filename, **asymmetry_features_from_image(img_rgb)})
+            except Exception as e:
+                errors.record(filename, e)
+
+        if 'B' in scales:
+            pending_border.append((filename, cv2.cvtColor(pyramid[scales['B']], cv2.COLOR_BGR2GRAY)))
+            if len(pending_border) >= border_batch_size:
+                flush_border()
+
+        if 'C' in scales:
+            try:
+                img_rgb = cv2.cvtColor(pyramid[scales['C']], cv2.COLOR_BGR2RGB)
+                features, _ = color_features_from_image(img_rgb, normalize_colors=normalize_colors)
+                results['C'].append({'filename': filename, **(features if features is not None else default_color_features())})
+            except Exception as e:
+                errors.record(filename, e)
+                results['C'].append({'filename': filename, **default_color_features()})
+    flush_border()
+
+    errors.log_summary()
+    log_run_summary(logger, "Pyramid", images=n_images, errors=errors.count,
+                    **{f"scale_{family}": size for family, size in scales.items()})
+    return {family: pd.DataFrame(rows) for family, rows in results.items()}
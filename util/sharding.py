@@ -0,0 +1,200 @@
+import os
+import re
+import sys
+import glob
+import hashlib
+import argparse
+
+import pandas as pd
+
+from util.logging_util import get_logger, configure_logging, log_run_summary
+from util.feature_B import calculate_border_score
+from util.checkpoint import write_csv_atomic
+
+logger = get_logger("sharding")
+
+# Raw border columns calculate_border_score needs
+BORDER_SCORE_INPUTS = ['sobel_mean', 'sobel_std', 'laplacian_mean', 'laplacian_std',
+                       'avg_contour_perimeter', 'contour_perimeter_std', 'avg_contour_area']
+
+# Partial feature files are named <base>.shard-<index>-of-<count>.csv next to the final CSV
+_SHARD_SUFFIX = ".shard-{index:05d}-of-{count:05d}"
+_SHARD_FILE_RE = re.compile(r"\.shard-(\d{5})-of-(\d{5})\.csv$")
+
+
+def parse_shard(spec):
+    """
+    Parse a shard spec: "3/16", (3, 16) or None (no sharding).
+
+    Returns:
+    tuple or None: (index, count) with 0 <= index < count.
+    """
+    if spec is None:
+        return None
+    if isinstance(spec, str):
+        try:
+            index, count = (int(part) for part in spec.split('/'))
+        except ValueError:
+            raise ValueError(f"Shard spec must look like 'index/count', got '{spec}'")
+    else:
+        index, count = spec
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Invalid shard {index}/{count}: need 0 <= index < count")
+    return index, count
+
+
+def shard_of(filename, count):
+    """
+    Shard a file belongs to. Uses a hash of the file name (not Python's salted hash()),
+    so every node computes the same assignment.
+    """
+    digest = hashlib.blake2b(os.path.basename(filename).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % count
+
+
+def select_shard(filenames, shard):
+    """Keep the file names that belong to `shard` ((index, count) or None for all)."""
+    shard = parse_shard(shard)
+    if shard is None:
+        return list(filenames)
+    index, count = shard
+    return [f for f in filenames if shard_of(f, count) == index]
+
+
+def shard_suffix(shard):
+    index, count = parse_shard(shard)
+    return _SHARD_SUFFIX.format(index=index, count=count)
+
+
+def shard_output_path(output_csv_path, shard):
+    """Partial feature file of `shard` for the final CSV `output_csv_path`."""
+    base, ext = os.path.splitext(output_csv_path)
+    return base + shard_suffix(shard) + (ext or ".csv")
+
+
+def find_shard_files(output_csv_path):
+    """{(index, count): path} of the partial files written for `output_csv_path`."""
+    base, _ = os.path.splitext(output_csv_path)
+    found = {}
+    for path in glob.glob(glob.escape(base) + ".shard-*-of-*.csv"):
+        match = _SHARD_FILE_RE.search(path)
+        if match:
+            found[(int(match.group(1)), int(match.group(2)))] = path
+    return found
+
+
+def merge_shards(output_csv_path, dataset_csv=None, allow_missing_shards=False):
+    """
+    Combine the partial feature files of all shards into `output_csv_path`.
+
+    Duplicate filenames (e.g. a shard that was re-run after a node failure wrote the same
+    rows twice) keep their first row. border_score is normalised over the rows it is
+    computed on, so it is recomputed over the merged rows to match a single-node run.
+    Coverage is validated: all shards of the
+    count must be present, and with `dataset_csv` every image listed there (img_id or
+    filename column) should have a row.
+
+    Parameters:
+    output_csv_path (str): Final merged CSV; the shards are found next to it.
+    dataset_csv (str or None): Metadata CSV to check coverage against.
+    allow_missing_shards (bool): Merge even if some shard files are missing.
+
+    Returns:
+    dict: Merge report (shards, rows, duplicates, missing shard indices, missing/extra images).
+    """
+    shard_files = find_shard_files(output_csv_path)
+    if not shard_files:
+        raise FileNotFoundError(f"No shard files found for {output_csv_path}")
+    counts = {count for _, count in shard_files}
+    if len(counts) > 1:
+        raise ValueError(f"Shard files from different shard counts found: {sorted(counts)}. Remove stale shards first.")
+    count = counts.pop()
+    missing_shards = sorted(set(range(count)) - {index for index, _ in shard_files})
+    if missing_shards and not allow_missing_shards:
+        raise ValueError(f"Missing shard(s) {missing_shards} of {count}")
+
+    frames = [pd.read_csv(shard_files[key]) for key in sorted(shard_files)]
+    merged_df = pd.concat(frames, ignore_index=True, sort=False)
+    n_duplicates = int(merged_df['filename'].duplicated().sum())
+    if n_duplicates:
+        logger.warning("Dropping %d duplicate filename row(s) while merging shards.", n_duplicates)
+        merged_df = merged_df.drop_duplicates(subset=['filename'], keep='first').reset_index(drop=True)
+
+    if 'border_score' in merged_df.columns and set(BORDER_SCORE_INPUTS) <= set(merged_df.columns):
+        merged_df['border_score'] = calculate_border_score(merged_df)['border_score']
+
+    # A shard assigned a file it should not own points to a count mismatch between nodes
+    misplaced = sum(int((frame['filename'].map(lambda f: shard_of(f, count)) != index).sum())
+                    for (index, _), frame in zip(sorted(shard_files), frames))
+    if misplaced:
+        logger.warning("%d row(s) are in a shard they do not hash to.", misplaced)
+
+    report = {
+        'shards': len(shard_files),
+        'shard_count': count,
+        'missing_shards': missing_shards,
+        'rows': len(merged_df),
+        'duplicates_dropped': n_duplicates,
+        'misplaced_rows': misplaced,
+    }
+    if dataset_csv:
+        expected_df = pd.read_csv(dataset_csv)
+        id_col = 'img_id' if 'img_id' in expected_df.columns else 'filename'
+        expected = set(expected_df[id_col].dropna())
+        present = set(merged_df['filename'])
+        missing = sorted(expected - present)
+        report['expected_images'] = len(expected)
+        report['missing_images'] = missing
+        report['extra_images'] = sorted(present - expected)
+        if missing:
+            logger.warning("%d of %d images in %s have no features, e.g. %s", len(missing), len(expected),
+                           dataset_csv, missing[:5])
+
+    write_csv_atomic(merged_df, output_csv_path)
+    log_run_summary(logger, "Shard merge", **{k: (len(v) if isinstance(v, list) else v) for k, v in report.items()})
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sharded feature extraction (run from the repository root: "
+                                                 "python -m util.sharding extract|merge ...).")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    extract = commands.add_parser("extract", help="Extract the features of one shard on this node.")
+    extract.add_argument("--pipeline", choices=["baseline", "extended"], default="extended")
+    extract.add_argument("--images", required=True, help="Image folder on the shared filesystem.")
+    extract.add_argument("--labels", default=None, help="Metadata CSV (labels), e.g. dataset.csv.")
+    extract.add_argument("--output", required=True, help="Final feature CSV; the shard file is written next to it.")
+    extract.add_argument("--shard", required=True, help="index/count, e.g. 3/16.")
+    extract.add_argument("--image-timeout", type=float, default=None,
+                         help="Seconds per image before a stage task is killed (extended pipeline; runs stages "
+                              "in worker processes). A restarted job resumes from its checkpoint either way.")
+
+    merge = commands.add_parser("merge", help="Combine the shard files and check coverage.")
+    merge.add_argument("output_csv", help="Final feature CSV; shard files are <name>.shard-XXXXX-of-YYYYY.csv next to it.")
+    merge.add_argument("--dataset", default=None, help="Metadata CSV to validate coverage against.")
+    merge.add_argument("--allow-missing-shards", action="store_true")
+    merge.add_argument("--strict", action="store_true", help="Exit with an error if any image is missing.")
+    args = parser.parse_args(argv)
+
+    configure_logging()
+    if args.command == "extract":
+        if args.pipeline == "extended":
+            import main_extended
+            main_extended.create_feature_dataset(args.images, None, args.output, labels_csv=args.labels,
+                                                 recreate_features=True, shard=parse_shard(args.shard),
+                                                 image_timeout=args.image_timeout)
+        else:
+            import main_baseline
+            main_baseline.create_feature_dataset(args.images, None, args.output, labels_csv=args.labels,
+                                                 shard=parse_shard(args.shard))
+        return 0
+
+    report = merge_shards(args.output_csv, dataset_csv=args.dataset, allow_missing_shards=args.allow_missing_shards)
+    if args.strict and report.get('missing_images'):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,357 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import joblib
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+from util.logging_util import get_logger, configure_logging, log_run_summary
+from util.feature_matrix import build_feature_matrix, drop_all_nan_columns, impute_mean_inplace
+from util.model_bundle import bundle_feature_matrix
+from util.feature_B import border_compactness
+from util.pipeline import NON_FEATURE_COLUMNS
+
+logger = get_logger("similar_cases")
+
+# Points per KD-tree leaf (scipy's default is 16)
+INDEX_LEAF_SIZE = 16
+
+# Inserted rows are searched by brute force until there are this many (or this fraction of
+# the tree size, whichever is larger); then the tree is rebuilt over all rows
+MIN_REBUILD_ROWS = 256
+REBUILD_FRACTION = 0.1
+
+# Columns of the feature table shown next to each similar case
+INFO_COLUMNS = ['real_label', 'diagnostic', 'binary_target', 'patient_id', 'lesion_id']
+
+
+class SimilarCaseIndex:
+    """
+    Nearest-neighbour index over the standardized feature vectors of past lesions, for
+    "show similar past lesions" and KNN-style lookups.
+
+    Vectors are built like the model bundles (util/model_bundle.py): same matrix columns,
+    missing values get the archive mean, then each column is standardized with the mean
+    and std of the archive the index was built from. The vectors live in a scipy cKDTree;
+    rows inserted later are kept in a small buffer that queries search by brute force,
+    until the buffer is large enough to rebuild the tree. Re-inserting a filename replaces
+    its old row. `eps` > 0 makes the tree search approximate (every returned neighbour is
+    within (1 + eps) of the true k-th distance) and faster; recall_benchmark measures what
+    that costs against exact search.
+
+    Parameters:
+    feature_names (list): Matrix columns, in order.
+    impute_means (np.ndarray): Value used for a missing feature.
+    center (np.ndarray): Column means for standardization.
+    scale (np.ndarray): Column stds for standardization (zeros are treated as 1).
+    leaf_size (int): KD-tree leaf size.
+    """
+
+    def __init__(self, feature_names, impute_means, center, scale, leaf_size=INDEX_LEAF_SIZE):
+        self.feature_names = list(feature_names)
+        self.impute_means = np.asarray(impute_means, dtype=np.float64)
+        self.center = np.asarray(center, dtype=np.float64)
+        scale = np.asarray(scale, dtype=np.float64)
+        self.scale = np.where(scale > 0, scale, 1.0)
+        self.leaf_size = leaf_size
+        self._vectors = np.empty((0, len(self.feature_names)), dtype=np.float64)
+        self._info = pd.DataFrame(columns=['filename'])
+        self._alive = np.empty(0, dtype=bool)
+        self._row_of = {}
+        self._tree = None
+        self._tree_rows = 0
+        self.compactness_mean = None
+
+    @classmethod
+    def from_feature_table(cls, data_df, leaf_size=INDEX_LEAF_SIZE):
+        """Index every row of a merged feature table (e.g. a main_extended.py features CSV)."""
+        feature_columns = [col for col in data_df.columns if col not in NON_FEATURE_COLUMNS]
+        X, names = build_feature_matrix(data_df, feature_columns)
+        X, names, _ = drop_all_nan_columns(X, names)
+        means = impute_mean_inplace(X)
+        index = cls(names, means, X.mean(axis=0, dtype=np.float64), X.std(axis=0, dtype=np.float64),
+                    leaf_size=leaf_size)
+        if {'avg_contour_perimeter', 'avg_contour_area'} <= set(data_df.columns):
+            # Query images are extracted a few at a time; their border_score needs the archive's mean
+            index.compactness_mean = float(border_compactness(data_df).mean())
+        index.insert(data_df)
+        index.rebuild()
+        return index
+
+    def __len__(self):
+        return int(self._alive.sum())
+
+    @property
+    def pending(self):
+        """Rows inserted since the last rebuild (searched by brute force)."""
+        return len(self._alive) - self._tree_rows
+
+    def transform(self, data_df):
+        """Standardized float64 vectors of feature rows, in the index's column order."""
+        X = bundle_feature_matrix({'feature_names': self.feature_names, 'impute_means': self.impute_means}, data_df)
+        return (X.astype(np.float64) - self.center) / self.scale
+
+    def insert(self, data_df):
+        """Add (or replace, by filename) feature rows; rebuilds the tree when the buffer is full."""
+        if data_df is None or data_df.empty:
+            return
+        data_df = data_df.drop_duplicates(subset=['filename'], keep='last')
+        vectors = self.transform(data_df)
+        info = data_df[['filename'] + [col for col in INFO_COLUMNS if col in data_df.columns]].reset_index(drop=True)
+        for filename in info['filename']:
+            old_row = self._row_of.get(filename)
+            if old_row is not None:
+                self._alive[old_row] = False
+        first_row = len(self._alive)
+        self._vectors = np.vstack([self._vectors, vectors])
+        self._info = pd.concat([self._info, info], ignore_index=True) if len(self._info) else info
+        self._alive = np.concatenate([self._alive, np.ones(len(info), dtype=bool)])
+        self._row_of.update({filename: first_row + i for i, filename in enumerate(info['filename'])})
+        if self.pending > max(MIN_REBUILD_ROWS, REBUILD_FRACTION * self._tree_rows):
+            self.rebuild()
+
+    def rebuild(self):
+        """Drop replaced rows and build the KD-tree over all rows."""
+        if not self._alive.all():
+            keep = self._alive
+            self._vectors = self._vectors[keep]
+            self._info = self._info[keep].reset_index(drop=True)
+            self._alive = np.ones(len(self._vectors), dtype=bool)
+            self._row_of = {filename: i for i, filename in enumerate(self._info['filename'])}
+        self._tree = cKDTree(self._vectors, leafsize=self.leaf_size) if len(self._vectors) else None
+        self._tree_rows = len(self._vectors)
+        logger.debug("Rebuilt the similar-case index over %d rows", self._tree_rows)
+
+    def query_vectors(self, Q, k=5, eps=0.0):
+        """
+        k nearest indexed rows of each standardized vector in Q.
+
+        Returns:
+        tuple: (distances (m, k), row numbers (m, k)); missing neighbours are inf / -1.
+        """
+        Q = np.atleast_2d(np.asarray(Q, dtype=np.float64))
+        parts_d, parts_i = [], []
+        if self._tree is not None:
+            # Ask for extra neighbours to make up for replaced rows that are still in the tree
+            n_dead = self._tree_rows - int(self._alive[:self._tree_rows].sum())
+            kk = min(k + n_dead, self._tree_rows)
+            d, i = self._tree.query(Q, k=kk, eps=eps)
+            d, i = d.reshape(len(Q), kk), i.reshape(len(Q), kk)
+            valid = i < self._tree_rows
+            i = np.where(valid, i, 0)
+            d = np.where(valid & self._alive[i], d, np.inf)
+            parts_d.append(d)
+            parts_i.append(i)
+        if self.pending:
+            rows = self._tree_rows + np.flatnonzero(self._alive[self._tree_rows:])
+            if len(rows):
+                parts_d.append(_euclidean(Q, self._vectors[rows]))
+                parts_i.append(np.broadcast_to(rows, (len(Q), len(rows))))
+        if not parts_d:
+            return np.full((len(Q), k), np.inf), np.full((len(Q), k), -1)
+        d, i = np.hstack(parts_d), np.hstack(parts_i)
+        if d.shape[1] < k:
+            d = np.hstack([d, np.full((len(Q), k - d.shape[1]), np.inf)])
+            i = np.hstack([i, np.zeros((len(Q), k - i.shape[1]), dtype=i.dtype)])
+        order = np.argsort(d, axis=1, kind='stable')[:, :k]
+        d, i = np.take_along_axis(d, order, axis=1), np.take_along_axis(i, order, axis=1)
+        return d, np.where(np.isinf(d), -1, i)
+
+    def exact_query_vectors(self, Q, k=5):
+        """Brute-force k nearest rows (the reference for recall_benchmark)."""
+        Q = np.atleast_2d(np.asarray(Q, dtype=np.float64))
+        rows = np.flatnonzero(self._alive)
+        d = _euclidean(Q, self._vectors[rows])
+        k = min(k, len(rows))
+        part = np.argpartition(d, k - 1, axis=1)[:, :k] if k < len(rows) else np.tile(np.arange(len(rows)), (len(Q), 1))
+        part_d = np.take_along_axis(d, part, axis=1)
+        order = np.argsort(part_d, axis=1, kind='stable')
+        return np.take_along_axis(part_d, order, axis=1), rows[np.take_along_axis(part, order, axis=1)]
+
+    def query(self, data_df, k=5, eps=0.0, exclude_self=True):
+        """
+        Similar past cases for feature rows.
+
+        Parameters:
+        data_df (pd.DataFrame): Feature rows with 'filename' (e.g. from watch_mode.extract_batch_features).
+        k (int): Neighbours per row.
+        eps (float): Approximation factor (0 = exact).
+        exclude_self (bool): Skip an indexed row with the same filename as the query.
+
+        Returns:
+        pd.DataFrame: query, rank, filename, distance and the INFO_COLUMNS of each neighbour.
+        """
+        extra = 1 if exclude_self else 0
+        distances, rows = self.query_vectors(self.transform(data_df), k=k + extra, eps=eps)
+        records = []
+        info = self._info.to_dict('records')
+        for query_name, d_row, i_row in zip(data_df['filename'], distances, rows):
+            rank = 0
+            for distance, row in zip(d_row, i_row):
+                if row < 0 or rank == k:
+                    break
+                if exclude_self and info[row]['filename'] == query_name:
+                    continue
+                rank += 1
+                records.append({'query': query_name, 'rank': rank, **info[row], 'distance': float(distance)})
+        return pd.DataFrame(records)
+
+    def save(self, path):
+        """Persist the index (joblib)."""
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        joblib.dump(self, path)
+        return path
+
+    @classmethod
+    def load(cls, path):
+        index = joblib.load(path)
+        if not isinstance(index, cls):
+            raise ValueError(f"{path} is not a similar-case index written by SimilarCaseIndex.save")
+        return index
+
+
+def _euclidean(Q, V):
+    """Pairwise Euclidean distances between the rows of Q and V."""
+    sq = (Q ** 2).sum(axis=1)[:, None] + (V ** 2).sum(axis=1)[None, :] - 2.0 * (Q @ V.T)
+    return np.sqrt(np.maximum(sq, 0.0))
+
+
+def recall_benchmark(index, Q, k=5, eps_values=(0.0, 0.5, 1.0, 2.0)):
+    """
+    Recall@k and per-query latency of the KD-tree (exact and approximate) against brute
+    force. Queries run one at a time, as for an interactive lookup. Use queries that are
+    not in the index (nor near-copies of indexed rows): a query with a twin in the index
+    lets the tree stop almost at once and overstates its speed.
+
+    Returns:
+    pd.DataFrame: One row per method with recall_at_k, p50/p95/mean ms per query and the
+                  p50 speedup over brute force.
+    """
+    _, exact_rows = index.exact_query_vectors(Q, k=k)
+    methods = [("brute_force", None)] + [(f"kdtree_eps_{eps:g}", eps) for eps in eps_values]
+    records = []
+    for method, eps in methods:
+        latencies, found = [], []
+        for q in Q:
+            start = time.perf_counter()
+            if eps is None:
+                _, rows = index.exact_query_vectors(q, k=k)
+            else:
+                _, rows = index.query_vectors(q, k=k, eps=eps)
+            latencies.append((time.perf_counter() - start) * 1000)
+            found.append(rows[0])
+        recall = np.mean([len(set(f) & set(e)) / len(e) for f, e in zip(found, exact_rows)])
+        records.append({'method': method, 'eps': eps, 'k': k, 'indexed_rows': len(index),
+                        'dims': len(index.feature_names), 'queries': len(Q), 'recall_at_k': recall,
+                        'p50_ms': np.percentile(latencies, 50), 'p95_ms': np.percentile(latencies, 95),
+                        'mean_ms': np.mean(latencies)})
+    results = pd.DataFrame(records)
+    results['speedup_vs_brute'] = results['p50_ms'].iloc[0] / results['p50_ms']
+    exact_speedup = results.loc[results['eps'] == 0, 'speedup_vs_brute']
+    if len(exact_speedup) and exact_speedup.iloc[0] < 2:
+        # With tens of dimensions a KD-tree can prune little; exact search is then about brute-force speed
+        logger.warning("Exact KD-tree search is only %.1fx brute force over %d dimensions.",
+                       exact_speedup.iloc[0], len(index.feature_names))
+    return results
+
+
+def _jittered_copies(data_df, multiplier, seed=0):
+    """
+    The table repeated `multiplier` times with 1% noise on the numeric features, to test
+    archive-sized indexes. Every copy of a row is a near-twin of it, so query rows must be
+    left out of the table before it is copied (see the benchmark command).
+    """
+    if multiplier <= 1:
+        return data_df
+    rng = np.random.default_rng(seed)
+    df = pd.concat([data_df] * multiplier, ignore_index=True)
+    numeric_cols = df[[c for c in df.columns if c not in NON_FEATURE_COLUMNS]].select_dtypes(include='number').columns
+    df[numeric_cols] = df[numeric_cols] * rng.normal(1.0, 0.01, (len(df), len(numeric_cols)))
+    df['filename'] = [f"{i // len(data_df)}_{name}" for i, name in enumerate(df['filename'])]
+    return df
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Similar-case index over lesion feature vectors (run from the "
+                                                 "repository root: python -m util.similar_cases ...).")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    build = commands.add_parser("build", help="Build an index from a feature table.")
+    build.add_argument("--features", required=True, help="Merged feature CSV (e.g. from main_extended.py).")
+    build.add_argument("--index", required=True, help="Index file to write.")
+
+    insert = commands.add_parser("insert", help="Add (or replace) rows of a feature table.")
+    insert.add_argument("--index", required=True)
+    insert.add_argument("--features", required=True)
+
+    query = commands.add_parser("query", help="Similar past cases for images or feature rows.")
+    query.add_argument("--index", required=True)
+    query.add_argument("--images", default=None, help="Folder with query images (extended features are extracted).")
+    query.add_argument("--features", default=None, help="Feature CSV with the query rows instead of images.")
+    query.add_argument("--k", type=int, default=5)
+    query.add_argument("--eps", type=float, default=0.0, help="Approximation factor (0 = exact).")
+    query.add_argument("--output", default=None, help="CSV for the neighbours (printed otherwise).")
+
+    bench = commands.add_parser("benchmark", help="Recall and latency of the index against exact search.")
+    bench.add_argument("--features", required=True)
+    bench.add_argument("--queries", type=int, default=100,
+                       help="Real rows held out of the index (with all their copies) and used as queries.")
+    bench.add_argument("--k", type=int, default=5)
+    bench.add_argument("--eps", type=float, nargs="+", default=[0.0, 0.5, 1.0, 2.0])
+    bench.add_argument("--multiplier", type=int, default=1, help="Repeat the table (jittered) to simulate a larger archive.")
+    bench.add_argument("--seed", type=int, default=0)
+    bench.add_argument("--output", default=None, help="CSV for the benchmark table.")
+    args = parser.parse_args(argv)
+
+    configure_logging()
+    if args.command == "build":
+        index = SimilarCaseIndex.from_feature_table(pd.read_csv(args.features))
+        index.save(args.index)
+        log_run_summary(logger, "Similar-case index", rows=len(index), features=len(index.feature_names))
+    elif args.command == "insert":
+        index = SimilarCaseIndex.load(args.index)
+        before = len(index)
+        index.insert(pd.read_csv(args.features))
+        index.save(args.index)
+        log_run_summary(logger, "Similar-case insert", rows=len(index), added=len(index) - before, pending=index.pending)
+    elif args.command == "query":
+        index = SimilarCaseIndex.load(args.index)
+        if args.features:
+            query_df = pd.read_csv(args.features)
+        elif args.images:
+            from util.watch_mode import extract_batch_features, VALID_EXTENSIONS
+            files = sorted(f for f in os.listdir(args.images) if f.lower().endswith(VALID_EXTENSIONS))
+            with tempfile.TemporaryDirectory(prefix="fyp_similar_") as work_dir:
+                query_df = extract_batch_features(args.images, files, work_dir,
+                                                  compactness_mean=getattr(index, 'compactness_mean', None))
+        else:
+            parser.error("query needs --images or --features")
+        neighbours = index.query(query_df, k=args.k, eps=args.eps)
+        if args.output:
+            os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+            neighbours.to_csv(args.output, index=False)
+            logger.info("Similar cases saved to %s", args.output)
+        else:
+            print(neighbours.to_string(index=False))
+    else:
+        # Queries are real rows; only the rest of the table is copied into the archive, so no
+        # query has a jittered twin in the index
+        data_df = pd.read_csv(args.features)
+        rng = np.random.default_rng(args.seed)
+        is_query = np.zeros(len(data_df), dtype=bool)
+        is_query[rng.choice(len(data_df), size=min(args.queries, len(data_df) - 1), replace=False)] = True
+        index = SimilarCaseIndex.from_feature_table(_jittered_copies(data_df[~is_query], args.multiplier, seed=args.seed))
+        results = recall_benchmark(index, index.transform(data_df[is_query]), k=args.k, eps_values=args.eps)
+        print(results.to_string(index=False))
+        if args.output:
+            os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+            results.to_csv(args.output, index=False)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
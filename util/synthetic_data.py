@@ -0,0 +1,86 @@
+import os
+
+import cv2
+import numpy as np
+import pandas as pd
+
+
+def make_synthetic_lesion(size, rng, n_hairs=3, blue_patch=False):
+    """
+    Create one lesion-like BGR image: a noisy skin-coloured background with a dark,
+    irregular elliptical lesion, optional blue-whitish patch and a few dark hair strokes.
+
+    Parameters:
+    size (int): Width and height of the square image in pixels.
+    rng (np.random.Generator): Random generator used for all randomness.
+    n_hairs (int): Number of hair-like dark lines drawn over the image.
+    blue_patch (bool): Whether to add a blue-veil-like patch inside the lesion.
+
+    Returns:
+    np.ndarray: uint8 BGR image of shape (size, size, 3).
+    """
+    skin_bgr = np.array([150, 170, 205]) + rng.integers(-15, 15, 3)
+    img = np.empty((size, size, 3), dtype=np.float32)
+    img[:] = skin_bgr
+    img += rng.normal(0, 8, img.shape)
+
+    center = (int(size / 2 + rng.integers(-size // 10, size // 10 + 1)),
+              int(size / 2 + rng.integers(-size // 10, size // 10 + 1)))
+    axes = (int(size * rng.uniform(0.15, 0.3)), int(size * rng.uniform(0.1, 0.25)))
+    lesion_bgr = tuple(int(c) for c in np.array([45, 55, 90]) + rng.integers(-20, 20, 3))
+    cv2.ellipse(img, center, axes, float(rng.uniform(0, 180)), 0, 360, lesion_bgr, -1)
+
+    # Bumpy border: a few overlapping smaller blobs along the ellipse
+    for _ in range(4):
+        offset = (rng.uniform(-1, 1, 2) * np.array(axes)).astype(int)
+        blob_center = (int(center[0] + offset[0]), int(center[1] + offset[1]))
+        cv2.circle(img, blob_center, int(min(axes) * rng.uniform(0.3, 0.6)), lesion_bgr, -1)
+
+    if blue_patch:
+        cv2.circle(img, center, max(2, min(axes) // 3), (170, 120, 90), -1)
+
+    for _ in range(n_hairs):
+        p = rng.integers(0, size, 4)
+        cv2.line(img, (int(p[0]), int(p[1])), (int(p[2]), int(p[3])), (25, 25, 30), max(1, size // 200))
+
+    img = cv2.GaussianBlur(img, (3, 3), 0)
+    return np.clip(img, 0, 255).astype(np.uint8)
+
+
+def generate_synthetic_dataset(folder, n_images, size, seed=0, labels_csv=None):
+    """
+    Write `n_images` synthetic lesion images to `folder` and optionally a metadata CSV
+    shaped like dataset.csv (img_id, patient_id, lesion_id, diagnostic).
+
+    Parameters:
+    folder (str): Output folder for the PNG images (created if missing).
+    n_images (int): Number of images to generate.
+    size (int): Image width/height in pixels.
+    seed (int): Seed so the same call always produces the same images.
+    labels_csv (str or None): If given, path of the metadata CSV to write.
+
+    Returns:
+    list: Filenames of the generated images.
+    """
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    diagnoses = ["BCC", "SCC", "MEL", "NEV", "ACK", "SEK"]
+
+    filenames = []
+    rows = []
+    for i in range(n_images):
+        patient = f"PAT_{i // 2}"
+        lesion_id = 1000 + i
+        filename = f"{patient}_{lesion_id}_{i}.png"
+        img = make_synthetic_lesion(size, rng, n_hairs=int(rng.integers(0, 6)), blue_patch=bool(i % 4 == 1))
+        cv2.imwrite(os.path.join(folder, filename), img)
+        filenames.append(filename)
+        # Alternate cancer / non-cancer so every fold sees both classes
+        diagnostic = diagnoses[(i % 2) * 3 + int(rng.integers(0, 3))]
+        rows.append({'img_id': filename, 'patient_id': patient, 'lesion_id': lesion_id, 'diagnostic': diagnostic})
+
+    if labels_csv:
+        os.makedirs(os.path.dirname(labels_csv) or '.', exist_ok=True)
+        pd.DataFrame(rows).to_csv(labels_csv, index=False)
+
+    return filenames
@@ -0,0 +1,387 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+import cv2
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
+from sklearn.linear_model import LogisticRegression
+
+from util.logging_util import get_logger, configure_logging, ErrorSummary, log_run_summary
+from util.contrast_feature import segment_lesion_gray, compute_contrast_features
+from util.feature_matrix import build_feature_matrix, drop_all_nan_columns, impute_mean_inplace
+from util.feature_sink import FeatureSink
+from util.metadata_index import load_metadata_index
+from util.cv_folds import get_cv_folds
+from util.model_bundle import save_model_bundle, load_model_bundle, score_dataframe
+
+logger = get_logger("triage")
+
+VALID_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+# The fast tier works on a small copy of the image; no hair removal, no KMeans, no PCA
+FAST_SIZE = 128
+FAST_WINDOWS = (5,)
+FAST_RING_WIDTHS = (8,)
+
+# Fast-tier decisions with max(p, 1 - p) below this are escalated to the full pipeline
+TRIAGE_CONFIDENCE = 0.85
+CANDIDATE_THRESHOLDS = (0.6, 0.7, 0.8, 0.85, 0.9, 0.95)
+
+# Metadata from dataset.csv used by the fast tier
+METADATA_NUMERIC = ('age', 'diameter_1', 'diameter_2', 'fitspatrick')
+METADATA_FLAGS = ('smoke', 'drink', 'pesticide', 'skin_cancer_history', 'cancer_history',
+                  'itch', 'grew', 'hurt', 'changed', 'bleed', 'elevation')
+METADATA_CATEGORICAL = {'region': 'meta_region', 'gender': 'meta_gender'}
+
+_FLAG_VALUES = {True: 1.0, False: 0.0, 'True': 1.0, 'False': 0.0}
+
+
+def cheap_features_from_image(img_bgr):
+    """
+    Features that cost about a millisecond per image: grey-level contrast and colour
+    statistics of an Otsu lesion mask on a FAST_SIZE x FAST_SIZE copy.
+
+    Returns:
+    dict: Feature values (without 'filename'), all prefixed 'fast_'.
+    """
+    small = cv2.resize(img_bgr, (FAST_SIZE, FAST_SIZE), interpolation=cv2.INTER_AREA)
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    mask = segment_lesion_gray(gray)
+    if not mask.any():
+        # Same fallback region the colour features use: the central circle
+        mask = np.zeros(gray.shape, dtype=np.uint8)
+        cv2.circle(mask, (FAST_SIZE // 2, FAST_SIZE // 2), FAST_SIZE // 3, 1, -1)
+        mask = mask.astype(bool)
+
+    features = {f'fast_{name}': value for name, value in
+                compute_contrast_features(gray, mask, windows=FAST_WINDOWS, ring_widths=FAST_RING_WIDTHS).items()}
+    features['fast_lesion_fraction'] = mask.mean()
+
+    background = ~mask
+    hsv = cv2.cvtColor(small, cv2.COLOR_BGR2HSV)
+    lesion_bgr = small[mask].astype(np.float64)
+    for i, channel in enumerate('BGR'):
+        features[f'fast_mean_{channel}'] = lesion_bgr[:, i].mean()
+        features[f'fast_std_{channel}'] = lesion_bgr[:, i].std()
+    lesion_hsv = hsv[mask].astype(np.float64)
+    for i, channel in enumerate('HSV'):
+        features[f'fast_mean_{channel}'] = lesion_hsv[:, i].mean()
+    features['fast_color_bg_dist'] = (np.linalg.norm(lesion_bgr.mean(axis=0) - small[background].mean(axis=0))
+                                      if background.any() else np.nan)
+    return features
+
+
+def extract_cheap_features(folder_path, file_list=None):
+    """Cheap features for the images in a folder (all of them, or those in `file_list`)."""
+    image_files = sorted(f for f in os.listdir(folder_path) if f.lower().endswith(VALID_EXTENSIONS))
+    if file_list is not None:
+        wanted = set(file_list)
+        image_files = [f for f in image_files if f in wanted]
+    results = FeatureSink()
+    errors = ErrorSummary(logger, "Triage features")
+    for filename in tqdm(image_files, desc="Extracting cheap features"):
+        try:
+            img = cv2.imread(os.path.join(folder_path, filename))
+            if img is None:
+                errors.record(filename, "unreadable image")
+                continue
+            results.append({'filename': filename, **cheap_features_from_image(img)})
+        except Exception as e:
+            errors.record(filename, e)
+    errors.log_summary()
+    return results.to_frame()
+
+
+def metadata_features(index, filenames):
+    """
+    Fast-tier metadata columns for `filenames` from a MetadataIndex (NaN where unknown).
+
+    Flags (True/False/UNK answers) become 1/0/NaN; region and gender stay categorical
+    and are one-hot encoded by build_feature_matrix.
+    """
+    frame = index.frame
+    rows = index.rows_for(list(filenames))
+    found = rows >= 0
+    take = np.where(found, rows, 0)
+    out = {'filename': list(filenames)}
+    for col in METADATA_NUMERIC:
+        if col in frame.columns:
+            values = pd.to_numeric(frame[col], errors='coerce').to_numpy(dtype=np.float64)[take]
+            out[f'meta_{col}'] = np.where(found, values, np.nan)
+    for col in METADATA_FLAGS:
+        if col in frame.columns:
+            values = frame[col].astype(object).map(lambda v: _FLAG_VALUES.get(v, np.nan)).to_numpy(dtype=np.float64)
+            out[f'meta_{col}'] = np.where(found, values[take], np.nan)
+    for col in METADATA_CATEGORICAL:
+        if col in frame.columns:
+            values = frame[col].astype(object).to_numpy()[take]
+            out[col] = np.where(found, values, None)
+    return pd.DataFrame(out)
+
+
+def _fast_vector(bundle, values):
+    """Feature vector in the bundle's column order from a {name: value} dict of one image."""
+    onehot_prefixes = tuple(f"{prefix}_" for prefix in METADATA_CATEGORICAL.values())
+    x = np.array([values.get(name, 0.0 if name.startswith(onehot_prefixes) else np.nan)
+                  for name in bundle['feature_names']], dtype=np.float64)
+    x[np.isinf(x)] = np.nan
+    missing = np.isnan(x)
+    x[missing] = bundle['impute_means'][missing]
+    return x.reshape(1, -1)
+
+
+def _metadata_values(meta_row):
+    """{feature name: value} of one metadata_features row, with the categorical columns one-hot."""
+    values = {}
+    for name, value in meta_row.items():
+        if name in METADATA_CATEGORICAL:
+            if value is not None and value == value:
+                values[f"{METADATA_CATEGORICAL[name]}_{value}"] = 1.0
+        elif name != 'filename':
+            values[name] = value
+    return values
+
+
+def fast_probability(bundle, values, positive_label=1):
+    model = bundle['model']
+    proba = model.predict_proba(_fast_vector(bundle, values))[0]
+    return float(proba[list(model.classes_).index(positive_label)])
+
+
+def threshold_table(y, proba, thresholds=CANDIDATE_THRESHOLDS):
+    """
+    For each confidence threshold: the fraction of images the fast tier would escalate and
+    its accuracy on the images it keeps.
+    """
+    y, proba = np.asarray(y), np.asarray(proba)
+    confidence = np.maximum(proba, 1 - proba)
+    predicted = (proba >= 0.5).astype(int)
+    table = []
+    for threshold in thresholds:
+        kept = confidence >= threshold
+        table.append({
+            'threshold': threshold,
+            'escalated_fraction': float(1 - kept.mean()),
+            'fast_accuracy': float((predicted[kept] == y[kept]).mean()) if kept.any() else np.nan,
+        })
+    return pd.DataFrame(table)
+
+
+def latency_summary(latencies_ms):
+    """count, mean, p50, p90, p99 and max of a list of latencies (ms)."""
+    arr = np.asarray(latencies_ms, dtype=np.float64)
+    if arr.size == 0:
+        return {'count': 0}
+    return {
+        'count': int(arr.size),
+        'mean_ms': round(float(arr.mean()), 2),
+        'p50_ms': round(float(np.percentile(arr, 50)), 2),
+        'p90_ms': round(float(np.percentile(arr, 90)), 2),
+        'p99_ms': round(float(np.percentile(arr, 99)), 2),
+        'max_ms': round(float(arr.max()), 2),
+    }
+
+
+def train_fast_tier(images_dir, labels_csv, model_output_path, threshold=TRIAGE_CONFIDENCE, n_splits=5, seed=42):
+    """
+    Train the fast tier (scaled logistic regression on cheap image features and metadata)
+    and save it as a model bundle.
+
+    Out-of-fold probabilities on the shared CV folds (util/cv_folds.py) give an honest
+    estimate of how many images each confidence threshold would escalate and how accurate
+    the fast tier is on the rest; the table is logged and stored in the bundle.
+
+    Parameters:
+    images_dir (str): Training images.
+    labels_csv (str): Metadata CSV (dataset.csv) with the diagnoses.
+    model_output_path (str): Where the bundle is written.
+    threshold (float): Default confidence threshold stored with the model.
+    n_splits (int): Folds for the out-of-fold estimate.
+    seed (int): Seed of the folds.
+
+    Returns:
+    dict: threshold table (list of dicts), out-of-fold accuracy and number of samples.
+    """
+    index = load_metadata_index(labels_csv)
+    files = [f for f in sorted(os.listdir(images_dir)) if f.lower().endswith(VALID_EXTENSIONS) and f in index]
+    if not files:
+        raise ValueError(f"No images in {images_dir} have metadata in {labels_csv}")
+
+    data_df = extract_cheap_features(images_dir, files).merge(metadata_features(index, files), on='filename')
+    y = index.frame['binary_target'].to_numpy()[index.rows_for(data_df['filename'].tolist())]
+    feature_columns = [col for col in data_df.columns if col != 'filename']
+    X, names = build_feature_matrix(data_df, feature_columns, categorical_columns=METADATA_CATEGORICAL)
+    X, names, dropped = drop_all_nan_columns(X, names)
+    if dropped:
+        logger.info("Dropped all-NaN fast-tier columns: %s", dropped)
+    means = impute_mean_inplace(X)
+
+    def make_model():
+        return make_pipeline(StandardScaler(), LogisticRegression(max_iter=1000, solver='liblinear'))
+
+    oof = np.full(len(y), np.nan)
+    for fold in get_cv_folds(data_df['filename'].tolist(), y, n_splits=n_splits, seed=seed):
+        model = make_model().fit(X[fold.dev], y[fold.dev])
+        oof[fold.test] = model.predict_proba(X[fold.test])[:, list(model.classes_).index(1)]
+    table = threshold_table(y, oof)
+    oof_accuracy = float(((oof >= 0.5).astype(int) == y).mean())
+    logger.info("Fast tier out-of-fold accuracy %.3f; escalation per threshold:\n%s", oof_accuracy,
+                table.to_string(index=False))
+
+    model = make_model().fit(X, y)
+    save_model_bundle(model_output_path, model, names, means, model_type='triage_fast', threshold=threshold,
+                      n_samples=len(y), oof_accuracy=oof_accuracy, threshold_table=table.to_dict('records'))
+    log_run_summary(logger, "Triage training", samples=len(y), features=len(names), oof_accuracy=round(oof_accuracy, 3))
+    return {'threshold_table': table.to_dict('records'), 'oof_accuracy': oof_accuracy, 'n_samples': len(y)}
+
+
+def triage_folder(images_dir, fast_model_path, full_model_path, labels_csv=None, threshold=None, output_csv=None,
+                  work_dir=None):
+    """
+    Score every image with the fast tier and escalate the unsure ones to the full pipeline.
+
+    Each image is handled on its own, as in interactive use: decode, cheap features and
+    fast score; if max(p, 1 - p) < threshold, hair removal, all extended extractors and
+    the full RandomForest bundle (main_extended.main's model_output_path) run for it.
+    The latency of each image is measured end to end, from reading the file to the score.
+
+    Parameters:
+    images_dir (str): Images to triage.
+    fast_model_path (str): Bundle from train_fast_tier.
+    full_model_path (str): Full-model bundle.
+    labels_csv (str or None): Metadata CSV; its answers feed the fast tier, and its
+        diagnoses (if present) are used to report accuracy per tier.
+    threshold (float or None): Confidence threshold; defaults to the one stored with the fast tier.
+    output_csv (str or None): Where the per-image results are written (plus a _summary.json).
+    work_dir (str or None): Staging area for escalated images; defaults to a temp dir.
+
+    Returns:
+    tuple: (pd.DataFrame per image, dict summary with the escalated fraction and latencies)
+    """
+    from util.watch_mode import extract_batch_features
+
+    fast_bundle = load_model_bundle(fast_model_path)
+    full_bundle = load_model_bundle(full_model_path)
+    # border_score of a single escalated image needs the training compactness mean
+    compactness_mean = full_bundle['metadata'].get('compactness_mean')
+    if compactness_mean is None:
+        logger.warning("%s has no compactness_mean (saved before it was stored); border_score of escalated "
+                       "images is not on the training scale. Re-save the full model to fix this.", full_model_path)
+    if threshold is None:
+        threshold = fast_bundle['metadata'].get('threshold', TRIAGE_CONFIDENCE)
+    files = sorted(f for f in os.listdir(images_dir) if f.lower().endswith(VALID_EXTENSIONS))
+    index = load_metadata_index(labels_csv) if labels_csv else None
+    meta = {}
+    if index is not None:
+        meta = {row['filename']: _metadata_values(row) for row in metadata_features(index, files).to_dict('records')}
+
+    owns_work_dir = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp(prefix="fyp_triage_")
+    os.makedirs(work_dir, exist_ok=True)
+    results = []
+    try:
+        for filename in tqdm(files, desc="Triage"):
+            start = time.perf_counter()
+            img = cv2.imread(os.path.join(images_dir, filename))
+            if img is None:
+                logger.warning("Could not read %s; skipped.", filename)
+                continue
+            values = {**cheap_features_from_image(img), **meta.get(filename, {})}
+            fast_prob = fast_probability(fast_bundle, values)
+            fast_ms = (time.perf_counter() - start) * 1000
+            prob, tier = fast_prob, 'fast'
+            if max(fast_prob, 1 - fast_prob) < threshold:
+                features_df = extract_batch_features(images_dir, [filename], work_dir, compactness_mean=compactness_mean)
+                if features_df is None or features_df.empty:
+                    logger.warning("Full extraction failed for %s; keeping the fast-tier score.", filename)
+                    tier = 'fast_fallback'
+                else:
+                    prob, tier = float(score_dataframe(full_bundle, features_df)['prob_cancer'].iloc[0]), 'full'
+            results.append({'filename': filename, 'tier': tier, 'fast_prob': fast_prob, 'prob_cancer': prob,
+                            'predicted_label': int(prob >= 0.5), 'fast_ms': fast_ms,
+                            'latency_ms': (time.perf_counter() - start) * 1000})
+    finally:
+        if owns_work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    results_df = pd.DataFrame(results)
+    summary = summarize_triage(results_df, threshold, index)
+    if output_csv:
+        os.makedirs(os.path.dirname(output_csv) or '.', exist_ok=True)
+        results_df.to_csv(output_csv, index=False)
+        with open(os.path.splitext(output_csv)[0] + "_summary.json", 'w') as f:
+            json.dump(summary, f, indent=2)
+        logger.info("Triage results saved to %s", output_csv)
+    return results_df, summary
+
+
+def summarize_triage(results_df, threshold, index=None):
+    """Escalated fraction, latency distribution (all / fast / escalated) and, with labels, accuracy per tier."""
+    if results_df.empty:
+        return {'threshold': threshold, 'images': 0}
+    escalated = results_df['tier'] != 'fast'
+    summary = {
+        'threshold': threshold,
+        'images': len(results_df),
+        'escalated_fraction': round(float(escalated.mean()), 4),
+        'latency_all': latency_summary(results_df['latency_ms']),
+        'latency_fast': latency_summary(results_df.loc[~escalated, 'latency_ms']),
+        'latency_escalated': latency_summary(results_df.loc[escalated, 'latency_ms']),
+        'fast_tier_ms': latency_summary(results_df['fast_ms']),
+    }
+    if index is not None and 'binary_target' in index.frame.columns:
+        rows = index.rows_for(results_df['filename'].tolist())
+        known = rows >= 0
+        if known.any():
+            y = index.frame['binary_target'].to_numpy()[rows[known]]
+            correct = results_df['predicted_label'].to_numpy()[known] == y
+            summary['accuracy'] = round(float(correct.mean()), 4)
+            for tier, mask in (('fast', ~escalated.to_numpy()[known]), ('escalated', escalated.to_numpy()[known])):
+                if mask.any():
+                    summary[f'accuracy_{tier}'] = round(float(correct[mask].mean()), 4)
+    log_run_summary(logger, "Triage", images=summary['images'], escalated_fraction=summary['escalated_fraction'],
+                    p50_ms=summary['latency_all'].get('p50_ms'), p90_ms=summary['latency_all'].get('p90_ms'),
+                    fast_p50_ms=summary['fast_tier_ms'].get('p50_ms'))
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Two-tier triage: cheap features first, full pipeline only when "
+                                                 "unsure (run from the repository root: python -m util.triage ...).")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    train = commands.add_parser("train", help="Train the fast tier.")
+    train.add_argument("--images", required=True)
+    train.add_argument("--labels", required=True, help="Metadata CSV, e.g. dataset.csv.")
+    train.add_argument("--output", required=True, help="Fast-tier bundle to write.")
+    train.add_argument("--threshold", type=float, default=TRIAGE_CONFIDENCE)
+
+    run = commands.add_parser("run", help="Triage a folder of images.")
+    run.add_argument("--images", required=True)
+    run.add_argument("--fast-model", required=True)
+    run.add_argument("--full-model", required=True, help="Bundle saved by main_extended.main(model_output_path=...).")
+    run.add_argument("--labels", default=None, help="Metadata CSV (answers for the fast tier, labels for accuracy).")
+    run.add_argument("--threshold", type=float, default=None)
+    run.add_argument("--output", default=None, help="Per-image CSV; the summary goes next to it.")
+    args = parser.parse_args(argv)
+
+    configure_logging()
+    if args.command == "train":
+        train_fast_tier(args.images, args.labels, args.output, threshold=args.threshold)
+    else:
+        _, summary = triage_folder(args.images, args.fast_model, args.full_model, labels_csv=args.labels,
+                                   threshold=args.threshold, output_csv=args.output)
+        print(json.dumps(summary, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
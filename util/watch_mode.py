@@ -0,0 +1,269 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+import pandas as pd
+
+from util.logging_util import get_logger, configure_logging, log_run_summary
+from util.model_bundle import load_model_bundle, score_dataframe
+from util.feature_B import border_compactness
+from util.checkpoint import write_csv_atomic, write_json_atomic
+
+logger = get_logger("watch_mode")
+
+VALID_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+# Defaults for the watch loop
+POLL_INTERVAL_S = 2.0
+SETTLE_SECONDS = 1.0
+MAX_BATCH = 32
+
+
+def _manifest_path(feature_store_csv):
+    return os.path.splitext(feature_store_csv)[0] + "_manifest.json"
+
+
+def load_manifest(feature_store_csv):
+    """{filename: [mtime_ns, size]} of the images already in the feature store."""
+    path = _manifest_path(feature_store_csv)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(feature_store_csv, manifest):
+    write_json_atomic(manifest, _manifest_path(feature_store_csv))
+
+
+def scan_folder(folder, manifest, settle_seconds=SETTLE_SECONDS, now=None):
+    """
+    Find images that are new or changed since they were last processed.
+
+    Files modified less than `settle_seconds` ago are skipped until the next scan, so an
+    image that is still being copied into the folder is not picked up half-written.
+
+    Returns:
+    dict: {filename: [mtime_ns, size]} of the files to process.
+    """
+    now = time.time() if now is None else now
+    pending = {}
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if not entry.is_file() or not entry.name.lower().endswith(VALID_EXTENSIONS):
+                continue
+            stat = entry.stat()
+            signature = [stat.st_mtime_ns, stat.st_size]
+            if manifest.get(entry.name) == signature:
+                continue
+            if now - stat.st_mtime < settle_seconds:
+                continue
+            pending[entry.name] = signature
+    return pending
+
+
+def extract_batch_features(folder, filenames, work_dir, compactness_mean=None):
+    """
+    Run hair removal and all extended extractors on `filenames` only.
+
+    The files are linked (or copied) into a fresh staging folder that is passed to
+    main_extended.create_feature_dataset, so the batch goes through exactly the same code
+    as a full run. No labels are merged here: new clinic images are usually unlabeled.
+    border_score is normalised with `compactness_mean` (training data or feature store,
+    see reference_compactness_mean); without it, by the batch's own mean.
+    """
+    import main_extended
+
+    batch_dir = tempfile.mkdtemp(prefix="batch_", dir=work_dir)
+    try:
+        source_dir = os.path.join(batch_dir, "images")
+        os.makedirs(source_dir)
+        for filename in filenames:
+            src, dst = os.path.join(folder, filename), os.path.join(source_dir, filename)
+            try:
+                os.link(src, dst)
+            except OSError:
+                shutil.copy2(src, dst)
+        return main_extended.create_feature_dataset(source_dir, None, os.path.join(batch_dir, "features.csv"),
+                                                    labels_csv=None, recreate_features=True,
+                                                    compactness_mean=compactness_mean)
+    finally:
+        shutil.rmtree(batch_dir, ignore_errors=True)
+
+
+def append_to_feature_store(feature_store_csv, batch_df):
+    """
+    Add the batch rows to the feature store CSV.
+
+    New filenames with the store's columns are appended in place; if a file was changed
+    (its old row must go) or the columns differ, the store is rewritten atomically.
+    Label columns of existing rows are kept, new rows get NaN labels.
+    """
+    if not os.path.exists(feature_store_csv):
+        os.makedirs(os.path.dirname(feature_store_csv) or '.', exist_ok=True)
+        batch_df.to_csv(feature_store_csv, index=False)
+        return len(batch_df)
+
+    header = pd.read_csv(feature_store_csv, nrows=0).columns.tolist()
+    store_filenames = pd.read_csv(feature_store_csv, usecols=['filename'])['filename']
+    replaced = store_filenames.isin(batch_df['filename'])
+    batch_df = batch_df.reindex(columns=header) if set(batch_df.columns) <= set(header) else batch_df
+
+    if not replaced.any() and list(batch_df.columns) == header:
+        batch_df.to_csv(feature_store_csv, mode='a', header=False, index=False)
+    else:
+        store_df = pd.read_csv(feature_store_csv)
+        old_rows = store_df[store_df['filename'].isin(batch_df['filename'])]
+        label_cols = [col for col in ('real_label', 'binary_target') if col in old_rows.columns]
+        if label_cols:
+            # A re-processed image keeps the label it already had
+            batch_df = batch_df.drop(columns=label_cols, errors='ignore').merge(
+                old_rows[['filename'] + label_cols], on='filename', how='left')
+        store_df = pd.concat([store_df[~store_df['filename'].isin(batch_df['filename'])], batch_df],
+                             ignore_index=True)
+        write_csv_atomic(store_df, feature_store_csv)
+    return len(batch_df)
+
+
+def reference_compactness_mean(feature_store_csv, model_bundle=None):
+    """
+    Compactness mean that border_score of new batches is normalised with: the training
+    mean stored in the model bundle, else the mean over the feature store, else None
+    (an empty store; the first batch then uses its own mean, as a full run would).
+    """
+    if model_bundle is not None and model_bundle['metadata'].get('compactness_mean') is not None:
+        return model_bundle['metadata']['compactness_mean']
+    if os.path.exists(feature_store_csv):
+        columns = ['avg_contour_perimeter', 'avg_contour_area']
+        if set(columns) <= set(pd.read_csv(feature_store_csv, nrows=0).columns):
+            mean = border_compactness(pd.read_csv(feature_store_csv, usecols=columns)).mean()
+            if pd.notna(mean):
+                return float(mean)
+    return None
+
+
+def append_predictions(predictions_csv, predictions_df):
+    predictions_df = predictions_df.assign(scored_at=pd.Timestamp.now().isoformat(timespec='seconds'))
+    write_header = not os.path.exists(predictions_csv)
+    predictions_df.to_csv(predictions_csv, mode='a', header=write_header, index=False)
+
+
+def process_pending(folder, feature_store_csv, manifest, pending, work_dir, model_bundle=None,
+                    predictions_csv=None, compactness_mean=None):
+    """Extract, store and (optionally) score one batch of pending files; updates the manifest."""
+    start = time.perf_counter()
+    batch_df = extract_batch_features(folder, sorted(pending), work_dir, compactness_mean=compactness_mean)
+    if batch_df is None or batch_df.empty:
+        logger.warning("No features extracted for batch of %d file(s): %s", len(pending), sorted(pending)[:5])
+        done = []
+    else:
+        append_to_feature_store(feature_store_csv, batch_df)
+        done = batch_df['filename'].tolist()
+        if model_bundle is not None and predictions_csv:
+            predictions_df = score_dataframe(model_bundle, batch_df)
+            append_predictions(predictions_csv, predictions_df)
+            for row in predictions_df.itertuples(index=False):
+                logger.info("Scored %s: p(cancer)=%.3f", row.filename, row.prob_cancer)
+
+    # Files that failed are recorded too, so they are retried only once they change again
+    manifest.update(pending)
+    save_manifest(feature_store_csv, manifest)
+    elapsed = time.perf_counter() - start
+    log_run_summary(logger, "Watch batch", files=len(pending), stored=len(done), seconds=round(elapsed, 2),
+                    seconds_per_image=round(elapsed / len(pending), 2))
+    return done
+
+
+def watch_folder(folder, feature_store_csv, model_path=None, predictions_csv=None, poll_interval=POLL_INTERVAL_S,
+                 settle_seconds=SETTLE_SECONDS, max_batch=MAX_BATCH, once=False, work_dir=None):
+    """
+    Watch `folder` and keep `feature_store_csv` up to date with its images.
+
+    Every `poll_interval` seconds the folder is scanned; new or changed images (at most
+    `max_batch` per round) go through hair removal and all extended extractors and are
+    appended to the store. With `model_path` (a bundle saved by main_extended.main's
+    model_output_path) each new image is also scored and written to `predictions_csv`.
+
+    Parameters:
+    folder (str): Folder the clinics drop images into (original_img_dir).
+    feature_store_csv (str): Merged feature CSV to extend (the output_csv_path of a full run).
+    model_path (str or None): Saved model bundle for scoring.
+    predictions_csv (str or None): Where scores are appended; defaults next to the store.
+    poll_interval (float): Seconds between scans.
+    settle_seconds (float): Minimum age of a file before it is processed.
+    max_batch (int): Maximum images per batch.
+    once (bool): Process what is pending now and return instead of looping.
+    work_dir (str or None): Staging area for batches; defaults to a temp dir.
+
+    Returns:
+    int: Number of images added to the store.
+    """
+    if not os.path.isdir(folder):
+        raise FileNotFoundError(f"Watch folder not found: {folder}")
+    model_bundle = load_model_bundle(model_path) if model_path else None
+    if model_bundle is not None and predictions_csv is None:
+        predictions_csv = os.path.splitext(feature_store_csv)[0] + "_predictions.csv"
+
+    manifest = load_manifest(feature_store_csv)
+    if not manifest and os.path.exists(feature_store_csv):
+        # Store from a full run without a manifest: treat its images as processed
+        known = set(pd.read_csv(feature_store_csv, usecols=['filename'])['filename'])
+        manifest = {name: sig for name, sig in scan_folder(folder, {}, settle_seconds=0).items() if name in known}
+        save_manifest(feature_store_csv, manifest)
+        logger.info("Initialised manifest with %d images already in %s", len(manifest), feature_store_csv)
+
+    # Fixed for the whole session, so every batch's border_score is on the same scale as the store
+    compactness_mean = reference_compactness_mean(feature_store_csv, model_bundle)
+    owns_work_dir = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp(prefix="fyp_watch_")
+    os.makedirs(work_dir, exist_ok=True)
+    added = 0
+    logger.info("Watching %s (poll every %.1fs) -> %s", folder, poll_interval, feature_store_csv)
+    try:
+        while True:
+            pending = scan_folder(folder, manifest, settle_seconds=settle_seconds)
+            if pending:
+                batch = dict(sorted(pending.items())[:max_batch])
+                logger.info("Processing %d new/changed image(s) (%d pending)", len(batch), len(pending))
+                added += len(process_pending(folder, feature_store_csv, manifest, batch, work_dir,
+                                             model_bundle=model_bundle, predictions_csv=predictions_csv,
+                                             compactness_mean=compactness_mean))
+                if len(pending) > len(batch):
+                    continue
+            if once:
+                break
+            time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        logger.info("Watch mode stopped.")
+    finally:
+        if owns_work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return added
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Incrementally extract features for images dropped into a folder "
+                                                 "(run from the repository root: python -m util.watch_mode ...).")
+    parser.add_argument("folder", help="Folder to watch (original_img_dir).")
+    parser.add_argument("feature_store", help="Feature CSV to append to (output_csv_path of a full run).")
+    parser.add_argument("--model", default=None, help="Model bundle saved by main_extended.main(model_output_path=...).")
+    parser.add_argument("--predictions", default=None, help="CSV the scores are appended to.")
+    parser.add_argument("--poll-interval", type=float, default=POLL_INTERVAL_S)
+    parser.add_argument("--settle-seconds", type=float, default=SETTLE_SECONDS)
+    parser.add_argument("--max-batch", type=int, default=MAX_BATCH)
+    parser.add_argument("--once", action="store_true", help="Process pending images once and exit.")
+    args = parser.parse_args(argv)
+
+    configure_logging()
+    added = watch_folder(args.folder, args.feature_store, model_path=args.model, predictions_csv=args.predictions,
+                         poll_interval=args.poll_interval, settle_seconds=args.settle_seconds,
+                         max_batch=args.max_batch, once=args.once)
+    logger.info("Added %d image(s) to %s", added, args.feature_store)
+
+
+if __name__ == "__main__":
+    sys.exit(main())